@@ -1,31 +1,52 @@
+import base64
 import helpers
 import requests
 import numpy as np
 
 API_ROOT = helpers.load_env_string("MODEL_API_BASE_URL")
 
+# Shared by every rerun of the app, so connections to the api are kept alive and reused
+# rather than opened for each request. Its connection pool is thread-safe, and nothing else on it changes.
+session = requests.Session()
+session.mount(API_ROOT, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
+def response_json(response: requests.Response):
+    """Raises for an error response (e.g. a 503 whilst the api is overloaded), so it isn't used (or cached) as a result"""
+    response.raise_for_status()
+    return response.json()
+
+def digit_bytes(pixels: np.array) -> bytes:
+    """The 784 raw bytes of the 28 x 28 greyscale image, row by row"""
+    return np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+
 def digit_json(pixels: np.array):
     return {
-        # Convert to JSON array
-        "pixels": [[pixel.item() for pixel in row] for row in pixels]
+        # Much cheaper to build and parse than a nested JSON array of 784 integers
+        "pixels_base64": base64.b64encode(digit_bytes(pixels)).decode('ascii')
     }
 
 def recognize_digit(pixels: np.array):
-    return requests.post(
+    return response_json(session.post(
         f'{API_ROOT}/recognize-digit',
-        json = digit_json(pixels),
-    ).json()
+        data = digit_bytes(pixels),
+        headers = {"Content-Type": "application/octet-stream"},
+    ))
 
 def submit_digit(pixels: np.array, label: int):
-    return requests.post(
+    return response_json(session.post(
         f'{API_ROOT}/submit-digit',
         json = {
             "digit": digit_json(pixels),
             "label": label,
         }
-    ).json()
+    ))
 
 def recent_submissions():
-    return requests.get(
-        f'{API_ROOT}/recent-submissions'
-    ).json()
\ No newline at end of file
+    # The images are rendered inline, as the browser can't reach the api to fetch them by id
+    return response_json(session.get(
+        f'{API_ROOT}/recent-submissions',
+        params = {"limit": 20, "include_images": True},
+    ))["submissions"]
+
+def model_stats():
+    return response_json(session.get(f'{API_ROOT}/model-stats'))
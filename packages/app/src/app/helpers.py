@@ -8,8 +8,6 @@ def load_env_string(name: str) -> str:
         raise ValueError(f"Environment variable {name} not set")
     return loaded
 
-# Could probably use torchvision to help here, but I wanted to get some numpy experience
-# (Using e.g. channel helper methods, and pooling for the mean)
 def rgba_to_downscaled_greyscale(rgba: np.array, output_shape: (int, int)) -> np.array:
     """
     Takes an RGBA image from a canvas and downscales it to a greyscale image of the given shape.
@@ -21,6 +19,8 @@ def rgba_to_downscaled_greyscale(rgba: np.array, output_shape: (int, int)) -> np
     > This function outputs a (Y, X) shaped byte array, created by:
       * Flattening the RGBA channels into one greyscale channel
       * Downscaling by taking the mean of this greyscale channel over (y_scale, x_scale) blocks
+
+    It's all integer arithmetic, so each mean is exact before being rounded down.
     """
 
     # STEP 1: Sanity check the inputs and calculate the scale factors
@@ -34,14 +34,35 @@ def rgba_to_downscaled_greyscale(rgba: np.array, output_shape: (int, int)) -> np
     y_scale = input_height // output_height
     x_scale = input_width // output_width
 
-    # STEP 2: Handle the greyscale conversion and alpha blending assuming a white background
-    greyscale_foreground = np.matmul(rgba, [1.0/3, 1.0/3, 1.0/3, 0])
-    alpha_mask = np.matmul(rgba, [0, 0, 0, 1.0/256])
-    background_mask = np.ones_like(alpha_mask) - alpha_mask
-    background = np.full_like(alpha_mask, 255, dtype=np.float64)
-    opaque_greyscale = (background * background_mask + greyscale_foreground * alpha_mask)
-
-    # STEP 3: Downscale the image by taking the mean of the greyscale values in each block
-    reshaped_data: np.array = np.reshape(opaque_greyscale, shape=(output_height, y_scale, output_width, x_scale))
-    meaned_data = np.mean(reshaped_data, axis=(1, 3))
-    return meaned_data.astype(np.uint8)
\ No newline at end of file
+    # STEP 2: Handle the greyscale conversion and alpha blending assuming a white background.
+    # The greyscale value is 255 + ((R + G + B) / 3 - 255) * (A / 256), which we keep multiplied
+    # by 3 * 256 and without the constant 255, so it's a (negative) integer. Each step is in place,
+    # on one int32 channel at a time.
+    greyscale_offset = rgba[:, :, 0].astype(np.int32)
+    greyscale_offset += rgba[:, :, 1]
+    greyscale_offset += rgba[:, :, 2]
+    greyscale_offset -= 3 * 255
+    greyscale_offset *= rgba[:, :, 3]
+
+    # STEP 3: Downscale the image by summing the values in each block (along y, then x),
+    # then add back the constant 255 and divide out the scaling and block size
+    block_sums = (
+        greyscale_offset
+            .reshape(output_height, y_scale, input_width).sum(axis=1)
+            .reshape(output_height, output_width, x_scale).sum(axis=2)
+    )
+    block_size = y_scale * x_scale
+    return ((block_sums + 255 * 3 * 256 * block_size) // (3 * 256 * block_size)).astype(np.uint8)
+
+def greyscale_preview(pixels: np.array, scale: int) -> np.array:
+    """
+    Upscales a (Y, X) greyscale byte array to a (Y * scale, X * scale, 4) RGBA image,
+    with the background tinted slightly blue.
+    """
+    rgba = np.empty((*pixels.shape, 4), dtype=np.uint8)
+    # The min just makes the background slightly blue
+    rgba[:, :, 0] = np.minimum(pixels, 240)
+    rgba[:, :, 1] = np.minimum(pixels, 245)
+    rgba[:, :, 2] = pixels
+    rgba[:, :, 3] = 255
+    return np.repeat(np.repeat(rgba, scale, axis=0), scale, axis=1)
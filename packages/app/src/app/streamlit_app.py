@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import requests
 from streamlit_drawable_canvas import st_canvas
 from datetime import datetime, UTC
 import helpers
@@ -42,32 +43,30 @@ if canvas_result.image_data is not None and canvas_result.image_data.shape == (R
 else:
     vision_pixels = np.full(shape=(RAW_IMAGE_SIZE, RAW_IMAGE_SIZE), fill_value=255, dtype=np.uint8)
 
+@st.cache_data(max_entries=256, ttl=600, show_spinner=False)
+def recognize_digit(pixel_bytes: bytes):
+    # Keyed by the pixels, so reruns which don't change the drawing (e.g. changing the label, or a stroke
+    # too small to change the downscaled image) don't call the api again
+    return api_client.recognize_digit(np.frombuffer(pixel_bytes, dtype=np.uint8).reshape(RAW_IMAGE_SIZE, RAW_IMAGE_SIZE))
+
 with predictions_column:
     with st.container(border=True):
         st.subheader("Predictions")
-        canvas_pixels = np.vstack([
-            np.hstack([
-                np.broadcast_to(
-                    # Three copies of greyscale value, then alpha channel
-                    # The min just makes the background slightly blue
-                    np.array([min(vision_pixel, 240), min(vision_pixel, 245), min(vision_pixel, 255), 255]),
-                    # Broadcast these 4 values to a block of size DRAWING_SCALE * DRAWING_SCALE
-                    (DRAWING_SCALE, DRAWING_SCALE, 4),
-                )
-                for vision_pixel in vision_pixels_row
-            ]) for vision_pixels_row in vision_pixels
-        ])
-        st.image(canvas_pixels)
-
-        predictions = api_client.recognize_digit(vision_pixels)
-
-        table_data = pd.DataFrame({
-            "Model": [prediction["model"] for prediction in predictions],
-            "Prediction": [prediction["predicted_digit"] for prediction in predictions],
-            "Confidence": [f'{prediction["confidence"]:2.1%}' for prediction in predictions],
-        })
-        table_data.set_index('Model', inplace=True)
-        st.table(table_data)
+        st.image(helpers.greyscale_preview(vision_pixels, DRAWING_SCALE))
+
+        try:
+            # Failed requests raise, so aren't cached, and are retried on the next rerun
+            predictions = recognize_digit(vision_pixels.tobytes())
+        except requests.RequestException as e:
+            st.error(f"The digit couldn't be recognized, try again shortly: {e}")
+        else:
+            table_data = pd.DataFrame({
+                "Model": [prediction["model"] for prediction in predictions],
+                "Prediction": [prediction["predicted_digit"] for prediction in predictions],
+                "Confidence": [f'{prediction["confidence"]:2.1%}' for prediction in predictions],
+            })
+            table_data.set_index('Model', inplace=True)
+            st.table(table_data)
 
 if "submission_reload_at" not in st.session_state:
     st.session_state.submission_reload_at = datetime.now(UTC).timestamp() * 1000
@@ -109,3 +108,48 @@ with st.container(border = True):
             "Image": st.column_config.ImageColumn()
         }
     )
+
+@st.cache_data(ttl=60)
+def load_model_stats(cache_key):
+    # Also refreshed every minute, to include others' submissions
+    _ignore = cache_key
+    return api_client.model_stats()
+
+with st.container(border = True):
+    st.subheader("Model accuracy")
+    # Running totals kept by the api, so this is cheap however many submissions there are
+    model_stats = load_model_stats(cache_key = st.session_state.submission_reload_at)
+    if len(model_stats) == 0:
+        st.write("No submissions yet")
+    else:
+        summary_table = pd.DataFrame({
+            "Model": list(model_stats),
+            "Submissions": [stats["count"] for stats in model_stats.values()],
+            "Accuracy": [f'{stats["accuracy"]:2.1%}' for stats in model_stats.values()],
+            "Calibration error": [f'{stats["expected_calibration_error"]:2.1%}' for stats in model_stats.values()],
+        })
+        summary_table.set_index('Model', inplace=True)
+        st.table(summary_table)
+
+        selected_model = st.selectbox("Model", list(model_stats))
+        stats = model_stats[selected_model]
+        confusion_column, calibration_column = st.columns([1, 1])
+        with confusion_column:
+            st.caption("Actual digits (rows) by predicted digits (columns)")
+            st.dataframe(pd.DataFrame(
+                stats["confusion_matrix"],
+                index = [f"Actual {digit}" for digit in range(10)],
+                columns = [str(digit) for digit in range(10)],
+            ))
+        with calibration_column:
+            st.caption("Accuracy of the predictions in each confidence bin, against their mean confidence")
+            calibration_table = pd.DataFrame([
+                {
+                    "Confidence": f'{bin["min_confidence"]:.1f}-{bin["max_confidence"]:.1f}',
+                    "Accuracy": bin["accuracy"],
+                    "Mean confidence": bin["mean_confidence"],
+                }
+                for bin in stats["calibration"] if bin["count"] > 0
+            ])
+            calibration_table.set_index('Confidence', inplace=True)
+            st.line_chart(calibration_table)
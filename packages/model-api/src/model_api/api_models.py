@@ -1,25 +1,180 @@
-from pydantic import BaseModel
-from typing import List, Self
-from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from typing import Any, Callable, List, Self
+import functools
+import secrets
+from fastapi import Header, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
 import numpy as np
 
+from . import wire_formats
 from .submission_store import DbSubmission
-from .predictions import PredictionDigitData, PredictionClassification
+from .predictions import PredictionDigitData, PredictionClassification, parse_model_names
+from .instrumentation import time_stage
+from .config import load_env_int, load_env_string_or_default
 
 class ApiDigitData(BaseModel):
-    pixels: List[List[int]]
+    """Either pixels, or pixels_base64 with the 784 raw bytes of the image, row by row"""
+    pixels: List[List[int]] | None = None
+    pixels_base64: str | None = None
 
     def to_prediction_model(self) -> PredictionDigitData:
+        if (self.pixels is None) == (self.pixels_base64 is None):
+            raise HTTPException(status_code=400, detail="Expected exactly one of pixels or pixels_base64")
+        if self.pixels_base64 is not None:
+            pixels = decode_or_400(wire_formats.decode_base64_pixels, self.pixels_base64, expected_count=1)
+            return PredictionDigitData(
+                pixels=pixels[0]
+            )
         try:
             pixels = np.array(self.pixels, dtype=np.uint8)
             pixels = pixels.reshape((28, 28))
-        except ValueError as e:
+        except (ValueError, OverflowError) as e:
             raise HTTPException(status_code=400,
                                 detail="Invalid pixel data shape, expected 28 x 28 integers from 0-255") from e
         return PredictionDigitData(
             pixels=pixels
         )
 
+class ApiDigitBatch(BaseModel):
+    """Either digits, or digits_base64 with the concatenated 784 raw bytes of each image"""
+    digits: List[List[List[int]]] | None = None
+    digits_base64: str | None = None
+
+    def to_pixels_array(self) -> np.ndarray:
+        """Returns the digits as a single N x 28 x 28 uint8 array"""
+        if (self.digits is None) == (self.digits_base64 is None):
+            raise HTTPException(status_code=400, detail="Expected exactly one of digits or digits_base64")
+        if self.digits_base64 is not None:
+            return decode_or_400(wire_formats.decode_base64_pixels, self.digits_base64)
+        try:
+            pixels = np.array(self.digits, dtype=np.uint8)
+            if pixels.ndim != 3 or pixels.shape[1:] != (28, 28):
+                raise ValueError(f"Unexpected shape {pixels.shape}")
+        except (ValueError, OverflowError) as e:
+            raise HTTPException(status_code=400,
+                                detail="Invalid pixel data shape, expected a list of 28 x 28 integers from 0-255") from e
+        return pixels
+
+def decode_or_400(decode: Callable[[Any], np.ndarray], data, expected_count: int | None = None) -> np.ndarray:
+    try:
+        pixels = decode(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    if expected_count is not None and len(pixels) != expected_count:
+        raise HTTPException(status_code=400, detail=f"Expected {expected_count} digit(s), got {len(pixels)}")
+    return pixels
+
+def _content_type(request: Request) -> str:
+    return request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+
+def _parse_json_body(model: type[BaseModel], body: bytes):
+    try:
+        with time_stage("validate"):
+            return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([error | {"loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]) from e
+
+async def read_digit(request: Request) -> PredictionDigitData:
+    """
+    Reads a single digit from the request body, as either:
+    * JSON matching ApiDigitData
+    * application/octet-stream with the 784 raw bytes of the image
+    * image/png with a 28 x 28 PNG image
+    """
+    content_type = _content_type(request)
+    with time_stage("read_body"):
+        body = await request.body()
+    if content_type == "application/octet-stream":
+        with time_stage("decode"):
+            pixels = decode_or_400(wire_formats.decode_raw_pixels, body, expected_count=1)
+        return PredictionDigitData(pixels=pixels[0])
+    if content_type == "image/png":
+        with time_stage("decode"):
+            pixels = decode_or_400(wire_formats.decode_png_pixels, body, expected_count=1)
+        return PredictionDigitData(pixels=pixels[0])
+    digit = _parse_json_body(ApiDigitData, body)
+    with time_stage("decode"):
+        return digit.to_prediction_model()
+
+# Big enough for offline relabelling jobs, whilst keeping a single request's memory bounded
+BULK_MAX_DIGITS = 10_000
+# The most a digit of a bulk request can take in JSON, allowing for up to 8 bytes per pixel, e.g. "255, " and whitespace
+_BULK_MAX_JSON_BYTES_PER_DIGIT = wire_formats.DIGIT_BYTES * 8
+
+def _too_many_digits() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"At most {BULK_MAX_DIGITS} digits can be recognized per request")
+
+async def _read_body_at_most(request: Request, max_bytes: int) -> bytes:
+    """Reads the body, rejecting it with a 413 as soon as it's known to be longer than max_bytes, before it's all read"""
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        raise _too_many_digits()
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise _too_many_digits()
+    return bytes(body)
+
+async def read_digit_batch(request: Request) -> np.ndarray:
+    """
+    Reads an N x 28 x 28 array of at most BULK_MAX_DIGITS digits from the request body, as either:
+    * JSON matching ApiDigitBatch
+    * application/octet-stream with the concatenated 784 raw bytes of each image
+    """
+    content_type = _content_type(request)
+    if content_type == "application/octet-stream":
+        max_bytes = BULK_MAX_DIGITS * wire_formats.DIGIT_BYTES
+    else:
+        max_bytes = BULK_MAX_DIGITS * _BULK_MAX_JSON_BYTES_PER_DIGIT
+    with time_stage("read_body"):
+        body = await _read_body_at_most(request, max_bytes)
+    if content_type == "application/octet-stream":
+        with time_stage("decode"):
+            return decode_or_400(wire_formats.decode_raw_pixels, body)
+    digits = _parse_json_body(ApiDigitBatch, body)
+    with time_stage("decode"):
+        pixels = digits.to_pixels_array()
+    # JSON digits can only be counted once parsed
+    if len(pixels) > BULK_MAX_DIGITS:
+        raise _too_many_digits()
+    return pixels
+
+_BINARY_SCHEMA = {"type": "string", "format": "binary"}
+
+def read_model_names(models: str | None = None) -> tuple[str, ...]:
+    """The models query parameter: a comma separated list of the models to predict with, e.g. cnn-v1,cnn-v2-int8"""
+    try:
+        return parse_model_names(models)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+def read_deadline_ms(
+    deadline_ms: float | None = Query(None, gt=0, description="Leave out models which haven't finished this long after the request arrives"),
+) -> float | None:
+    """The deadline_ms query parameter, or None if it isn't given, for inference.create_predictions to default to PREDICTION_DEADLINE_MS"""
+    return deadline_ms
+
+# The /admin endpoints need an "Authorization: Bearer <ADMIN_TOKEN>" header, and are disabled if it isn't set
+ADMIN_TOKEN = load_env_string_or_default("ADMIN_TOKEN", "")
+
+def require_admin(authorization: str | None = Header(None)):
+    if ADMIN_TOKEN == "":
+        raise HTTPException(status_code=403, detail="The admin endpoints are disabled, as ADMIN_TOKEN isn't set")
+    if authorization is None or not secrets.compare_digest(authorization.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Expected an admin bearer token", headers={"WWW-Authenticate": "Bearer"})
+
+def digit_request_body_openapi(json_model: type[BaseModel], binary_content_types: List[str]) -> dict:
+    """Documents the body of endpoints which read it themselves via read_digit or read_digit_batch"""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": json_model.model_json_schema()}} | {
+                content_type: {"schema": _BINARY_SCHEMA} for content_type in binary_content_types
+            },
+        }
+    }
+
 class ApiSubmittedDigit(BaseModel):
     digit: ApiDigitData
     label: int
@@ -57,21 +212,40 @@ class ApiDigitClassification(BaseModel):
             confidence=prediction_model.confidence,
         )
 
+@functools.lru_cache(maxsize=load_env_int("PNG_CACHE_SIZE", 1024))
+def cached_png_bytes(raw_pixels: bytes) -> bytes:
+    """Submissions are stored as pixels, so their PNGs are only encoded when requested, and the most recent are kept"""
+    return wire_formats.encode_png_pixels(wire_formats.decode_raw_pixels(raw_pixels))
+
+def submission_png_bytes(db_model: DbSubmission) -> bytes:
+    if db_model.deflated_pixels is None:
+        # Stored as a PNG by an earlier version
+        return db_model.png_bytes
+    return cached_png_bytes(wire_formats.encode_raw_pixels(wire_formats.decode_deflated_pixels(db_model.deflated_pixels)))
+
 def png_bytes_to_base64(png_bytes: bytes) -> str:
     import base64
     return base64.b64encode(png_bytes).decode('ascii')
 
 class ApiPreviousSubmission(BaseModel):
+    id: int
     timestamp: str
-    png_base64: str
+    """None unless images were included, else the image can be fetched from /submissions/{id}/image.png"""
+    png_base64: str | None
     label: int
     predictions: List[ApiDigitClassification]
 
     @classmethod
-    def from_db_model(cls, db_model: DbSubmission) -> Self:
+    def from_db_model(cls, db_model: DbSubmission, include_image: bool = True) -> Self:
         return cls(
+            id=db_model.id,
             timestamp=db_model.timestamp.isoformat(),
-            png_base64=png_bytes_to_base64(db_model.png_bytes),
+            png_base64=png_bytes_to_base64(submission_png_bytes(db_model)) if include_image else None,
             label=db_model.label,
             predictions=[ApiDigitClassification.from_db_model(x) for x in db_model.predictions],
         )
+
+class ApiSubmissionsPage(BaseModel):
+    submissions: List[ApiPreviousSubmission]
+    """Pass as the cursor to get the next page, or None if this is the last page"""
+    next_cursor: str | None
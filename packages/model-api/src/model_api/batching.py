@@ -0,0 +1,182 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Generic, List, TypeVar
+from .executor import OverloadedError
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+@dataclass
+class BatchingMetrics:
+    batch_count: int = 0
+    item_count: int = 0
+    """Number of batches processed, keyed by batch size"""
+    batch_size_histogram: dict[int, int] = field(default_factory=dict)
+    total_queue_wait_seconds: float = 0.0
+    max_queue_wait_seconds: float = 0.0
+    """Number of items rejected because the queue was full"""
+    rejected_count: int = 0
+
+    def record_batch(self, queue_waits: List[float]):
+        batch_size = len(queue_waits)
+        self.batch_count += 1
+        self.item_count += batch_size
+        self.batch_size_histogram[batch_size] = self.batch_size_histogram.get(batch_size, 0) + 1
+        self.total_queue_wait_seconds += sum(queue_waits)
+        self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, max(queue_waits))
+
+    def summary(self) -> dict:
+        return {
+            "batch_count": self.batch_count,
+            "item_count": self.item_count,
+            "mean_batch_size": self.item_count / self.batch_count if self.batch_count > 0 else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_size_histogram.items())),
+            "mean_queue_wait_ms": 1000 * self.total_queue_wait_seconds / self.item_count if self.item_count > 0 else 0.0,
+            "max_queue_wait_ms": 1000 * self.max_queue_wait_seconds,
+            "rejected_count": self.rejected_count,
+        }
+
+@dataclass
+class _PendingItem(Generic[T]):
+    item: T
+    future: asyncio.Future
+    enqueued_at: float
+
+class MicroBatchScheduler(Generic[T, R]):
+    """
+    Collects items submitted within max_wait_seconds of the first item of a batch
+    (up to max_batch_size items), and hands them to process_batch together.
+
+    process_batch must return one result per item, in the same order.
+    At most max_concurrent_batches are processed at once; whilst they run, new items
+    keep queueing (so form larger batches), up to max_queue_size items, after which
+    submit raises an OverloadedError.
+    If given, observe_queue_wait is called with how long each item waited before its batch was processed.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[T]], Awaitable[List[R]]],
+        max_batch_size: int,
+        max_wait_seconds: float,
+        max_concurrent_batches: int = 1,
+        max_queue_size: int = 0,
+        observe_queue_wait: Callable[[float], None] | None = None,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        if max_concurrent_batches < 1:
+            raise ValueError(f"max_concurrent_batches must be at least 1, got {max_concurrent_batches}")
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_concurrent_batches = max_concurrent_batches
+        self.max_queue_size = max_queue_size
+        self.observe_queue_wait = observe_queue_wait
+        self.metrics = BatchingMetrics()
+        self._loop = None
+        self._queue = None
+        self._batch_slots = None
+        self._in_flight = set()
+        self._worker = None
+
+    async def submit(self, item: T) -> R:
+        loop = asyncio.get_running_loop()
+        self._ensure_worker(loop)
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait(_PendingItem(item=item, future=future, enqueued_at=loop.time()))
+        except asyncio.QueueFull as e:
+            self.metrics.rejected_count += 1
+            raise OverloadedError("Too many predictions are already queued") from e
+        return await future
+
+    def _ensure_worker(self, loop: asyncio.AbstractEventLoop):
+        # The queue and worker are bound to the event loop they were created on
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._in_flight = set()
+            self._worker = None
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._batch_slots.acquire()
+            batch = []
+            try:
+                await self._collect_batch(batch)
+            except asyncio.CancelledError:
+                self._fail_all(batch)
+                raise
+            task = self._loop.create_task(self._process(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._on_batch_done)
+
+    async def _collect_batch(self, batch: List[_PendingItem[T]]):
+        first = await self._queue.get()
+        batch.append(first)
+        deadline = first.enqueued_at + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                # Still take anything which has already arrived
+                if self._queue.empty():
+                    break
+                batch.append(self._queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    @staticmethod
+    def _fail_all(batch: List[_PendingItem[T]]):
+        for pending in batch:
+            if not pending.future.done():
+                pending.future.set_exception(RuntimeError("The batch scheduler was stopped"))
+
+    def _on_batch_done(self, task: asyncio.Task):
+        self._in_flight.discard(task)
+        self._batch_slots.release()
+
+    async def _process(self, batch: List[_PendingItem[T]]):
+        started_at = self._loop.time()
+        queue_waits = [started_at - pending.enqueued_at for pending in batch]
+        self.metrics.record_batch(queue_waits)
+        if self.observe_queue_wait is not None:
+            for queue_wait in queue_waits:
+                self.observe_queue_wait(queue_wait)
+        try:
+            results = await self.process_batch([pending.item for pending in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Expected {len(batch)} results from the batch, got {len(results)}")
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        else:
+            for (pending, result) in zip(batch, results):
+                if not pending.future.done():
+                    pending.future.set_result(result)
+
+    async def stop(self):
+        """Stops the worker once in-flight batches have completed, failing anything still queued"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        if self._queue is not None:
+            remaining = []
+            while not self._queue.empty():
+                remaining.append(self._queue.get_nowait())
+            self._fail_all(remaining)
+        self._loop = None
+        self._queue = None
@@ -0,0 +1,33 @@
+"""
+Runs the benchmark suite: the microbenchmarks, then the in-process load test, on CPU with the in-memory store.
+Save the results as a baseline with --save-baseline, and check a later run for regressions with --compare.
+
+Run with: uv run --package model-api python -m model_api.benchmarks --compare baseline.json
+"""
+import argparse
+import asyncio
+
+from .baseline import add_baseline_arguments, handle_baseline
+from .load import print_result, run_load, use_in_memory_store
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations of each microbenchmark")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the load test for")
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_in_memory_store()
+    from .micro import run_microbenchmarks
+    results = run_microbenchmarks(args.iterations)
+    for (metric, value) in results.items():
+        print(f"{metric:<48} {value:>10.1f}")
+
+    load_result = asyncio.run(run_load("recognize-digit", args.concurrency, args.duration, warm_up_seconds=2.0, distinct_digits=True))
+    print_result("recognize-digit", load_result)
+    results |= load_result.metrics()
+    raise SystemExit(handle_baseline(args, results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Saving benchmark results as a baseline, and flagging regressions against it.
+
+Results are a flat dict of metric names to values. Metrics ending in _per_second are better when higher,
+and every other metric (times, memory) is better when lower.
+"""
+import argparse
+import json
+from pathlib import Path
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_second")
+
+def find_regressions(baseline: dict[str, float], results: dict[str, float], tolerance: float) -> list[str]:
+    """Describes each metric which is worse than the baseline by more than tolerance (a fraction of the baseline)"""
+    regressions = []
+    for (metric, value) in results.items():
+        baseline_value = baseline.get(metric)
+        if baseline_value is None:
+            continue
+        # Relative to the baseline, unless it was zero (e.g. no errors)
+        change = (value - baseline_value) / abs(baseline_value) if baseline_value != 0 else value
+        if higher_is_better(metric):
+            change = -change
+        if change > tolerance:
+            regressions.append(f"{metric}: {baseline_value:.4g} -> {value:.4g} ({change:+.1%} worse)")
+    return regressions
+
+def add_baseline_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--save-baseline", metavar="PATH", help="Save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results against a saved baseline, exiting with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="How much worse than the baseline (as a fraction) counts as a regression")
+
+def handle_baseline(args: argparse.Namespace, results: dict[str, float]) -> int:
+    """Saves and/or compares the results as requested by the arguments, returning the exit code"""
+    exit_code = 0
+    if args.compare is not None:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = find_regressions(baseline, results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.compare}, beyond a tolerance of {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit_code = 1
+        else:
+            print(f"No regressions against {args.compare}, within a tolerance of {args.tolerance:.0%}")
+    if args.save_baseline is not None:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2, sort_keys=True))
+        print(f"Saved the results as a baseline to {args.save_baseline}")
+    return exit_code
@@ -0,0 +1,97 @@
+"""
+Reports the cascade's trade-off between accuracy and compute: for each confidence threshold, the fraction of digits
+escalated to the second model (with test-time augmentation), the accuracy, and the CPU time per digit,
+against running each model on every digit, or both for the ensemble.
+
+The CPU time per digit of each stage is measured on batches of --batch-size digits, and a threshold's is the first
+model's plus the escalated fraction of the second's, which the run of the configured CASCADE_THRESHOLD checks.
+
+The digits are the stored submissions (from DATABASE_URL if set), or MNIST's test set with --mnist.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.cascade
+"""
+import argparse
+import time
+from typing import Callable
+import numpy as np
+
+from model.digit_model import DigitModelBase
+from ..predictions import cascade, create_predictions_for_pixels, ensemble, predictors
+from .quantization import load_submissions
+
+DEFAULT_THRESHOLDS = [0.0, 0.3, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99]
+
+def in_batches(fn: Callable[[np.ndarray], np.ndarray], pixels: np.ndarray, batch_size: int) -> tuple[np.ndarray, float]:
+    """Runs fn over the digits a batch at a time, returning its concatenated results, and the CPU time per digit in ms"""
+    fn(pixels[:batch_size]) # Warm up
+    started_at = time.process_time()
+    results = np.concatenate([fn(pixels[start:start + batch_size]) for start in range(0, len(pixels), batch_size)])
+    return (results, (time.process_time() - started_at) / len(pixels) * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mnist", metavar="DATA_DIR", help="Evaluate on MNIST's test set, downloaded to DATA_DIR")
+    parser.add_argument("--limit", type=int, default=10_000, help="How many of the most recent submissions to evaluate on")
+    parser.add_argument("--batch-size", type=int, default=32, help="Digits per forward pass, e.g. BATCH_MAX_SIZE")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=DEFAULT_THRESHOLDS)
+    args = parser.parse_args()
+
+    if args.mnist is not None:
+        from model.datasets import load_mnist_pixels
+        (pixels, labels) = load_mnist_pixels(args.mnist, train=False)
+        pixels = np.asarray(pixels[:args.limit])
+        labels = np.asarray(labels[:args.limit])
+    else:
+        (pixels, labels) = load_submissions(args.limit)
+
+    first = predictors[cascade.first]
+    second = predictors[cascade.second]
+    (first_probabilities, first_ms) = in_batches(lambda x: first.probabilities(DigitModelBase.pixels_tensor(x, first.scale)), pixels, args.batch_size)
+    (second_probabilities, second_ms) = in_batches(lambda x: second.probabilities(DigitModelBase.pixels_tensor(x, second.scale)), pixels, args.batch_size)
+    (augmented_probabilities, augmented_ms) = in_batches(
+        lambda x: second.augmented_probabilities(DigitModelBase.pixels_tensor(x, second.scale), cascade.augmentations), pixels, args.batch_size,
+    )
+    first_confidences = first_probabilities.max(axis=1)
+    first_correct = first_probabilities.argmax(axis=1) == labels
+    augmented_correct = augmented_probabilities.argmax(axis=1) == labels
+    second_accuracy = (second_probabilities.argmax(axis=1) == labels).mean()
+    ensemble_probabilities = sum(
+        probabilities * ensemble.weights.get(model_name, 0.0)
+        for (model_name, probabilities) in [(cascade.first, first_probabilities), (cascade.second, second_probabilities)]
+    )
+
+    print(f"Evaluating on {len(pixels)} digits, in batches of {args.batch_size}, with {len(cascade.augmentations)} test-time augmentations")
+    print(f"{'':<36} {'escalated':>10} {'accuracy':>9} {'CPU/digit (ms)':>15}")
+    print(f"{cascade.first + ' only':<36} {'':>10} {first_correct.mean():>9.2%} {first_ms:>15.3f}")
+    print(f"{cascade.second + ' only':<36} {'':>10} {second_accuracy:>9.2%} {second_ms:>15.3f}")
+    print(f"{cascade.second + ' with augmentation':<36} {'':>10} {augmented_correct.mean():>9.2%} {augmented_ms:>15.3f}")
+    if set(ensemble.weights) == {cascade.first, cascade.second}:
+        print(f"{'ensemble':<36} {'':>10} {(ensemble_probabilities.argmax(axis=1) == labels).mean():>9.2%} {first_ms + second_ms:>15.3f}")
+    recommended = None
+    for threshold in sorted(args.thresholds):
+        escalated = first_confidences < threshold
+        accuracy = np.where(escalated, augmented_correct, first_correct).mean()
+        cpu_ms = first_ms + escalated.mean() * augmented_ms
+        print(f"{f'cascade at threshold {threshold:g}':<36} {escalated.mean():>10.2%} {accuracy:>9.2%} {cpu_ms:>15.3f}")
+        if recommended is None and accuracy >= second_accuracy:
+            recommended = (threshold, cpu_ms)
+
+    # The whole cascade as the api runs it, with the configured threshold
+    started_at = time.process_time()
+    predicted_digits = np.array([
+        predictions[0].predicted_digit
+        for start in range(0, len(pixels), args.batch_size)
+        for predictions in create_predictions_for_pixels(pixels[start:start + args.batch_size], (cascade.model_name,))
+    ])
+    measured_ms = (time.process_time() - started_at) / len(pixels) * 1000
+    print(
+        f"{f'cascade at CASCADE_THRESHOLD={cascade.threshold:g}, measured':<36} {(first_confidences < cascade.threshold).mean():>10.2%}"
+        f" {(predicted_digits == labels).mean():>9.2%} {measured_ms:>15.3f}"
+    )
+    if recommended is None:
+        print(f"No threshold was as accurate as {cascade.second} alone")
+    else:
+        print(f"The lowest threshold as accurate as {cascade.second} alone is {recommended[0]:g}, using {recommended[1] / second_ms:.0%} of its CPU time")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Drives the api in-process (through its ASGI interface, so without a network or a server) with a fixed number of
+concurrent clients, and reports throughput, the latency distribution, and the CPU and memory used.
+
+It runs offline with the in-memory submission store, even if DATABASE_URL is set.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.load --concurrency 16 --duration 10
+"""
+import argparse
+import asyncio
+import base64
+import os
+import resource
+import time
+from dataclasses import dataclass, field
+import numpy as np
+
+from .baseline import add_baseline_arguments, handle_baseline
+
+ENDPOINTS = ["recognize-digit", "submit-digit"]
+# Upper bounds of the latency histogram's buckets
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float("inf")]
+
+@dataclass
+class LoadResult:
+    concurrency: int
+    duration_seconds: float
+    latencies_ms: list[float] = field(default_factory=list)
+    """Number of responses, keyed by status code"""
+    status_counts: dict[int, int] = field(default_factory=dict)
+    cpu_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+
+    def percentile_ms(self, percentile: float) -> float:
+        return float(np.percentile(self.latencies_ms, percentile)) if self.latencies_ms else 0.0
+
+    def histogram(self) -> dict[str, int]:
+        counts = np.histogram(self.latencies_ms, bins=[0, *HISTOGRAM_BUCKETS_MS])[0]
+        labels = [f"<= {bucket:g}ms" for bucket in HISTOGRAM_BUCKETS_MS[:-1]] + [f"> {HISTOGRAM_BUCKETS_MS[-2]:g}ms"]
+        return {label: int(count) for (label, count) in zip(labels, counts)}
+
+    def metrics(self) -> dict[str, float]:
+        """The results as flat metrics, to compare against a baseline"""
+        ok_count = self.status_counts.get(200, 0)
+        return {
+            "load.requests_per_second": ok_count / self.duration_seconds,
+            "load.p50_ms": self.percentile_ms(50),
+            "load.p90_ms": self.percentile_ms(90),
+            "load.p99_ms": self.percentile_ms(99),
+            "load.error_fraction": 1 - ok_count / max(1, sum(self.status_counts.values())),
+            "load.cpu_cores_used": self.cpu_seconds / self.duration_seconds,
+            "load.peak_rss_mb": self.peak_rss_mb,
+        }
+
+def request_for(endpoint: str, pixels: np.ndarray) -> dict:
+    if endpoint == "recognize-digit":
+        return {
+            "method": "POST",
+            "url": "/recognize-digit",
+            "content": pixels.tobytes(),
+            "headers": {"Content-Type": "application/octet-stream"},
+        }
+    return {
+        "method": "POST",
+        "url": "/submit-digit",
+        "json": {"digit": {"pixels_base64": base64.b64encode(pixels.tobytes()).decode("ascii")}, "label": 0},
+    }
+
+async def wait_until_ready(client, timeout_seconds: float = 120.0):
+    deadline = time.monotonic() + timeout_seconds
+    while (await client.get("/ready")).status_code != 200:
+        if time.monotonic() > deadline:
+            raise TimeoutError("The models weren't ready in time")
+        await asyncio.sleep(0.1)
+
+async def run_load(endpoint: str, concurrency: int, duration_seconds: float, warm_up_seconds: float, distinct_digits: bool) -> LoadResult:
+    """Runs concurrency clients, each sending its next request as soon as the previous one completes"""
+    import httpx
+    from ..main import app
+    from ..model_registry import peak_rss_mb
+
+    result = LoadResult(concurrency=concurrency, duration_seconds=duration_seconds)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            await wait_until_ready(client)
+
+            async def client_loop(client_id: int, until: float, record: bool):
+                rng = np.random.default_rng(client_id)
+                fixed_pixels = np.full((28, 28), 255, dtype=np.uint8)
+                while time.perf_counter() < until:
+                    # Random digits miss the prediction cache, as most real digits would
+                    pixels = rng.integers(0, 256, size=(28, 28), dtype=np.uint8) if distinct_digits else fixed_pixels
+                    started_at = time.perf_counter()
+                    response = await client.request(**request_for(endpoint, pixels))
+                    if record:
+                        result.latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                        result.status_counts[response.status_code] = result.status_counts.get(response.status_code, 0) + 1
+
+            warm_up_until = time.perf_counter() + warm_up_seconds
+            await asyncio.gather(*[client_loop(i, warm_up_until, record=False) for i in range(concurrency)])
+
+            cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+            started_at = time.perf_counter()
+            await asyncio.gather(*[client_loop(i, started_at + duration_seconds, record=True) for i in range(concurrency)])
+            result.duration_seconds = time.perf_counter() - started_at
+            cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    result.cpu_seconds = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    result.peak_rss_mb = peak_rss_mb()
+    return result
+
+def print_result(endpoint: str, result: LoadResult):
+    metrics = result.metrics()
+    print(f"{endpoint} at concurrency {result.concurrency}, for {result.duration_seconds:.1f}s:")
+    print(f"  {metrics['load.requests_per_second']:,.1f} requests/s, status codes {dict(sorted(result.status_counts.items()))}")
+    print(f"  latency p50 {metrics['load.p50_ms']:.2f}ms, p90 {metrics['load.p90_ms']:.2f}ms, p99 {metrics['load.p99_ms']:.2f}ms, max {max(result.latencies_ms, default=0):.2f}ms")
+    print(f"  CPU {metrics['load.cpu_cores_used']:.2f} cores and peak RSS {result.peak_rss_mb:.0f}MB, of the api's processes")
+    print("  latency histogram:")
+    for (bucket, count) in result.histogram().items():
+        print(f"    {bucket:>10} {count:>8}")
+
+def use_in_memory_store():
+    # Must happen before the api is imported
+    os.environ["DATABASE_URL"] = ""
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="recognize-digit")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to measure for")
+    parser.add_argument("--warm-up", type=float, default=2.0, help="Seconds to run for before measuring")
+    parser.add_argument("--repeat-digit", action="store_true", help="Send the same digit every time, so most predictions are cached")
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_in_memory_store()
+    result = asyncio.run(run_load(args.endpoint, args.concurrency, args.duration, args.warm_up, distinct_digits=not args.repeat_digit))
+    print_result(args.endpoint, result)
+    raise SystemExit(handle_baseline(args, result.metrics()))
+
+if __name__ == "__main__":
+    main()
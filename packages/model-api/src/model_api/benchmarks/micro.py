@@ -0,0 +1,65 @@
+"""
+Microbenchmarks of the per-request hot paths: running a model on a single image, parsing a JSON digit,
+and encoding a submission's PNG.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.micro
+"""
+import argparse
+import json
+import time
+from typing import Callable
+import numpy as np
+
+from .baseline import add_baseline_arguments, handle_baseline
+from .load import use_in_memory_store
+
+def median_time_per_call_us(fn: Callable[[], object], iterations: int, repeats: int = 5) -> float:
+    """The median over repeats of the mean time per call, which is less noisy than a single mean"""
+    fn() # Warm up
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        samples.append((time.perf_counter() - start) / iterations * 1_000_000)
+    return float(np.median(samples))
+
+def run_microbenchmarks(iterations: int) -> dict[str, float]:
+    from PIL import Image
+    from ..api_models import ApiDigitData
+    from ..wire_formats import encode_deflated_pixels, encode_png_pixels
+    from ..predictions import predictors
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, size=(28, 28), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    json_body = json.dumps({"pixels": pixels.tolist()}).encode()
+
+    results = {}
+    for predictor in predictors.values():
+        model = predictor.model
+        results[f"micro.probabilities.{predictor.model_name}_us"] = median_time_per_call_us(
+            lambda: model.probabilities(image, predictor.temperature, predictor.scale), iterations,
+        )
+    results["micro.to_prediction_model_us"] = median_time_per_call_us(
+        lambda: ApiDigitData.model_validate_json(json_body).to_prediction_model(), iterations,
+    )
+    # Submissions are stored deflated, and only encoded as PNGs when their images are requested
+    results["micro.encode_deflated_pixels_us"] = median_time_per_call_us(lambda: encode_deflated_pixels(pixels), iterations)
+    results["micro.encode_png_pixels_us"] = median_time_per_call_us(lambda: encode_png_pixels(pixels), iterations)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_in_memory_store()
+    results = run_microbenchmarks(args.iterations)
+    for (metric, value) in results.items():
+        print(f"{metric:<48} {value:>10.1f}")
+    raise SystemExit(handle_baseline(args, results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares the int8 quantized models against their float32 originals: accuracy on labelled digits,
+how often they agree with the float32 prediction, latency at batch sizes 1 and 64, and memory.
+
+The digits are the stored submissions (from DATABASE_URL if set), or MNIST's test set with --mnist.
+Export the calibrated int8 models first with model-quantize, else only their classifiers are quantized.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.quantization
+"""
+import argparse
+import io
+import numpy as np
+import torch
+
+from .. import wire_formats
+from ..predictions import predictors, model_registry
+from ..submission_store import submission_store
+from .wire_formats import time_per_call_us
+
+def load_submissions(limit: int) -> tuple[np.ndarray, np.ndarray]:
+    submissions = submission_store.get_recent_submissions(limit)
+    if len(submissions) == 0:
+        raise SystemExit("There are no stored submissions to compare on, try --mnist instead")
+    pixels = np.concatenate([wire_formats.decode_stored_pixels(x.deflated_pixels, x.png_bytes) for x in submissions])
+    labels = np.array([x.label for x in submissions], dtype=np.uint8)
+    return (pixels, labels)
+
+def serialized_size_kb(network) -> float:
+    buffer = io.BytesIO()
+    if isinstance(network, torch.jit.ScriptModule):
+        # Frozen modules inline their weights, so have no state dict
+        torch.jit.save(network, buffer)
+    else:
+        torch.save(network.state_dict(), buffer)
+    return len(buffer.getvalue()) / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mnist", metavar="DATA_DIR", help="Compare on MNIST's test set, downloaded to DATA_DIR")
+    parser.add_argument("--limit", type=int, default=10_000, help="How many of the most recent submissions to compare on")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.mnist is not None:
+        from model.datasets import load_mnist_pixels
+        (pixels, labels) = load_mnist_pixels(args.mnist, train=False)
+        pixels = np.asarray(pixels[:args.limit])
+        labels = np.asarray(labels[:args.limit])
+    else:
+        (pixels, labels) = load_submissions(args.limit)
+    latency_batch = pixels[:64] if len(pixels) >= 64 else np.resize(pixels, (64, *wire_formats.DIGIT_SHAPE))
+
+    predicted_digits = {}
+    for (model_name, predictor) in predictors.items():
+        predicted_digits[model_name] = np.array([x.predicted_digit for x in predictor.predict_pixels(pixels)])
+
+    print(f"Comparing on {len(pixels)} digits")
+    print(f"{'model':<12} {'version':<28} {'accuracy':>9} {'agreement':>10} {'batch 1 (us)':>13} {'batch 64 (us)':>14} {'size (KB)':>10} {'peak RSS (MB)':>14}")
+    for (model_name, predictor) in predictors.items():
+        float_model_name = model_name.removesuffix("-int8")
+        accuracy = (predicted_digits[model_name] == labels).mean()
+        agreement = (predicted_digits[model_name] == predicted_digits[float_model_name]).mean()
+        batch_1_us = time_per_call_us(lambda: predictor.predict_pixels(pixels[:1]), args.iterations)
+        batch_64_us = time_per_call_us(lambda: predictor.predict_pixels(latency_batch), max(1, args.iterations // 10))
+        size_kb = serialized_size_kb(predictor.model.network)
+        # Models are loaded in order, so this is the growth in peak memory as each is loaded
+        peak_rss_mb = model_registry.status()["models"][model_name]["peak_rss_mb_after_load"]
+        print(
+            f"{model_name:<12} {model_registry.weights_version(model_name):<28} {accuracy:>9.2%} {agreement:>10.2%}"
+            f" {batch_1_us:>13.1f} {batch_64_us:>14.1f} {size_kb:>10.1f} {peak_rss_mb:>14.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
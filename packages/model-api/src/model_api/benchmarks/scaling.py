@@ -0,0 +1,192 @@
+"""
+Measures how throughput scales with the number of web workers on one host: for each worker count, starts
+model_api.serve as a server, load tests it over HTTP, and reports throughput, latency, and the memory
+of each process, showing how much of the models' memory the forked workers share with the parent.
+
+The load is generated from several client processes, so that the client isn't the bottleneck,
+though it still competes with the server for the host's cores. The servers use the in-memory submission store.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.scaling --workers 1 2 4 --duration 10
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+from .baseline import add_baseline_arguments, handle_baseline
+from .load import ENDPOINTS, LoadResult, print_result, request_for
+
+def process_memory_mb(pid: int) -> dict[str, float]:
+    """
+    The process's resident memory (including pages shared with other processes), its proportional share
+    of the shared pages, and the memory only it uses, from /proc (so only on Linux)
+    """
+    fields = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        (name, value, *_) = line.split()
+        fields[name.rstrip(":")] = int(value) / 1024
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "uss": fields["Private_Clean"] + fields["Private_Dirty"],
+    }
+
+def process_cpu_seconds(pid: int) -> float:
+    # The user and system time fields, after the command (which is in brackets, and may contain spaces)
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def process_peak_rss_mb(pid: int) -> float:
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+def server_pids(parent_pid: int) -> list[int]:
+    """The server's parent process, then its workers (a single worker runs in the parent)"""
+    try:
+        children = Path(f"/proc/{parent_pid}/task/{parent_pid}/children").read_text().split()
+    except OSError:
+        children = []
+    return [parent_pid, *sorted(int(pid) for pid in children)]
+
+def process_count(workers: int) -> int:
+    return workers + 1 if workers > 1 else 1
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    environment = os.environ | {"DATABASE_URL": "", "WEB_WORKERS": str(workers)}
+    return subprocess.Popen(
+        [sys.executable, "-m", "model_api.serve", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=environment,
+    )
+
+def wait_until_ready(server: subprocess.Popen, base_url: str, workers: int, timeout_seconds: float = 120.0):
+    import httpx
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode}")
+        try:
+            if httpx.get(f"{base_url}/ready").status_code == 200 and len(server_pids(server.pid)) >= process_count(workers):
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError("The server wasn't ready in time")
+        time.sleep(0.2)
+
+def stop_server(server: subprocess.Popen):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+async def _client_process_load(base_url: str, endpoint: str, concurrency: int, first_client_id: int, duration_seconds: float, warm_up_seconds: float) -> tuple[list[float], dict[int, int]]:
+    import httpx
+    latencies_ms = []
+    status_counts = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+
+        async def client_loop(client_id: int, until: float, record: bool):
+            rng = np.random.default_rng(client_id)
+            while time.perf_counter() < until:
+                # Random digits miss the prediction cache, as most real digits would
+                pixels = rng.integers(0, 256, size=(28, 28), dtype=np.uint8)
+                started_at = time.perf_counter()
+                response = await client.request(**request_for(endpoint, pixels))
+                if record:
+                    latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                    status_counts[response.status_code] = status_counts.get(response.status_code, 0) + 1
+
+        client_ids = range(first_client_id, first_client_id + concurrency)
+        warm_up_until = time.perf_counter() + warm_up_seconds
+        await asyncio.gather(*[client_loop(i, warm_up_until, record=False) for i in client_ids])
+        until = time.perf_counter() + duration_seconds
+        await asyncio.gather(*[client_loop(i, until, record=True) for i in client_ids])
+    return (latencies_ms, status_counts)
+
+def client_process_load(*args) -> tuple[list[float], dict[int, int]]:
+    """Runs in each client process"""
+    return asyncio.run(_client_process_load(*args))
+
+def run_http_load(base_url: str, endpoint: str, concurrency: int, client_processes: int, duration_seconds: float, warm_up_seconds: float) -> LoadResult:
+    """Runs concurrency clients (split between client_processes), each sending its next request as soon as the previous one completes"""
+    result = LoadResult(concurrency=concurrency, duration_seconds=duration_seconds)
+    client_processes = max(1, min(client_processes, concurrency))
+    concurrency_per_process = [len(clients) for clients in np.array_split(range(concurrency), client_processes)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=client_processes) as client_pool:
+        futures = [
+            client_pool.submit(client_process_load, base_url, endpoint, process_concurrency, sum(concurrency_per_process[:i]), duration_seconds, warm_up_seconds)
+            for (i, process_concurrency) in enumerate(concurrency_per_process)
+        ]
+        for future in futures:
+            (latencies_ms, status_counts) = future.result()
+            result.latencies_ms.extend(latencies_ms)
+            for (status_code, count) in status_counts.items():
+                result.status_counts[status_code] = result.status_counts.get(status_code, 0) + count
+    return result
+
+def measure_scaling(worker_counts: list[int], port: int, endpoint: str, concurrency: int, client_processes: int, duration_seconds: float, warm_up_seconds: float) -> dict[str, float]:
+    results = {}
+    base_url = f"http://127.0.0.1:{port}"
+    for workers in worker_counts:
+        server = start_server(workers, port)
+        try:
+            wait_until_ready(server, base_url, workers)
+            pids = server_pids(server.pid)
+            cpu_seconds_before = sum(process_cpu_seconds(pid) for pid in pids)
+            result = run_http_load(base_url, endpoint, concurrency, client_processes, duration_seconds, warm_up_seconds)
+            # Includes the warm up, which the load's duration doesn't
+            result.cpu_seconds = (sum(process_cpu_seconds(pid) for pid in pids) - cpu_seconds_before) * duration_seconds / (duration_seconds + warm_up_seconds)
+            result.peak_rss_mb = sum(process_peak_rss_mb(pid) for pid in pids)
+            memory = [process_memory_mb(pid) for pid in pids]
+        finally:
+            stop_server(server)
+
+        print_result(f"{endpoint} with {workers} workers", result)
+        print("  memory (MB): RSS counts shared pages in full, PSS counts a fair share of them, USS only counts private pages")
+        roles = ["parent", *["worker"] * workers] if workers > 1 else ["worker"]
+        for (role, pid, process_memory) in zip(roles, pids, memory):
+            print(f"    {role:<6} {pid:>8} RSS {process_memory['rss']:>7.0f} PSS {process_memory['pss']:>7.0f} USS {process_memory['uss']:>7.0f}")
+        total_pss_mb = sum(process_memory["pss"] for process_memory in memory)
+        print(f"    total PSS {total_pss_mb:.0f}MB, against {sum(process_memory['rss'] for process_memory in memory):.0f}MB of RSS")
+
+        metrics = result.metrics()
+        results[f"scaling.workers_{workers}.requests_per_second"] = metrics["load.requests_per_second"]
+        results[f"scaling.workers_{workers}.p50_ms"] = metrics["load.p50_ms"]
+        results[f"scaling.workers_{workers}.p99_ms"] = metrics["load.p99_ms"]
+        results[f"scaling.workers_{workers}.total_pss_mb"] = total_pss_mb
+
+    baseline_throughput = results[f"scaling.workers_{worker_counts[0]}.requests_per_second"]
+    print(f"Throughput relative to {worker_counts[0]} worker(s):")
+    for workers in worker_counts:
+        throughput = results[f"scaling.workers_{workers}.requests_per_second"]
+        print(f"  {workers:>3} workers {throughput:>10,.1f} requests/s {throughput / max(baseline_throughput, 1e-9):>6.2f}x")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="The worker counts to measure")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="recognize-digit")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to measure each worker count for")
+    parser.add_argument("--warm-up", type=float, default=2.0, help="Seconds to run for before measuring")
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    results = measure_scaling(args.workers, args.port, args.endpoint, args.concurrency, args.client_processes, args.duration, args.warm_up)
+    raise SystemExit(handle_baseline(args, results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares the time spent encoding and parsing each digit wire format against the time spent on inference.
+
+Run with: uv run --package model-api python -m model_api.benchmarks.wire_formats
+"""
+import argparse
+import json
+import time
+from typing import Callable
+import numpy as np
+
+from .. import wire_formats
+from ..api_models import ApiDigitData
+from ..predictions import create_predictions_for_pixels
+
+def time_per_call_us(fn: Callable[[], object], iterations: int) -> float:
+    fn() # Warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, size=(28, 28), dtype=np.uint8)
+
+    formats = {
+        "json": (
+            lambda: json.dumps({"pixels": [[pixel.item() for pixel in row] for row in pixels]}).encode(),
+            lambda body: ApiDigitData.model_validate_json(body).to_prediction_model().pixels,
+        ),
+        "json-base64": (
+            lambda: json.dumps({"pixels_base64": wire_formats.encode_base64_pixels(pixels)}).encode(),
+            lambda body: ApiDigitData.model_validate_json(body).to_prediction_model().pixels,
+        ),
+        "octet-stream": (
+            lambda: wire_formats.encode_raw_pixels(pixels),
+            lambda body: wire_formats.decode_raw_pixels(body)[0],
+        ),
+        "png": (
+            lambda: wire_formats.encode_png_pixels(pixels),
+            lambda body: wire_formats.decode_png_pixels(body)[0],
+        ),
+        # Only used for storage, where real digits (unlike these random pixels) compress well
+        "deflated": (
+            lambda: wire_formats.encode_deflated_pixels(pixels),
+            lambda body: wire_formats.decode_deflated_pixels(body)[0],
+        ),
+    }
+
+    inference_us = time_per_call_us(lambda: create_predictions_for_pixels(pixels[np.newaxis]), max(1, args.iterations // 10))
+
+    print(f"{'format':<14} {'bytes':>7} {'encode (us)':>12} {'parse (us)':>11} {'infer (us)':>11} {'parse share':>12}")
+    for (name, (encode, parse)) in formats.items():
+        body = encode()
+        if not np.array_equal(parse(body), pixels):
+            raise RuntimeError(f"{name} did not round trip")
+        encode_us = time_per_call_us(encode, args.iterations)
+        parse_us = time_per_call_us(lambda: parse(body), args.iterations)
+        parse_share = parse_us / (parse_us + inference_us)
+        print(f"{name:<14} {len(body):>7} {encode_us:>12.1f} {parse_us:>11.1f} {inference_us:>11.1f} {parse_share:>12.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import os
+
+def load_env_int(name: str, default: int) -> int:
+    """Load integer environment variable, or the default if it isn't set"""
+    loaded = os.getenv(name)
+    if loaded is None or loaded == "":
+        return default
+    try:
+        return int(loaded)
+    except ValueError as e:
+        raise ValueError(f"Environment variable {name} must be an integer, got {loaded!r}") from e
+
+def load_env_float(name: str, default: float) -> float:
+    """Load float environment variable, or the default if it isn't set"""
+    loaded = os.getenv(name)
+    if loaded is None or loaded == "":
+        return default
+    try:
+        return float(loaded)
+    except ValueError as e:
+        raise ValueError(f"Environment variable {name} must be a number, got {loaded!r}") from e
+
+def load_env_string_or_default(name: str, default: str) -> str:
+    """Load string environment variable, or the default if it isn't set"""
+    loaded = os.getenv(name)
+    if loaded is None or loaded == "":
+        return default
+    return loaded
+
+def load_env_bool(name: str, default: bool) -> bool:
+    """Load boolean environment variable (true/false, yes/no, on/off or 1/0), or the default if it isn't set"""
+    loaded = os.getenv(name)
+    if loaded is None or loaded == "":
+        return default
+    if loaded.strip().lower() in ("true", "yes", "on", "1"):
+        return True
+    if loaded.strip().lower() in ("false", "no", "off", "0"):
+        return False
+    raise ValueError(f"Environment variable {name} must be true or false, got {loaded!r}")
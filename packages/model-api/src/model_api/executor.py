@@ -0,0 +1,86 @@
+import asyncio
+import concurrent.futures
+from typing import Callable, TypeVar
+
+R = TypeVar("R")
+
+class OverloadedError(Exception):
+    """Raised when work is rejected because too much is already queued, and is returned as a 503"""
+
+class BoundedExecutor:
+    """
+    Runs blocking calls on a pool of worker threads (or processes) so they don't stall the event loop.
+
+    At most max_workers calls run at once, and at most max_queue_size more can wait for a worker;
+    anything beyond that is rejected immediately with an OverloadedError.
+    The pool is only created on first use.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int,
+        max_queue_size: int,
+        use_processes: bool = False,
+        initializer: Callable | None = None,
+        initargs: tuple = (),
+    ):
+        if max_workers < 1:
+            raise ValueError(f"{name}: max_workers must be at least 1, got {max_workers}")
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.use_processes = use_processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor = None
+        # Only touched from the event loop thread, so needs no lock
+        self._pending = 0
+        self.rejected_count = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.use_processes:
+                import multiprocessing
+                # Forking a process which has already started torch's thread pools can deadlock
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer,
+                    initargs=self.initargs,
+                )
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=self.name,
+                    initializer=self.initializer,
+                    initargs=self.initargs,
+                )
+        return self._executor
+
+    async def run(self, fn: Callable[..., R], *args) -> R:
+        if self._pending >= self.max_workers + self.max_queue_size:
+            self.rejected_count += 1
+            raise OverloadedError(f"{self.name}: too many requests are already queued")
+        self._pending += 1
+        try:
+            return await asyncio.wrap_future(self._get_executor().submit(fn, *args))
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def summary(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+            "pending": self._pending,
+            "rejected_count": self.rejected_count,
+        }
@@ -0,0 +1,36 @@
+"""
+Converts the submissions which earlier versions stored as PNG images to deflated pixels, as new submissions are stored.
+
+Each batch of submissions is converted in its own short transaction, so it can run whilst the api keeps serving,
+which reads either form meanwhile. It only converts submissions still stored as PNGs, so can be stopped and re-run.
+Postgres reuses the space the PNGs took for later rows, or VACUUM FULL dbsubmission returns it to the operating system.
+
+Run with: uv run --package model-api python -m model_api.image_migration
+"""
+import argparse
+import time
+
+# How many submissions are converted per transaction
+MIGRATION_BATCH_SIZE = 500
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE, help="How many submissions to convert per transaction")
+    args = parser.parse_args()
+
+    from .submission_store import InMemorySubmissionStore, submission_store
+    if isinstance(submission_store, InMemorySubmissionStore):
+        raise SystemExit("Set DATABASE_URL to the database to migrate: the in-memory store never holds PNGs")
+
+    started_at = time.perf_counter()
+
+    def on_batch(converted_count: int, invalid_count: int):
+        print(f"Converted {converted_count:,} submissions in {time.perf_counter() - started_at:.1f}s", flush=True)
+
+    (converted_count, invalid_count) = submission_store.convert_png_submissions(args.batch_size, on_batch)
+    print(f"Converted {converted_count:,} submissions from PNG images to deflated pixels in {time.perf_counter() - started_at:.1f}s")
+    if invalid_count > 0:
+        print(f"{invalid_count:,} submissions had an invalid PNG image, so were left as they were")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import asyncio
+import time
+from typing import Callable, List, TypeVar
+import numpy as np
+from model.cpus import available_cpu_count
+from .batching import MicroBatchScheduler
+from .config import load_env_int, load_env_float, load_env_string_or_default
+from .executor import BoundedExecutor, OverloadedError
+from .predictions import PredictionDigitData, PredictionClassification, PredictionRequest, DEFAULT_MODEL_NAMES
+from .predictions import configure_model_threads, predictors
+from .predictions import create_predictions_batch, create_predictions_for_pixels
+from .predictions import get_cached_predictions, cache_predictions, model_registry, MODEL_WATCH_INTERVAL_SECONDS
+from .instrumentation import call_and_take_metrics, metrics, stage_seconds, time_stage
+
+R = TypeVar("R")
+
+# Requests arriving within BATCH_WINDOW_MS of each other share a forward pass, up to BATCH_MAX_SIZE digits
+BATCH_MAX_SIZE = load_env_int("BATCH_MAX_SIZE", 32)
+BATCH_WINDOW_MS = load_env_float("BATCH_WINDOW_MS", 2.0)
+
+# The api may be served by WEB_WORKERS processes (see model_api.serve), each with the same inference workers.
+# Forward passes run on INFERENCE_WORKERS threads (or processes), which each run up to MODEL_PARALLELISM models
+# at once, each using INFERENCE_TORCH_THREADS intra-op threads, so that together they don't oversubscribe the available cores
+WEB_WORKERS = load_env_int("WEB_WORKERS", 1)
+INFERENCE_EXECUTOR = load_env_string_or_default("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = load_env_int("INFERENCE_WORKERS", 2)
+# By default, a worker's models split its share of the cores, or run one after another if it only has one
+INFERENCE_WORKER_CORES = max(1, available_cpu_count() // (WEB_WORKERS * INFERENCE_WORKERS))
+MODEL_PARALLELISM = load_env_int("MODEL_PARALLELISM", max(1, min(len(predictors), INFERENCE_WORKER_CORES)))
+INFERENCE_TORCH_THREADS = load_env_int("INFERENCE_TORCH_THREADS", max(1, INFERENCE_WORKER_CORES // MODEL_PARALLELISM))
+# Once this many digits are waiting to be predicted, further requests are rejected with a 503
+INFERENCE_MAX_QUEUE = load_env_int("INFERENCE_MAX_QUEUE", 256)
+
+if INFERENCE_EXECUTOR not in ("thread", "process"):
+    raise ValueError(f"INFERENCE_EXECUTOR must be thread or process, got {INFERENCE_EXECUTOR!r}")
+
+def initialize_inference_worker(torch_threads: int, model_parallelism: int, warm_up_models: bool):
+    """Runs once in each inference worker"""
+    import torch
+    # For threads, this applies to the calling thread's intra-op pool
+    torch.set_num_threads(torch_threads)
+    configure_model_threads(model_parallelism, torch_threads)
+    if warm_up_models:
+        model_registry.warm_up()
+        model_registry.watch_in_background(MODEL_WATCH_INTERVAL_SECONDS)
+
+inference_executor = BoundedExecutor(
+    name="inference",
+    max_workers=INFERENCE_WORKERS,
+    # The scheduler dispatches at most one batch per worker, so this leaves room for the bulk chunks (see BULK_MAX_CONCURRENT_CHUNKS)
+    max_queue_size=INFERENCE_WORKERS,
+    use_processes=INFERENCE_EXECUTOR == "process",
+    initializer=initialize_inference_worker,
+    # Worker processes each load their own models, so warm them up as they start
+    initargs=(INFERENCE_TORCH_THREADS, MODEL_PARALLELISM, INFERENCE_EXECUTOR == "process"),
+)
+
+async def run_inference(fn: Callable[..., R], *args) -> R:
+    """Runs fn on an inference worker, bringing back any metrics it recorded if the worker is another process"""
+    with time_stage("inference"):
+        if not inference_executor.use_processes or not metrics.enabled:
+            return await inference_executor.run(fn, *args)
+        (result, worker_metrics) = await inference_executor.run(call_and_take_metrics, fn, *args)
+    metrics.merge(worker_metrics)
+    return result
+
+async def _run_batch(batch: List[PredictionRequest]) -> List[List[PredictionClassification]]:
+    return await run_inference(create_predictions_batch, batch)
+
+def _observe_queue_wait(seconds: float):
+    stage_seconds.observe(seconds, "queue_wait")
+
+prediction_scheduler: MicroBatchScheduler[PredictionRequest, List[PredictionClassification]] = MicroBatchScheduler(
+    process_batch=_run_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_seconds=BATCH_WINDOW_MS / 1000,
+    max_concurrent_batches=INFERENCE_WORKERS,
+    max_queue_size=INFERENCE_MAX_QUEUE,
+    observe_queue_wait=_observe_queue_wait if metrics.enabled else None,
+)
+
+# Models which haven't finished this long after a request arrives are left out of its predictions, 0 waits for every model
+PREDICTION_DEADLINE_MS = load_env_float("PREDICTION_DEADLINE_MS", 0.0)
+
+async def create_predictions(
+    data: PredictionDigitData,
+    model_names: tuple[str, ...] = DEFAULT_MODEL_NAMES,
+    deadline_ms: float | None = None,
+) -> List[PredictionClassification]:
+    """
+    Returns cached predictions for the digit if there are any,
+    else queues it to be predicted alongside any other concurrent requests.
+
+    Models which haven't finished deadline_ms (default PREDICTION_DEADLINE_MS) from now are left out,
+    unless none have, in which case the first model to finish is waited for.
+    """
+    if deadline_ms is None:
+        deadline_ms = PREDICTION_DEADLINE_MS
+    # Monotonic time is system-wide, so can be compared in worker processes too
+    deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms > 0 else None
+    request = PredictionRequest(data, model_names, deadline)
+    with time_stage("cache_lookup"):
+        cached = get_cached_predictions(request)
+    if cached is not None:
+        return cached
+    predictions = await prediction_scheduler.submit(request)
+    cache_predictions(request, predictions)
+    return predictions
+
+# Bulk requests are split into chunks of this many digits, to bound the memory of each forward pass
+BULK_CHUNK_SIZE = load_env_int("BULK_CHUNK_SIZE", 1024)
+# Bulk chunks share the inference workers (and their queue) with the scheduler's batches, so at most one fewer chunks
+# than there are workers run or queue at once, leaving room for the scheduler's batches, which are never rejected by them.
+# Bulk requests wait their turn for a chunk, up to BULK_MAX_QUEUE of them, and beyond that get a 503.
+BULK_MAX_CONCURRENT_CHUNKS = max(1, INFERENCE_WORKERS - 1)
+BULK_MAX_QUEUE = load_env_int("BULK_MAX_QUEUE", 8)
+_bulk_loop = None
+_bulk_chunk_slots = None
+_bulk_waiting_count = 0
+
+def _ensure_bulk_chunk_slots(loop: asyncio.AbstractEventLoop):
+    global _bulk_loop, _bulk_chunk_slots, _bulk_waiting_count
+    # The semaphore is bound to the event loop it was created on, e.g. each asyncio.run of a benchmark has its own
+    if _bulk_loop is not loop:
+        _bulk_loop = loop
+        _bulk_chunk_slots = asyncio.Semaphore(BULK_MAX_CONCURRENT_CHUNKS)
+        _bulk_waiting_count = 0
+
+async def _run_bulk_chunk(pixels: np.ndarray, model_names: tuple[str, ...]) -> List[List[PredictionClassification]]:
+    global _bulk_waiting_count
+    _ensure_bulk_chunk_slots(asyncio.get_running_loop())
+    if _bulk_chunk_slots.locked() and _bulk_waiting_count >= BULK_MAX_QUEUE:
+        raise OverloadedError("bulk: too many requests are already queued")
+    _bulk_waiting_count += 1
+    try:
+        await _bulk_chunk_slots.acquire()
+    finally:
+        _bulk_waiting_count -= 1
+    try:
+        return await run_inference(create_predictions_for_pixels, pixels, model_names)
+    finally:
+        _bulk_chunk_slots.release()
+
+async def create_predictions_bulk(pixels: np.ndarray, model_names: tuple[str, ...] = DEFAULT_MODEL_NAMES) -> List[List[PredictionClassification]]:
+    """
+    Predicts an N x 28 x 28 array of digits which already form a batch,
+    so skips the scheduler and goes straight to the inference workers, a chunk at a time
+    """
+    predictions = []
+    for start in range(0, len(pixels), BULK_CHUNK_SIZE):
+        predictions += await _run_bulk_chunk(pixels[start:start + BULK_CHUNK_SIZE], model_names)
+    return predictions
+
+_worker_warm_up = None
+
+def model_status() -> dict:
+    # A module level function, so that it can be called in worker processes
+    return model_registry.status()
+
+def start_warm_up():
+    """Starts loading the models in the background, so the first requests don't have to wait"""
+    global _worker_warm_up
+    if INFERENCE_EXECUTOR == "process":
+        # Each worker warms up its models in its initializer, so just get every worker started
+        _worker_warm_up = asyncio.ensure_future(asyncio.gather(
+            *[inference_executor.run(model_status) for _ in range(INFERENCE_WORKERS)]
+        ))
+        # The models aren't loaded in this process, so it reads their weights versions for the prediction cache's keys
+        model_registry.watch_in_background(MODEL_WATCH_INTERVAL_SECONDS)
+    else:
+        model_registry.warm_up_in_background()
+        model_registry.watch_in_background(MODEL_WATCH_INTERVAL_SECONDS)
+
+def readiness() -> dict:
+    if INFERENCE_EXECUTOR == "process":
+        warmed_up = _worker_warm_up is not None and _worker_warm_up.done() and _worker_warm_up.exception() is None
+        return {
+            "ready": warmed_up,
+            "workers": _worker_warm_up.result() if warmed_up else [],
+        }
+    return model_registry.status()
+
+async def shutdown():
+    await prediction_scheduler.stop()
+    inference_executor.shutdown()
@@ -0,0 +1,297 @@
+"""
+Low overhead timings of each stage of handling a request, and of each model's forward passes,
+exported in the Prometheus text format at /metrics.
+
+Timings are counted into fixed histogram buckets, so recording one is a perf_counter call either side,
+a bisect and an increment under a lock. With METRICS_ENABLED=false, timing a stage returns a shared no-op
+context manager instead, so costs little more than the function call.
+
+A sample of prediction batches (PROFILE_SAMPLE_RATE) can also be run under the torch profiler,
+keeping a chrome trace of each one slower than PROFILE_SLOW_MS in PROFILE_DIR.
+"""
+import bisect
+import contextlib
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, TypeVar
+from .config import load_env_bool, load_env_float, load_env_string_or_default
+
+R = TypeVar("R")
+
+# Upper bounds of the buckets, from 100us to 2.5s
+LATENCY_BUCKETS_SECONDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class _NoOpTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_OP_TIMER = _NoOpTimer()
+
+class _Timer:
+    __slots__ = ("_histogram", "_label_values", "_started_at")
+
+    def __init__(self, histogram: "Histogram", label_values: tuple[str, ...]):
+        self._histogram = histogram
+        self._label_values = label_values
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started_at, *self._label_values)
+        return False
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Histogram:
+    """A thread-safe histogram, with a series for each combination of label values"""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...], enabled: bool = True):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.enabled = enabled
+        # Label values => a count for each bucket then +Inf (not cumulative), and the sum of the values
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        if not self.enabled:
+            return
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = ([0] * (len(self.buckets) + 1), [0.0])
+                self._series[label_values] = series
+            series[0][bucket_index] += 1
+            series[1][0] += value
+
+    def time(self, *label_values: str):
+        """A context manager which observes how long its body took, in seconds"""
+        if not self.enabled:
+            return _NO_OP_TIMER
+        return _Timer(self, label_values)
+
+    def take_snapshot(self) -> dict[tuple[str, ...], tuple[list[int], float]]:
+        """Returns and resets the counts recorded so far"""
+        with self._lock:
+            snapshot = {label_values: (counts, total[0]) for (label_values, (counts, total)) in self._series.items()}
+            self._series = {}
+        return snapshot
+
+    def merge(self, snapshot: dict[tuple[str, ...], tuple[list[int], float]]):
+        with self._lock:
+            for (label_values, (counts, total)) in snapshot.items():
+                series = self._series.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0]))
+                for (i, count) in enumerate(counts):
+                    series[0][i] += count
+                series[1][0] += total
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((label_values, list(counts), total[0]) for (label_values, (counts, total)) in self._series.items())
+        for (label_values, counts, total) in series:
+            labels = ",".join(f'{name}="{_escape_label_value(value)}"' for (name, value) in zip(self.label_names, label_values))
+            separator = "," if labels else ""
+            cumulative_count = 0
+            for (bound, count) in zip([*self.buckets, float("inf")], counts):
+                cumulative_count += count
+                yield f'{self.name}_bucket{{{labels}{separator}le="{"+Inf" if bound == float("inf") else f"{bound:g}"}"}} {cumulative_count}'
+            braced_labels = f"{{{labels}}}" if labels else ""
+            yield f"{self.name}_sum{braced_labels} {total}"
+            yield f"{self.name}_count{braced_labels} {cumulative_count}"
+
+class Counter:
+    """A thread-safe counter, with a series for each combination of label values"""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], enabled: bool = True):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.enabled = enabled
+        self._series: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def take_snapshot(self) -> dict[tuple[str, ...], float]:
+        """Returns and resets the counts recorded so far"""
+        with self._lock:
+            (snapshot, self._series) = (self._series, {})
+        return snapshot
+
+    def merge(self, snapshot: dict[tuple[str, ...], float]):
+        with self._lock:
+            for (label_values, count) in snapshot.items():
+                self._series[label_values] = self._series.get(label_values, 0) + count
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            series = sorted(self._series.items())
+        for (label_values, count) in series:
+            labels = ",".join(f'{name}="{_escape_label_value(value)}"' for (name, value) in zip(self.label_names, label_values))
+            yield f"{self.name}{{{labels}}} {count:g}" if labels else f"{self.name} {count:g}"
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics: dict[str, Histogram | Counter] = {}
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...] = LATENCY_BUCKETS_SECONDS) -> Histogram:
+        histogram = Histogram(name, help, label_names, buckets, enabled=self.enabled)
+        self._metrics[name] = histogram
+        return histogram
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...]) -> Counter:
+        counter = Counter(name, help, label_names, enabled=self.enabled)
+        self._metrics[name] = counter
+        return counter
+
+    def take_snapshot(self) -> dict[str, dict]:
+        """Returns and resets every metric's counts, e.g. to send them from a worker process to the api's process"""
+        return {name: metric.take_snapshot() for (name, metric) in self._metrics.items()}
+
+    def merge(self, snapshot: dict[str, dict]):
+        for (name, metric_snapshot) in snapshot.items():
+            self._metrics[name].merge(metric_snapshot)
+
+    def render(self) -> str:
+        """All the metrics, in the Prometheus text exposition format"""
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry(enabled=load_env_bool("METRICS_ENABLED", True))
+
+stage_seconds = metrics.histogram(
+    "digit_api_stage_duration_seconds",
+    "Time spent in each stage of handling a request",
+    ("stage",),
+)
+model_seconds = metrics.histogram(
+    "digit_api_model_forward_seconds",
+    "Time each model's forward pass over a batch took",
+    ("model",),
+)
+model_batch_digits = metrics.histogram(
+    "digit_api_model_batch_digits",
+    "Number of digits in each batch run through a model",
+    ("model",),
+    BATCH_SIZE_BUCKETS,
+)
+models_skipped = metrics.counter(
+    "digit_api_models_skipped_total",
+    "Predictions left out because the model hadn't finished by the request's deadline",
+    ("model",),
+)
+cascade_digits = metrics.counter(
+    "digit_api_cascade_digits_total",
+    "Digits predicted by the cascade, by whether its first model was confident, they were escalated to its second, or it was too late to",
+    ("outcome",),
+)
+request_seconds = metrics.histogram(
+    "digit_api_request_duration_seconds",
+    "Time to respond to each request, from receiving it to sending the start of the response",
+    ("method", "route", "status"),
+)
+
+def time_stage(stage: str):
+    """A context manager timing a stage of handling a request, e.g. decode or png_encode"""
+    return stage_seconds.time(stage)
+
+def call_and_take_metrics(fn: Callable[..., R], *args) -> tuple[R, dict]:
+    """Runs in an inference worker process, returning the metrics it recorded so the api's process can merge them"""
+    return (fn(*args), metrics.take_snapshot())
+
+class RequestTimingMiddleware:
+    """
+    Times each HTTP request by the route which handled it (rather than its path, which would give
+    a series for every submission id).
+    """
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+        self._route_paths = None
+
+    def _route_path(self, scope) -> str:
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            return route.path
+        # Older versions of starlette only record the endpoint
+        if self._route_paths is None:
+            self._route_paths = {route.endpoint: route.path for route in self.routes if hasattr(route, "endpoint")}
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not request_seconds.enabled:
+            return await self.app(scope, receive, send)
+        started_at = time.perf_counter()
+        status_code = 500
+
+        async def send_timed(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                request_seconds.observe(time.perf_counter() - started_at, scope["method"], self._route_path(scope), str(status_code))
+            await send(message)
+
+        await self.app(scope, receive, send_timed)
+
+class SlowBatchProfiler:
+    """
+    Runs a sample of calls under the torch profiler, keeping the chrome traces of those which took
+    at least slow_seconds in output_dir. Only one call per process is profiled at a time.
+    """
+
+    def __init__(self, sample_rate: float, slow_seconds: float, output_dir: Path):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+
+    def maybe_profile(self, label: str):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return _NO_OP_TIMER
+        # The profiler is global to the process, so skip this sample if another call is being profiled
+        if not self._lock.acquire(blocking=False):
+            return _NO_OP_TIMER
+        return self._profile(label)
+
+    @contextlib.contextmanager
+    def _profile(self, label: str):
+        try:
+            import torch.profiler
+            with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True) as profiler:
+                started_at = time.perf_counter()
+                yield
+                elapsed_seconds = time.perf_counter() - started_at
+            if elapsed_seconds >= self.slow_seconds:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                timestamp = time.strftime("%Y%m%d-%H%M%S")
+                profiler.export_chrome_trace(str(self.output_dir / f"{label}-{timestamp}-{os.getpid()}-{elapsed_seconds * 1000:.0f}ms.json"))
+        finally:
+            self._lock.release()
+
+batch_profiler = SlowBatchProfiler(
+    sample_rate=load_env_float("PROFILE_SAMPLE_RATE", 0.0),
+    slow_seconds=load_env_float("PROFILE_SLOW_MS", 100.0) / 1000,
+    output_dir=Path(load_env_string_or_default("PROFILE_DIR", "profiles")),
+)
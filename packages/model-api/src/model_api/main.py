@@ -1,10 +1,38 @@
-from fastapi import FastAPI, status, HTTPException
+from fastapi import FastAPI, Depends, Header, Query, Request, Response, status, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
+import datetime
+import hashlib
 from typing import List, Self
 import numpy as np
-from .api_models import HealthCheck, ApiDigitData, ApiSubmittedDigit, ApiDigitClassification, ApiPreviousSubmission
-from .submission_store import submission_store, DbSubmission
+from .api_models import HealthCheck, ApiDigitData, ApiDigitBatch, ApiSubmittedDigit, ApiDigitClassification, ApiPreviousSubmission, ApiSubmissionsPage
+from .api_models import read_digit, read_digit_batch, read_model_names, read_deadline_ms, require_admin, digit_request_body_openapi, cached_png_bytes
+from .predictions import PredictionDigitData, prediction_cache, predictors, ensemble, cascade, model_registry, DEFAULT_MODEL_NAMES
+from .submission_store import submission_store, submission_writer, store_executor, DbSubmission, SubmissionCursor, SubmissionQuery
+from .executor import OverloadedError
+from .submission_export import EXPORT_CHUNK_SIZE, npy_size, stream_npy
+from .instrumentation import RequestTimingMiddleware, metrics, time_stage
+from . import inference, wire_formats
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    inference.start_warm_up()
+    yield
+    await inference.shutdown()
+    await submission_writer.stop()
+    store_executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware, routes=app.routes)
+
+@app.exception_handler(OverloadedError)
+async def overloaded_error_handler(request: Request, exc: OverloadedError) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "The server is busy, please try again shortly"},
+        headers={"Retry-After": "1"},
+    )
 
 @app.get(
     "/health",
@@ -17,36 +45,244 @@ app = FastAPI()
 async def health_check() -> HealthCheck:
     return HealthCheck(status="OK")
 
-@app.post("/recognize-digit")
-async def recognize_digit(data: ApiDigitData) -> list[ApiDigitClassification]:
-    return [ApiDigitClassification.from_prediction_model(x) for x in data.to_prediction_model().create_predictions()]
+@app.get(
+    "/ready",
+    tags=["healthcheck"],
+    summary="Check whether the models have been loaded",
+    response_description="Return HTTP Status Code 200 (OK) once every model is loaded, or 503 whilst warming up",
+)
+async def ready() -> JSONResponse:
+    readiness = inference.readiness()
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if readiness["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=readiness,
+    )
+
+@app.post(
+    "/recognize-digit",
+    openapi_extra=digit_request_body_openapi(ApiDigitData, ["application/octet-stream", "image/png"]),
+)
+async def recognize_digit(
+    data: PredictionDigitData = Depends(read_digit),
+    model_names: tuple[str, ...] = Depends(read_model_names),
+    deadline_ms: float | None = Depends(read_deadline_ms),
+) -> list[ApiDigitClassification]:
+    predictions = await inference.create_predictions(data, model_names, deadline_ms)
+    return [ApiDigitClassification.from_prediction_model(x) for x in predictions]
 
-def pixels_to_png_bytes(pixels: np.array) -> bytes:
-    """Convert a numpy array of pixels to a PNG image in bytes"""
-    from PIL import Image
-    import io
-    image_io = io.BytesIO()
-    image = Image.fromarray(pixels)
-    image.save(image_io, format="PNG")
-    return image_io.getvalue()
+@app.post(
+    "/recognize-digits",
+    openapi_extra=digit_request_body_openapi(ApiDigitBatch, ["application/octet-stream"]),
+)
+async def recognize_digits(
+    pixels: np.ndarray = Depends(read_digit_batch),
+    model_names: tuple[str, ...] = Depends(read_model_names),
+) -> list[list[ApiDigitClassification]]:
+    """Recognizes up to BULK_MAX_DIGITS digits in one request, returning the predictions for each digit in order"""
+    predictions = await inference.create_predictions_bulk(pixels, model_names)
+    return [[ApiDigitClassification.from_prediction_model(x) for x in digit_predictions] for digit_predictions in predictions]
 
 @app.post("/submit-digit")
-async def submit_digit(data: ApiSubmittedDigit):
-    import datetime
-    pixel_data = data.digit.to_prediction_model()
+async def submit_digit(
+    data: ApiSubmittedDigit,
+    model_names: tuple[str, ...] = Depends(read_model_names),
+    deadline_ms: float | None = Depends(read_deadline_ms),
+):
+    with time_stage("decode"):
+        pixel_data = data.digit.to_prediction_model()
     label = data.label
     if not (0 <= label <= 9):
         raise HTTPException(status_code=400, detail="Label must be between 0 and 9")
-    predictions = pixel_data.create_predictions()
-    submission_store.add_submission(
+    predictions = await inference.create_predictions(pixel_data, model_names, deadline_ms)
+    # Its PNG is only encoded if it's requested
+    deflated_pixels = wire_formats.encode_deflated_pixels(pixel_data.pixels)
+    # Returns once the submission is queued, it's written to the store shortly after, in a batch with others
+    submission_writer.enqueue(
         DbSubmission(
             timestamp=datetime.datetime.now(datetime.UTC),
-            png_bytes=pixels_to_png_bytes(pixel_data.pixels),
+            deflated_pixels=deflated_pixels,
             label=label,
             predictions=[ApiDigitClassification.from_prediction_model(x).to_db_model() for x in predictions],
         )
     )
 
 @app.get("/recent-submissions")
-async def recent_submissions() -> List[ApiPreviousSubmission]:
-    return [ApiPreviousSubmission.from_db_model(x) for x in submission_store.get_recent_submissions(20)]
+async def recent_submissions(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = Query(None, description="The next_cursor of the previous page"),
+    label: int | None = Query(None, ge=0, le=9),
+    model: str | None = Query(None, description="Only submissions predicted by this model"),
+    misclassified: bool = Query(False, description="Only submissions predicted wrongly (by the model, if given)"),
+    include_images: bool = Query(True, description="If false, fetch each image from /submissions/{id}/image.png instead"),
+) -> ApiSubmissionsPage:
+    """The most recent submissions first, a page at a time"""
+    try:
+        after = SubmissionCursor.decode(cursor) if cursor is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    query = SubmissionQuery(
+        limit=limit,
+        after=after,
+        label=label,
+        model=model,
+        misclassified=misclassified,
+        include_images=include_images,
+    )
+    return await store_executor.run(read_submissions_page, query)
+
+def read_submissions_page(query: SubmissionQuery) -> ApiSubmissionsPage:
+    """Runs on the store executor, as encoding a page of PNGs would otherwise hold up the event loop"""
+    with time_stage("store_read"):
+        submissions = submission_store.get_submissions(query)
+    with time_stage("png_encode"):
+        page = [ApiPreviousSubmission.from_db_model(x, query.include_images) for x in submissions]
+    return ApiSubmissionsPage(
+        submissions=page,
+        next_cursor=SubmissionCursor.after(submissions[-1]).encode() if len(submissions) == query.limit else None,
+    )
+
+@app.get(
+    "/submissions/{id}/image.png",
+    response_class=Response,
+    responses={200: {"content": {"image/png": {}}}},
+)
+async def submission_image(id: int, if_none_match: str | None = Header(None)) -> Response:
+    with time_stage("store_read"):
+        pixels = await store_executor.run(submission_store.get_submission_pixels, id)
+    if pixels is None:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    raw_pixels = wire_formats.encode_raw_pixels(pixels)
+    # Weak, as the PNG's bytes may change (e.g. as an earlier version's PNG is converted to pixels), but not its pixels
+    etag = f'W/"{hashlib.blake2b(raw_pixels, digest_size=16).hexdigest()}"'
+    # Submissions are never modified, so neither are their images
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match is not None and any(x.strip() in (etag, etag.removeprefix("W/"), "*") for x in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    with time_stage("png_encode"):
+        png_bytes = cached_png_bytes(raw_pixels)
+    return Response(content=png_bytes, media_type="image/png", headers=headers)
+
+@app.get("/model-stats")
+async def model_stats() -> dict:
+    """
+    Each model's accuracy, confusion matrix (of labels by predicted digits) and confidence calibration over every submission,
+    from running totals, rather than the submissions themselves
+    """
+    with time_stage("store_read"):
+        stats_by_model = await store_executor.run(submission_store.get_model_stats)
+    return {model_name: stats.summary() for (model_name, stats) in sorted(stats_by_model.items())}
+
+@app.get("/models")
+async def models() -> dict:
+    """The models which can be selected with the models query parameter, and those used by default"""
+    return {
+        "default": list(DEFAULT_MODEL_NAMES),
+        "models": {
+            model_name: {
+                "version": model_registry.active_version(model_name),
+                "weights_version": model_registry.weights_version(model_name),
+                "loaded": model_registry.is_loaded(model_name),
+            }
+            for model_name in predictors
+        } | {
+            ensemble.model_name: {
+                "weights": ensemble.weights,
+                "loaded": all(model_registry.is_loaded(member) for member in ensemble.weights),
+            },
+            cascade.model_name: {
+                "first": cascade.first,
+                "second": cascade.second,
+                "threshold": cascade.threshold,
+                "augmentations": len(cascade.augmentations),
+                "loaded": model_registry.is_loaded(cascade.first) and model_registry.is_loaded(cascade.second),
+            },
+        },
+    }
+
+def registry_model_name_or_404(model_name: str) -> str:
+    if model_name not in model_registry.model_names:
+        raise HTTPException(status_code=404, detail=f"Unknown model {model_name}, expected one of {', '.join(model_registry.model_names)}")
+    return model_name
+
+@app.get("/admin/models", dependencies=[Depends(require_admin)])
+async def admin_models() -> dict:
+    """Each model's active, pinned and available versions, in the process which handled the request"""
+    return {model_name: model_registry.version_status(model_name) for model_name in model_registry.model_names}
+
+async def change_version(change, model_name: str, *args) -> dict:
+    """
+    Runs a change of version (which may load it) off the event loop. With the process executor, the models
+    run in the worker processes, so this only records the change, which they pick up as they next check.
+    """
+    try:
+        await asyncio.to_thread(change, model_name, *args, activate=inference.INFERENCE_EXECUTOR != "process")
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0]) from e
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load {model_name}: {type(e).__name__}: {e}") from e
+    return model_registry.version_status(model_name)
+
+@app.post("/admin/models/{model_name}/pin", dependencies=[Depends(require_admin)])
+async def pin_model_version(model_name: str = Depends(registry_model_name_or_404), version: str = Query(...)) -> dict:
+    """Loads and swaps in the version, and keeps the model on it (in every process) until it's unpinned"""
+    return await change_version(model_registry.pin, model_name, version)
+
+@app.delete("/admin/models/{model_name}/pin", dependencies=[Depends(require_admin)])
+async def unpin_model_version(model_name: str = Depends(registry_model_name_or_404)) -> dict:
+    """Returns the model to its latest version"""
+    return await change_version(model_registry.unpin, model_name)
+
+@app.post("/admin/models/{model_name}/rollback", dependencies=[Depends(require_admin)])
+async def rollback_model_version(model_name: str = Depends(registry_model_name_or_404)) -> dict:
+    """Pins the model to the version before its active one"""
+    return await change_version(model_registry.rollback, model_name)
+
+@app.get(
+    "/submissions/export.npy",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/octet-stream": {}}}},
+)
+async def export_submissions(
+    after_id: int = Query(0, ge=0, description="Only export submissions after this id, e.g. X-Export-Up-To-Id of a previous export"),
+    since: datetime.datetime | None = Query(None, description="Only export submissions from this time"),
+) -> StreamingResponse:
+    """
+    Streams the submissions as a .npy array of (id, timestamp, label, pixels) records, in id order.
+    Use model_api.submission_export to download them as a dataset.
+    """
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.UTC)
+    export = await store_executor.run(submission_store.export_submissions, after_id, since, EXPORT_CHUNK_SIZE)
+    return StreamingResponse(
+        stream_npy(export.count, export.chunks),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Length": str(npy_size(export.count)),
+            "X-Export-Count": str(export.count),
+            "X-Export-Up-To-Id": str(export.up_to_id),
+        },
+    )
+
+@app.get("/batching-stats")
+async def batching_stats() -> dict:
+    """Batch size and queue wait metrics of the prediction scheduler, and load on the worker pools"""
+    return inference.prediction_scheduler.metrics.summary() | {
+        "inference_executor": inference.inference_executor.summary(),
+        "store_executor": store_executor.summary(),
+        "submission_writer": submission_writer.summary(),
+        "submission_store": submission_store.summary(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics() -> PlainTextResponse:
+    """Latency histograms of each request stage and model, in the Prometheus text format"""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled, see METRICS_ENABLED")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/prediction-cache-stats")
+async def prediction_cache_stats() -> dict:
+    """Size and hit/miss counters of the prediction cache"""
+    return prediction_cache.summary()
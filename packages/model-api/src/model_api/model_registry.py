@@ -0,0 +1,363 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List
+import torch
+from model.digit_model import DigitModelBase, weights_file_version
+from model.export import write_atomically
+
+def peak_rss_mb() -> float:
+    """The peak resident set size of this process so far"""
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and kilobytes on Linux
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+@dataclass
+class ModelLoadStats:
+    load_seconds: float
+    peak_rss_mb_after_load: float
+
+# The weights packaged with the model package, which every model has
+PACKAGED_VERSION = "packaged"
+# Each loaded version is run over batches of these sizes before it's used, so its first requests aren't slow
+WARM_UP_BATCH_SIZES = (1, 32)
+
+def warm_up_model(model: DigitModelBase):
+    for batch_size in WARM_UP_BATCH_SIZES:
+        # Twice, as TorchScript optimizes a graph for its inputs on the second run
+        for _ in range(2):
+            model.probabilities_from_tensor(torch.zeros(batch_size, 1, 28, 28), 1.0)
+
+def version_sort_key(version: str) -> tuple:
+    """Orders versions by their numbers, rather than their digits, e.g. 9 before 10, and 2026-10-02 before 2026-10-10"""
+    # Splitting on runs of digits alternates text and numbers, so the keys of any two versions compare
+    return tuple(int(part) if i % 2 == 1 else part for (i, part) in enumerate(re.split(r"(\d+)", version)))
+
+class ModelRegistry:
+    """
+    Loads each registered model on first use (or when warmed up), so that importing the api,
+    and answering health checks, doesn't have to wait for torch to load the weights.
+
+    With a checkpoint_dir, the models which can load checkpoints are versioned: each version is a
+    <checkpoint_dir>/<model name>/<version>.pth file (e.g. saved by model-train), and the packaged weights
+    are the version "packaged", which comes before them. Each model uses the latest version by name (comparing
+    any numbers in the names numerically, see version_sort_key), unless a version is pinned (recorded in a
+    <model name>/pinned file, so every process serving the api agrees).
+
+    Whilst watching, new versions are loaded and warmed up in the background, then swapped in atomically.
+    Requests already running keep the version they started with, and the previous retained_versions versions
+    stay loaded for quick rollbacks. Older versions are unloaded, once any requests still using them finish.
+    """
+
+    def __init__(self, checkpoint_dir: Path | None = None, retained_versions: int = 1):
+        self.checkpoint_dir = checkpoint_dir
+        self.retained_versions = retained_versions
+        self._loaders: Dict[str, Callable[[], DigitModelBase]] = {}
+        self._checkpoint_loaders: Dict[str, Callable[[Path], DigitModelBase] | None] = {}
+        self._weights_versions: Dict[str, Callable[[], str]] = {}
+        self._models: Dict[str, DigitModelBase] = {}
+        self._active_versions: Dict[str, str] = {}
+        # Previously active versions which are still loaded, oldest first
+        self._retained: Dict[str, OrderedDict[str, DigitModelBase]] = {}
+        # The error from each version which failed to load, which isn't tried again unless it's pinned
+        self._failed_versions: Dict[str, Dict[str, str]] = {}
+        # Each checkpoint's weights version, keyed by its path, modification time and size
+        self._checkpoint_weights_versions: Dict[tuple[Path, int, int], str] = {}
+        # The weights version of each model's target version, for models which aren't loaded in this process
+        # (e.g. with the process executor), kept up to date by the watch thread rather than read per request
+        self._target_weights_versions: Dict[str, str] = {}
+        self._load_stats: Dict[str, ModelLoadStats] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._swap_listeners: List[Callable[[str], None]] = []
+        self._warm_up_thread = None
+        self._watch_thread = None
+        self.created_at = time.monotonic()
+        self.ready_seconds = None
+
+    def register(
+        self,
+        model_name: str,
+        load_model: Callable[[], DigitModelBase],
+        weights_version: Callable[[], str],
+        load_checkpoint: Callable[[Path], DigitModelBase] | None = None,
+    ):
+        """
+        weights_version should return the version of the weights load_model would load, without loading them.
+        Only models with a load_checkpoint can load versions from the checkpoint directory.
+        """
+        self._loaders[model_name] = load_model
+        self._checkpoint_loaders[model_name] = load_checkpoint
+        self._weights_versions[model_name] = weights_version
+        self._retained[model_name] = OrderedDict()
+        self._failed_versions[model_name] = {}
+        self._load_locks[model_name] = threading.Lock()
+
+    def add_swap_listener(self, listener: Callable[[str], None]):
+        """Calls listener with the model's name after a different version of it is swapped in"""
+        self._swap_listeners.append(listener)
+
+    @property
+    def model_names(self) -> List[str]:
+        return list(self._loaders)
+
+    def is_loaded(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def _model_dir(self, model_name: str) -> Path | None:
+        if self.checkpoint_dir is None or self._checkpoint_loaders[model_name] is None:
+            return None
+        return self.checkpoint_dir / model_name
+
+    def _checkpoint_path(self, model_name: str, version: str) -> Path:
+        return self._model_dir(model_name) / f"{version}.pth"
+
+    def versions(self, model_name: str) -> List[str]:
+        """The versions of the model which can be loaded, oldest first"""
+        versions = [PACKAGED_VERSION]
+        model_dir = self._model_dir(model_name)
+        if model_dir is not None and model_dir.is_dir():
+            # Partially written files (e.g. from write_atomically) don't end in .pth
+            versions += sorted(
+                (path.stem for path in model_dir.glob("*.pth") if path.is_file() and path.stem != PACKAGED_VERSION),
+                key=version_sort_key,
+            )
+        return versions
+
+    def pinned_version(self, model_name: str) -> str | None:
+        model_dir = self._model_dir(model_name)
+        if model_dir is None:
+            return None
+        try:
+            return (model_dir / "pinned").read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def target_version(self, model_name: str) -> str:
+        """The pinned version if it's available, else the latest version which hasn't failed to load"""
+        versions = self.versions(model_name)
+        pinned = self.pinned_version(model_name)
+        if pinned in versions:
+            return pinned
+        loadable = [version for version in versions if version not in self._failed_versions[model_name]]
+        return loadable[-1] if loadable else PACKAGED_VERSION
+
+    def active_version(self, model_name: str) -> str | None:
+        return self._active_versions.get(model_name)
+
+    def weights_version(self, model_name: str) -> str:
+        """The loaded model's weights version, else that of the version it would load, as of the last refresh"""
+        model = self._models.get(model_name)
+        if model is not None:
+            return model.weights_version
+        weights_version = self._target_weights_versions.get(model_name)
+        if weights_version is None:
+            # Only until the watch thread first refreshes them
+            weights_version = self._read_target_weights_version(model_name)
+            self._target_weights_versions[model_name] = weights_version
+        return weights_version
+
+    def _read_target_weights_version(self, model_name: str) -> str:
+        version = self.target_version(model_name)
+        if version == PACKAGED_VERSION:
+            return self._weights_versions[model_name]()
+        # Hashing the file again is only needed if it's changed
+        path = self._checkpoint_path(model_name, version)
+        stat = path.stat()
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key not in self._checkpoint_weights_versions:
+            self._checkpoint_weights_versions[key] = weights_file_version(path)
+        return self._checkpoint_weights_versions[key]
+
+    def refresh_weights_versions(self, model_names: List[str] | None = None):
+        """Reads the weights version of each model's target version, as served by weights_version whilst it isn't loaded"""
+        for model_name in model_names if model_names is not None else self._loaders:
+            try:
+                self._target_weights_versions[model_name] = self._read_target_weights_version(model_name)
+            except OSError as e:
+                # e.g. a checkpoint removed whilst it was read, so keep the previous version until the next refresh
+                print(f"Failed to read the weights version of {model_name}: {e}", file=sys.stderr, flush=True)
+
+    def _load_version(self, model_name: str, version: str) -> DigitModelBase:
+        started_at = time.perf_counter()
+        try:
+            if version == PACKAGED_VERSION:
+                model = self._loaders[model_name]()
+            else:
+                model = self._checkpoint_loaders[model_name](self._checkpoint_path(model_name, version))
+            warm_up_model(model)
+        except Exception as e:
+            self._failed_versions[model_name][version] = f"{type(e).__name__}: {e}"
+            raise
+        self._load_stats[model_name] = ModelLoadStats(
+            load_seconds=time.perf_counter() - started_at,
+            peak_rss_mb_after_load=peak_rss_mb(),
+        )
+        return model
+
+    def get(self, model_name: str) -> DigitModelBase:
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+        with self._load_locks[model_name]:
+            # Another thread may have loaded it whilst we waited for the lock
+            model = self._models.get(model_name)
+            if model is None:
+                while True:
+                    version = self.target_version(model_name)
+                    try:
+                        model = self._load_version(model_name, version)
+                        break
+                    except Exception as e:
+                        # Fall back to the previous version, unless even the packaged weights can't be loaded
+                        if version == PACKAGED_VERSION or version == self.pinned_version(model_name):
+                            raise
+                        print(f"Failed to load {model_name} version {version}, so falling back: {e}", file=sys.stderr, flush=True)
+                self._active_versions[model_name] = version
+                self._models[model_name] = model
+                if self.ready_seconds is None and len(self._models) == len(self._loaders):
+                    self.ready_seconds = time.monotonic() - self.created_at
+        return model
+
+    def activate(self, model_name: str, version: str):
+        """
+        Loads (unless it's retained) and warms up the version, then swaps it in for new requests,
+        keeping the previously active version loaded until it's one of more than retained_versions
+        """
+        with self._load_locks[model_name]:
+            previous_version = self._active_versions.get(model_name)
+            if previous_version == version:
+                return
+            model = self._retained[model_name].pop(version, None)
+            if model is None:
+                model = self._load_version(model_name, version)
+            # A single assignment, so every request gets either the previous model or the new one
+            previous_model = self._models.get(model_name)
+            self._models[model_name] = model
+            self._active_versions[model_name] = version
+            if previous_model is not None:
+                retained = self._retained[model_name]
+                retained[previous_version] = previous_model
+                while len(retained) > self.retained_versions:
+                    # Freed once any requests still using it finish
+                    retained.popitem(last=False)
+        for listener in self._swap_listeners:
+            listener(model_name)
+
+    def reconcile(self):
+        """Swaps in the target version of each loaded model which isn't using it, e.g. after a new checkpoint is added"""
+        for model_name in list(self._models):
+            version = self.target_version(model_name)
+            if version == self._active_versions.get(model_name) or version in self._failed_versions[model_name]:
+                continue
+            try:
+                self.activate(model_name, version)
+                print(f"Swapped in {model_name} version {version}", file=sys.stderr, flush=True)
+            except Exception as e:
+                print(f"Failed to load {model_name} version {version}, so kept version {self._active_versions.get(model_name)}: {e}", file=sys.stderr, flush=True)
+
+    def pin(self, model_name: str, version: str, activate: bool = True):
+        """
+        Pins the model to the version, for every process serving the api. Unless activate is False
+        (e.g. if another process runs the models), it's loaded first, so a version which fails to load isn't pinned.
+        """
+        model_dir = self._model_dir(model_name)
+        if model_dir is None:
+            reason = "there's no checkpoint directory" if self.checkpoint_dir is None else "it only has its packaged weights"
+            raise ValueError(f"{model_name} can't be pinned, as {reason}")
+        if version not in self.versions(model_name):
+            raise KeyError(f"{model_name} has no version {version!r}")
+        # Pinning retries a version which previously failed to load
+        self._failed_versions[model_name].pop(version, None)
+        if activate:
+            self.activate(model_name, version)
+        model_dir.mkdir(parents=True, exist_ok=True)
+        write_atomically(model_dir / "pinned", lambda temporary_path: temporary_path.write_text(version))
+        self.refresh_weights_versions([model_name])
+
+    def unpin(self, model_name: str, activate: bool = True):
+        """Returns the model to the latest version"""
+        model_dir = self._model_dir(model_name)
+        if model_dir is not None:
+            (model_dir / "pinned").unlink(missing_ok=True)
+        self.refresh_weights_versions([model_name])
+        if activate and self.is_loaded(model_name):
+            self.activate(model_name, self.target_version(model_name))
+
+    def rollback(self, model_name: str, activate: bool = True) -> str:
+        """Pins the model to the version before the active (or target) one which hasn't failed to load, and returns it"""
+        current = self._active_versions.get(model_name) or self.target_version(model_name)
+        versions = self.versions(model_name)
+        earlier = [
+            version for version in versions[:versions.index(current)] if version not in self._failed_versions[model_name]
+        ] if current in versions else []
+        if len(earlier) == 0:
+            raise ValueError(f"{model_name} has no version before {current} to roll back to")
+        self.pin(model_name, earlier[-1], activate)
+        return earlier[-1]
+
+    def watch_in_background(self, interval_seconds: float):
+        """
+        Reads each model's target weights version, then if there's a checkpoint directory, checks for
+        new or pinned versions every interval_seconds
+        """
+        if self._watch_thread is not None:
+            return
+
+        def watch():
+            self.refresh_weights_versions()
+            # The packaged weights don't change whilst the api runs
+            while self.checkpoint_dir is not None:
+                time.sleep(interval_seconds)
+                self.refresh_weights_versions()
+                self.reconcile()
+
+        self._watch_thread = threading.Thread(target=watch, name="model-watch", daemon=True)
+        self._watch_thread.start()
+
+    def warm_up(self):
+        """Loads every registered model"""
+        for model_name in self._loaders:
+            self.get(model_name)
+
+    def warm_up_in_background(self):
+        if self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=self.warm_up, name="model-warm-up", daemon=True)
+            self._warm_up_thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return len(self._models) == len(self._loaders)
+
+    def version_status(self, model_name: str) -> dict:
+        return {
+            "active": self._active_versions.get(model_name),
+            "weights_version": self.weights_version(model_name),
+            "pinned": self.pinned_version(model_name),
+            "target": self.target_version(model_name),
+            "versions": self.versions(model_name),
+            "loaded_versions": list(self._retained[model_name]) + ([self._active_versions[model_name]] if model_name in self._active_versions else []),
+            "failed_versions": dict(self._failed_versions[model_name]),
+            "reloadable": self._model_dir(model_name) is not None,
+        }
+
+    def status(self) -> dict:
+        models = {}
+        for model_name in self._loaders:
+            load_stats = self._load_stats.get(model_name)
+            models[model_name] = {
+                "loaded": load_stats is not None,
+                "version": self._active_versions.get(model_name),
+                "load_seconds": load_stats.load_seconds if load_stats is not None else None,
+                "peak_rss_mb_after_load": load_stats.peak_rss_mb_after_load if load_stats is not None else None,
+            }
+        return {
+            "ready": self.ready,
+            "models": models,
+            "seconds_until_ready": self.ready_seconds,
+            "peak_rss_mb": peak_rss_mb(),
+        }
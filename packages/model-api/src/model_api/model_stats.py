@@ -0,0 +1,128 @@
+"""
+Running totals of each model's predictions of the labelled submissions, from which its accuracy, confusion matrix
+and confidence calibration are derived, without scanning the submissions.
+
+The stores update them as they add each batch of submissions, and serve them from /model-stats.
+This rebuilds them from the stored submissions, streamed a chunk at a time, e.g. after upgrading from a version
+which didn't keep them, or if they're ever suspected to have drifted.
+
+Run with: uv run --package model-api python -m model_api.model_stats
+"""
+import argparse
+import time
+from typing import Iterable, Iterator
+import numpy as np
+
+DIGIT_COUNT = 10
+# Predictions are binned by confidence, in bins of 0.1, to compare each bin's accuracy to its mean confidence
+CONFIDENCE_BIN_COUNT = 10
+# How many submissions the rebuild reads from the store at once
+REBUILD_CHUNK_SIZE = 1000
+
+def confidence_bin(confidence: float) -> int:
+    return min(max(int(confidence * CONFIDENCE_BIN_COUNT), 0), CONFIDENCE_BIN_COUNT - 1)
+
+class ModelStats:
+    """
+    A count of a model's predictions, and the sum of their confidences, by label, predicted digit and confidence bin.
+    Each is a cell of a fixed size table, so the stats of any number of submissions take the same space,
+    and the stats of two sets of submissions are added together.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros((DIGIT_COUNT, DIGIT_COUNT, CONFIDENCE_BIN_COUNT), dtype=np.int64)
+        self.confidence_sums = np.zeros((DIGIT_COUNT, DIGIT_COUNT, CONFIDENCE_BIN_COUNT), dtype=np.float64)
+
+    def add_prediction(self, label: int, predicted_digit: int, confidence: float):
+        cell = (label, predicted_digit, confidence_bin(confidence))
+        self.counts[cell] += 1
+        self.confidence_sums[cell] += confidence
+
+    def add_cell(self, label: int, predicted_digit: int, confidence_bin: int, count: int, confidence_sum: float):
+        self.counts[label, predicted_digit, confidence_bin] += count
+        self.confidence_sums[label, predicted_digit, confidence_bin] += confidence_sum
+
+    def cells(self) -> Iterator[tuple[int, int, int, int, float]]:
+        """The (label, predicted_digit, confidence_bin, count, confidence_sum) of each cell with any predictions, in order"""
+        for (label, predicted_digit, confidence_bin) in zip(*np.nonzero(self.counts)):
+            cell = (label, predicted_digit, confidence_bin)
+            yield (int(label), int(predicted_digit), int(confidence_bin), int(self.counts[cell]), float(self.confidence_sums[cell]))
+
+    def copy(self) -> "ModelStats":
+        copied = ModelStats()
+        copied.counts[:] = self.counts
+        copied.confidence_sums[:] = self.confidence_sums
+        return copied
+
+    def __add__(self, other: "ModelStats") -> "ModelStats":
+        added = self.copy()
+        added.counts += other.counts
+        added.confidence_sums += other.confidence_sums
+        return added
+
+    def __sub__(self, other: "ModelStats") -> "ModelStats":
+        subtracted = self.copy()
+        subtracted.counts -= other.counts
+        subtracted.confidence_sums -= other.confidence_sums
+        return subtracted
+
+    def summary(self) -> dict:
+        count = int(self.counts.sum())
+        bin_counts = self.counts.sum(axis=(0, 1))
+        # The diagonal of the labels and predicted digits, as a confidence bin by digit array
+        bin_correct_counts = np.diagonal(self.counts).sum(axis=1)
+        bin_confidence_sums = self.confidence_sums.sum(axis=(0, 1))
+        calibration = [
+            {
+                "min_confidence": i / CONFIDENCE_BIN_COUNT,
+                "max_confidence": (i + 1) / CONFIDENCE_BIN_COUNT,
+                "count": int(bin_counts[i]),
+                "accuracy": float(bin_correct_counts[i] / bin_counts[i]) if bin_counts[i] > 0 else None,
+                "mean_confidence": float(bin_confidence_sums[i] / bin_counts[i]) if bin_counts[i] > 0 else None,
+            }
+            for i in range(CONFIDENCE_BIN_COUNT)
+        ]
+        return {
+            "count": count,
+            "accuracy": int(bin_correct_counts.sum()) / count if count > 0 else None,
+            # Rows are the labels, and columns the predicted digits
+            "confusion_matrix": self.counts.sum(axis=2).tolist(),
+            "calibration": calibration,
+            # The mean difference between each prediction's confidence and its bin's accuracy
+            "expected_calibration_error": float(np.abs(bin_correct_counts - bin_confidence_sums).sum() / count) if count > 0 else None,
+        }
+
+def model_stats_of(submissions: Iterable) -> dict[str, ModelStats]:
+    """The stats of the predictions of submissions (or rows with a label and predictions), by model"""
+    stats_by_model = {}
+    for submission in submissions:
+        for prediction in submission.predictions:
+            if not (0 <= prediction["predicted_digit"] < DIGIT_COUNT):
+                continue
+            if prediction["model"] not in stats_by_model:
+                stats_by_model[prediction["model"]] = ModelStats()
+            stats_by_model[prediction["model"]].add_prediction(submission.label, prediction["predicted_digit"], prediction["confidence"])
+    return stats_by_model
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-size", type=int, default=REBUILD_CHUNK_SIZE, help="How many submissions to read at once")
+    args = parser.parse_args()
+
+    from .submission_store import InMemorySubmissionStore, submission_store
+    if isinstance(submission_store, InMemorySubmissionStore):
+        raise SystemExit("Set DATABASE_URL to the database to rebuild the stats of: the in-memory store only lives as long as the api")
+
+    started_at = time.perf_counter()
+
+    def on_chunk(scanned_count: int):
+        print(f"Read {scanned_count:,} submissions in {time.perf_counter() - started_at:.1f}s", flush=True)
+
+    scanned_count = submission_store.rebuild_model_stats(args.chunk_size, on_chunk)
+    print(f"Rebuilt the model stats from {scanned_count:,} submissions in {time.perf_counter() - started_at:.1f}s")
+    for (model_name, stats) in sorted(submission_store.get_model_stats().items()):
+        summary = stats.summary()
+        print(f"  {model_name:<12} {summary['count']:>10,} predictions, accuracy {summary['accuracy']:.2%}")
+
+if __name__ == "__main__":
+    main()
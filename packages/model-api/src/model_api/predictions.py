@@ -1,7 +1,21 @@
-from typing import List
+from typing import Hashable, List
+import concurrent.futures
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
 import numpy as np
+import torch
 from model import FirstModel, SecondModel
+from model.digit_model import DigitModelBase, packaged_weights_version, test_time_augmentations
+from model.export import load_inference_model
+from model.quantization import load_quantized_model, quantized_weights_version
 from dataclasses import dataclass
+from .config import load_env_int, load_env_float, load_env_string_or_default
+from .model_registry import ModelRegistry
+from .instrumentation import batch_profiler, cascade_digits, model_batch_digits, model_seconds, models_skipped, time_stage
 
 @dataclass
 class PredictionClassification:
@@ -9,17 +23,17 @@ class PredictionClassification:
     predicted_digit: int
     """Confidence in prediction, between 0 and 1"""
     confidence: float
+    """For an ensemble, the models it combined, and for the cascade, the models it ran"""
+    combined_models: tuple[str, ...] | None = None
+    """The (model, weights version) of each model it was made with, which it's cached under"""
+    weights_versions: tuple[tuple[str, str], ...] = ()
 
 @dataclass
 class PredictionDigitData:
     pixels: np.array
 
-    def create_predictions(self) -> List[PredictionClassification]:
-        return [
-            # predict_random(self),
-            predict_cnn_v1(self),
-            predict_cnn_v2(self),
-        ]
+    def create_predictions(self, model_names: tuple[str, ...] | None = None) -> List[PredictionClassification]:
+        return create_predictions_batch([PredictionRequest(self, model_names or DEFAULT_MODEL_NAMES)])[0]
 
 def predict_random(data: PredictionDigitData) -> PredictionClassification:
     # Uses the whole image data to seed the RNG to make it deterministic
@@ -31,24 +45,640 @@ def predict_random(data: PredictionDigitData) -> PredictionClassification:
         confidence=0.1,
     )
 
-first_model = FirstModel()
+# One of eager, torchscript or onnxruntime (if installed); see model.export
+MODEL_RUNTIME = load_env_string_or_default("MODEL_RUNTIME", "torchscript")
+
+# Versioned checkpoints of cnn-v1 and cnn-v2 are loaded from here, if set; see ModelRegistry
+MODEL_CHECKPOINT_DIR = load_env_string_or_default("MODEL_CHECKPOINT_DIR", "")
+MODEL_WATCH_INTERVAL_SECONDS = load_env_float("MODEL_WATCH_INTERVAL_SECONDS", 5.0)
+
+model_registry = ModelRegistry(
+    checkpoint_dir=Path(MODEL_CHECKPOINT_DIR) if MODEL_CHECKPOINT_DIR != "" else None,
+    retained_versions=load_env_int("MODEL_RETAINED_VERSIONS", 1),
+)
+model_registry.register(
+    "cnn-v1",
+    lambda: load_inference_model(FirstModel, MODEL_RUNTIME),
+    lambda: packaged_weights_version(FirstModel.weights_filename),
+    lambda weights_path: load_inference_model(FirstModel, MODEL_RUNTIME, weights_path),
+)
+model_registry.register(
+    "cnn-v2",
+    lambda: load_inference_model(SecondModel, MODEL_RUNTIME),
+    lambda: packaged_weights_version(SecondModel.weights_filename),
+    lambda weights_path: load_inference_model(SecondModel, MODEL_RUNTIME, weights_path),
+)
+# int8 variants for CPU inference, of the packaged weights; see model.quantization
+model_registry.register(
+    "cnn-v1-int8",
+    lambda: load_quantized_model(FirstModel),
+    lambda: quantized_weights_version(FirstModel),
+)
+model_registry.register(
+    "cnn-v2-int8",
+    lambda: load_quantized_model(SecondModel),
+    lambda: quantized_weights_version(SecondModel),
+)
+
+@dataclass
+class CnnPredictor:
+    model_name: str
+    temperature: float
+    scale: bool
+
+    @property
+    def model(self) -> DigitModelBase:
+        """Loads the model on first use"""
+        return model_registry.get(self.model_name)
+
+    @property
+    def members(self) -> tuple[str, ...]:
+        return (self.model_name,)
+
+    def cache_key(self, pixels_hash: bytes, weights_versions: dict[str, str]) -> Hashable:
+        # The weights version means predictions from replaced weights are never returned
+        return (pixels_hash, self.model_name, self.temperature, weights_versions[self.model_name])
+
+    def predict(self, data: PredictionDigitData) -> PredictionClassification:
+        return self.predict_batch([data])[0]
+
+    def predict_batch(self, batch: List[PredictionDigitData]) -> List[PredictionClassification]:
+        return self.predict_pixels(stack_pixels(batch))
+
+    def predict_pixels(self, pixels: np.ndarray) -> List[PredictionClassification]:
+        """Runs an N x 28 x 28 array of digits through the model in a single forward pass"""
+        model = self.model
+        return self.predictions(self.probabilities(DigitModelBase.pixels_tensor(pixels, self.scale), model), model.weights_version)
+
+    def probabilities(self, image_batch: torch.Tensor, model: DigitModelBase | None = None) -> np.ndarray:
+        """
+        Runs an N x 1 x 28 x 28 batch (see shared_image_batches) through the model, returning N x 10 digit probabilities.
+        Pass the model to run several batches with the same weights, even if they're swapped meanwhile.
+        """
+        model = model if model is not None else self.model
+        model_batch_digits.observe(len(image_batch), self.model_name)
+        with model_seconds.time(self.model_name):
+            return model.probabilities_from_tensor(image_batch, self.temperature).numpy()
+
+    def augmented_probabilities(self, image_batch: torch.Tensor, augmentations: tuple[tuple[float, float, float], ...], model: DigitModelBase | None = None) -> np.ndarray:
+        """Like probabilities, but averaged over test-time augmentations of each digit, all run as one batch"""
+        model = model if model is not None else self.model
+        model_batch_digits.observe(len(image_batch) * len(augmentations), self.model_name)
+        with model_seconds.time(self.model_name):
+            return model.augmented_probabilities_from_tensor(image_batch, self.temperature, augmentations).numpy()
+
+    def predictions(self, probabilities: np.ndarray, weights_version: str) -> List[PredictionClassification]:
+        return [
+            PredictionClassification(
+                model=self.model_name,
+                predicted_digit=predicted_digit,
+                confidence=confidence,
+                weights_versions=((self.model_name, weights_version),),
+            )
+            for (predicted_digit, confidence) in DigitModelBase.top_predictions(probabilities)
+        ]
+
+cnn_v1 = CnnPredictor(model_name="cnn-v1", temperature=0.1, scale=False)
 
 def predict_cnn_v1(data: PredictionDigitData) -> PredictionClassification:
-    from PIL import Image
-    (predicted_digit, confidence) = first_model.predict(Image.fromarray(data.pixels), 0.1, scale=False)
-    return PredictionClassification(
-        model="cnn-v1",
-        predicted_digit=predicted_digit,
-        confidence=confidence,
-    )
+    return cnn_v1.predict(data)
 
-second_model = SecondModel()
+cnn_v2 = CnnPredictor(model_name="cnn-v2", temperature=0.4, scale=True)
 
 def predict_cnn_v2(data: PredictionDigitData) -> PredictionClassification:
-    from PIL import Image
-    (predicted_digit, confidence) = second_model.predict(Image.fromarray(data.pixels), 0.4, scale=True)
-    return PredictionClassification(
-        model="cnn-v2",
-        predicted_digit=predicted_digit,
-        confidence=confidence,
-    )
\ No newline at end of file
+    return cnn_v2.predict(data)
+
+cnn_v1_int8 = CnnPredictor(model_name="cnn-v1-int8", temperature=0.1, scale=False)
+cnn_v2_int8 = CnnPredictor(model_name="cnn-v2-int8", temperature=0.4, scale=True)
+
+predictors = {
+    predictor.model_name: predictor
+    for predictor in [cnn_v1, cnn_v2, cnn_v1_int8, cnn_v2_int8]
+}
+
+@dataclass
+class ModelOutputs:
+    """Each model's probabilities for the digits it was run over, as an array with a row of 10 per digit"""
+    probabilities: dict[str, np.ndarray]
+    """For each model, the row of each digit it was run over, keyed by the digit's index in the batch"""
+    rows: dict[str, dict[int, int]]
+    """The models which finished in time for each digit of the batch"""
+    completed_models: List[set[str]]
+    """The weights version each model ran with"""
+    weights_versions: dict[str, str]
+
+@dataclass
+class EnsemblePredictor:
+    """Predicts from the weighted average of its member models' digit probabilities"""
+    model_name: str
+    """The weight of each member model"""
+    weights: dict[str, float]
+
+    @property
+    def members(self) -> tuple[str, ...]:
+        return tuple(self.weights)
+
+    def cache_key(self, pixels_hash: bytes, weights_versions: dict[str, str]) -> Hashable:
+        return (
+            pixels_hash,
+            self.model_name,
+            tuple(self.weights.items()),
+            tuple((member, predictors[member].temperature, weights_versions[member]) for member in self.weights),
+        )
+
+    def combine(self, digits: List[int], outputs: ModelOutputs) -> List[PredictionClassification | None]:
+        """
+        Combines the members which finished in time for each of the given digits of the batch,
+        or returns None for a digit if none of them did.
+        """
+        combined = [None] * len(digits)
+        # Digits with the same members are combined together, as one vectorized weighted sum
+        groups: dict[tuple[str, ...], List[tuple[int, int]]] = {}
+        for (position, i) in enumerate(digits):
+            members = tuple(member for member in self.weights if member in outputs.completed_models[i])
+            groups.setdefault(members, []).append((position, i))
+        for (members, group) in groups.items():
+            if len(members) == 0:
+                continue
+            total_weight = sum(self.weights[member] for member in members)
+            probabilities = sum(
+                outputs.probabilities[member][[outputs.rows[member][i] for (_position, i) in group]] * (self.weights[member] / total_weight)
+                for member in members
+            )
+            for ((position, _i), (predicted_digit, confidence)) in zip(group, DigitModelBase.top_predictions(probabilities)):
+                combined[position] = PredictionClassification(
+                    model=self.model_name,
+                    predicted_digit=predicted_digit,
+                    confidence=confidence,
+                    combined_models=members,
+                    weights_versions=tuple((member, outputs.weights_versions[member]) for member in members),
+                )
+        return combined
+
+def parse_ensemble_weights(weights: str) -> dict[str, float]:
+    """Parses comma separated model=weight pairs, e.g. cnn-v1=1,cnn-v2=2"""
+    parsed = {}
+    for pair in weights.split(","):
+        (model_name, _, weight) = pair.partition("=")
+        model_name = model_name.strip()
+        if model_name not in predictors:
+            raise ValueError(f"Unknown ensemble model {model_name!r}, expected some of {', '.join(predictors)}")
+        try:
+            parsed[model_name] = float(weight) if weight.strip() != "" else 1.0
+        except ValueError as e:
+            raise ValueError(f"Ensemble weight of {model_name} must be a number, got {weight!r}") from e
+        if parsed[model_name] <= 0:
+            raise ValueError(f"Ensemble weight of {model_name} must be positive, got {weight!r}")
+    return parsed
+
+ENSEMBLE_MODEL_NAME = "ensemble"
+ensemble = EnsemblePredictor(
+    model_name=ENSEMBLE_MODEL_NAME,
+    weights=parse_ensemble_weights(load_env_string_or_default("ENSEMBLE_WEIGHTS", "cnn-v1=1,cnn-v2=1")),
+)
+
+@dataclass
+class CascadePredictor:
+    """
+    Predicts with the cheap first model where it's confident, and escalates the other digits to the second model,
+    averaging its probabilities over test-time augmentations of each digit, so most digits only need the first.
+    """
+    model_name: str
+    first: str
+    second: str
+    """The first model's confidence, below which a digit is escalated"""
+    threshold: float
+    """The (rotation, x shift, y shift) of each augmentation run through the second model; see model.digit_model"""
+    augmentations: tuple[tuple[float, float, float], ...]
+
+    @property
+    def members(self) -> tuple[str, ...]:
+        return (self.first, self.second)
+
+    def cache_key(self, pixels_hash: bytes, weights_versions: dict[str, str]) -> Hashable:
+        return (
+            pixels_hash,
+            self.model_name,
+            self.threshold,
+            self.augmentations,
+            tuple((member, predictors[member].temperature, weights_versions[member]) for member in (self.first, self.second)),
+        )
+
+    def run(self, pixels: np.ndarray, digits: List[int], deadlines: List[float | None], outputs: ModelOutputs) -> List[PredictionClassification | None]:
+        """
+        Predicts the given digits of an N x 28 x 28 array from the first model's outputs, running the second model
+        over those the first isn't confident about. Digits past their deadline aren't escalated, and if the first
+        model didn't finish in time for a digit, it gets None.
+        """
+        predictions = [None] * len(digits)
+        answered = [(position, i) for (position, i) in enumerate(digits) if self.first in outputs.completed_models[i]]
+        if len(answered) == 0:
+            return predictions
+        probabilities = outputs.probabilities[self.first][[outputs.rows[self.first][i] for (_position, i) in answered]]
+        unconfident = np.flatnonzero(probabilities.max(axis=1) < self.threshold)
+        now = time.monotonic()
+        escalated = [row for row in unconfident if deadlines[answered[row][1]] is None or deadlines[answered[row][1]] > now]
+        cascade_digits.inc("confident", amount=len(answered) - len(unconfident))
+        cascade_digits.inc("escalated", amount=len(escalated))
+        cascade_digits.inc("past_deadline", amount=len(unconfident) - len(escalated))
+        members = [(self.first,)] * len(answered)
+        weights_versions = {self.first: outputs.weights_versions[self.first]}
+        if escalated:
+            second = predictors[self.second]
+            second_model = second.model
+            weights_versions[self.second] = second_model.weights_version
+            image_batch = DigitModelBase.pixels_tensor(pixels[[answered[row][1] for row in escalated]], second.scale)
+            probabilities = probabilities.copy()
+            probabilities[escalated] = second.augmented_probabilities(image_batch, self.augmentations, second_model)
+            for row in escalated:
+                members[row] = (self.first, self.second)
+        for (row, (predicted_digit, confidence)) in enumerate(DigitModelBase.top_predictions(probabilities)):
+            predictions[answered[row][0]] = PredictionClassification(
+                model=self.model_name,
+                predicted_digit=predicted_digit,
+                confidence=confidence,
+                combined_models=members[row],
+                weights_versions=tuple((member, weights_versions[member]) for member in members[row]),
+            )
+        return predictions
+
+    def is_complete(self, prediction: PredictionClassification) -> bool:
+        """Whether the prediction wasn't cut short by a deadline, so can be cached"""
+        return prediction.combined_models == (self.first, self.second) or prediction.confidence >= self.threshold
+
+def parse_cascade_models(model_names: str) -> tuple[str, str]:
+    """Parses the comma separated first and second models of the cascade, e.g. cnn-v1,cnn-v2"""
+    parsed = tuple(name.strip() for name in model_names.split(","))
+    if len(parsed) != 2:
+        raise ValueError(f"The cascade needs a first and second model, got {model_names!r}")
+    for model_name in parsed:
+        if model_name not in predictors:
+            raise ValueError(f"Unknown cascade model {model_name!r}, expected some of {', '.join(predictors)}")
+    return parsed
+
+CASCADE_MODEL_NAME = "cascade"
+(cascade_first, cascade_second) = parse_cascade_models(load_env_string_or_default("CASCADE_MODELS", "cnn-v1,cnn-v2"))
+cascade = CascadePredictor(
+    model_name=CASCADE_MODEL_NAME,
+    first=cascade_first,
+    second=cascade_second,
+    threshold=load_env_float("CASCADE_THRESHOLD", 0.5),
+    augmentations=test_time_augmentations(
+        shift_pixels=load_env_float("TTA_SHIFT_PIXELS", 1.0),
+        rotation_degrees=load_env_float("TTA_ROTATION_DEGREES", 10.0),
+    ),
+)
+
+# Every model which can be requested: the ensemble runs its members, even if they weren't requested themselves,
+# and the cascade runs its first model, then its second only for the digits which need it
+MODEL_NAMES = (*predictors, ENSEMBLE_MODEL_NAME, CASCADE_MODEL_NAME)
+# The models which predict each digit unless the request picks others, if DEFAULT_MODELS isn't set
+_PACKAGED_DEFAULT_MODELS = "cnn-v1,cnn-v2"
+
+def parse_model_names(model_names: str | None) -> tuple[str, ...]:
+    """Parses a comma separated list of model names, defaulting to DEFAULT_MODEL_NAMES"""
+    if model_names is None or model_names.strip() == "":
+        return DEFAULT_MODEL_NAMES
+    parsed = tuple(dict.fromkeys(name.strip() for name in model_names.split(",") if name.strip() != ""))
+    unknown = [name for name in parsed if name not in MODEL_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown model(s) {', '.join(unknown)}, expected some of {', '.join(MODEL_NAMES)}")
+    return parsed
+
+DEFAULT_MODEL_NAMES = parse_model_names(load_env_string_or_default("DEFAULT_MODELS", _PACKAGED_DEFAULT_MODELS))
+
+def models_to_run(model_names: tuple[str, ...]) -> List[str]:
+    """The models which need to be run together to predict with the given models, including the ensemble's members"""
+    names = []
+    for model_name in model_names:
+        if model_name == ENSEMBLE_MODEL_NAME:
+            names += list(ensemble.weights)
+        elif model_name == CASCADE_MODEL_NAME:
+            names.append(cascade.first)
+        else:
+            names.append(model_name)
+    return list(dict.fromkeys(names))
+
+@dataclass
+class PredictionRequest:
+    data: PredictionDigitData
+    model_names: tuple[str, ...] = DEFAULT_MODEL_NAMES
+    """A time.monotonic() time, after which models which haven't finished are left out of the predictions"""
+    deadline: float | None = None
+
+def stack_pixels(batch: List[PredictionDigitData]) -> np.ndarray:
+    return np.stack([x.pixels for x in batch])
+
+def shared_image_batches(pixels: np.ndarray, scales: set[bool]) -> dict[bool, torch.Tensor]:
+    """Preprocesses an N x 28 x 28 array of digits once for every model, keyed by whether the model scales its inputs"""
+    image_batch = DigitModelBase.pixels_tensor(pixels, scale=False)
+    image_batches = {False: image_batch}
+    if True in scales:
+        image_batches[True] = image_batch / 255.0
+    return image_batches
+
+# Each inference worker runs up to model_parallelism of a batch's models at once, on its own pool of threads,
+# each with torch_threads intra-op threads, so a request takes as long as its slowest model, rather than all of them.
+# Set for each worker by configure_model_threads, and until then, the models run one after another.
+_model_threads = threading.local()
+
+def configure_model_threads(parallelism: int, torch_threads: int):
+    """Sizes the calling inference worker's pool of model threads, e.g. from its share of the cores"""
+    _model_threads.parallelism = parallelism
+    _model_threads.torch_threads = torch_threads
+    _model_threads.executor = None
+
+def model_parallelism() -> int:
+    return getattr(_model_threads, "parallelism", 1)
+
+def model_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """The calling inference worker's pool of model threads, only created on first use"""
+    if getattr(_model_threads, "executor", None) is None:
+        _model_threads.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=model_parallelism(),
+            thread_name_prefix="model",
+            initializer=torch.set_num_threads,
+            initargs=(_model_threads.torch_threads,),
+        )
+    return _model_threads.executor
+
+# Batches with a deadline run each model this many digits at a time, so a model which no digit is waiting for any more
+# stops after its current chunk, rather than holding its thread (and delaying the worker's next batch) until it finishes.
+# Smaller chunks stop sooner, but make less efficient forward passes.
+DEADLINE_CHUNK_SIZE = load_env_int("DEADLINE_CHUNK_SIZE", 8)
+
+def run_models(pixels: np.ndarray, indices_by_model: dict[str, List[int]], deadlines: List[float | None]) -> ModelOutputs:
+    """
+    Runs each model over the digits at its indices of an N x 28 x 28 array, all from one preprocessed batch.
+
+    The models run concurrently, unless the worker's model parallelism is 1. There is a deadline per digit (or None),
+    and a digit only gets the probabilities of the models which finished by its deadline, or if none did,
+    of the first of its models to finish. Models which no digit is waiting for any more are stopped
+    after their current chunk (see DEADLINE_CHUNK_SIZE), or not started.
+    """
+    with time_stage("preprocess"):
+        image_batches = shared_image_batches(pixels, {predictors[model_name].scale for model_name in indices_by_model})
+    chunk_size = len(pixels) if all(deadline is None for deadline in deadlines) else max(1, DEADLINE_CHUNK_SIZE)
+    # Set once every digit has its results, so models still running can stop
+    abandoned = threading.Event()
+
+    def run(model_name: str) -> np.ndarray | None:
+        indices = indices_by_model[model_name]
+        image_batch = image_batches[predictors[model_name].scale]
+        if len(indices) != len(pixels):
+            image_batch = image_batch[indices]
+        # Every chunk runs with the same weights, even if they're swapped meanwhile
+        model = predictors[model_name].model
+        outputs.weights_versions[model_name] = model.weights_version
+        chunks = []
+        for start in range(0, len(image_batch), chunk_size):
+            if abandoned.is_set():
+                return None
+            chunks.append(predictors[model_name].probabilities(image_batch[start:start + chunk_size], model))
+        return np.concatenate(chunks)
+
+    outputs = ModelOutputs(
+        probabilities={},
+        rows={model_name: {i: row for (row, i) in enumerate(indices)} for (model_name, indices) in indices_by_model.items()},
+        completed_models=[set() for _ in deadlines],
+        weights_versions={},
+    )
+    if len(indices_by_model) == 1 or model_parallelism() == 1:
+        # One model at a time, on this thread, which already has the worker's share of the cores
+        for (model_name, indices) in indices_by_model.items():
+            now = time.monotonic()
+            if all(deadlines[i] is not None and now > deadlines[i] and len(outputs.completed_models[i]) > 0 for i in indices):
+                # Every digit already has a model's results, and is past its deadline
+                models_skipped.inc(model_name, amount=len(indices))
+                continue
+            outputs.probabilities[model_name] = run(model_name)
+            finished_at = time.monotonic()
+            for i in indices:
+                # A digit always waits for at least one model
+                if deadlines[i] is None or finished_at <= deadlines[i] or len(outputs.completed_models[i]) == 0:
+                    outputs.completed_models[i].add(model_name)
+                else:
+                    models_skipped.inc(model_name)
+        return outputs
+
+    futures = {model_name: model_executor().submit(run, model_name) for model_name in indices_by_model}
+    # Digits with the same deadline and models get the same results
+    groups: dict[tuple[float | None, tuple[str, ...]], List[int]] = {}
+    for (i, deadline) in enumerate(deadlines):
+        model_names = tuple(model_name for model_name in indices_by_model if i in outputs.rows[model_name])
+        groups.setdefault((deadline, model_names), []).append(i)
+    # The earliest deadlines first, whilst the models keep running for the later ones
+    for ((deadline, model_names), digits) in sorted(groups.items(), key=lambda group: math.inf if group[0][0] is None else group[0][0]):
+        group_futures = [futures[model_name] for model_name in model_names]
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        (done, _) = concurrent.futures.wait(group_futures, timeout=timeout)
+        if len(done) == 0:
+            (done, _) = concurrent.futures.wait(group_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for model_name in model_names:
+            if futures[model_name] in done:
+                outputs.probabilities[model_name] = futures[model_name].result()
+                for i in digits:
+                    outputs.completed_models[i].add(model_name)
+            else:
+                models_skipped.inc(model_name, amount=len(digits))
+    # No digit is waiting for the models any more, so those which haven't started are cancelled, and the rest stop
+    abandoned.set()
+    for future in futures.values():
+        future.cancel()
+    return outputs
+
+def run_cascade(pixels: np.ndarray, model_names_by_digit: List[tuple[str, ...]], deadlines: List[float | None], outputs: ModelOutputs) -> dict[int, PredictionClassification]:
+    """The cascade's prediction for each digit which requested it, keyed by the digit's index in the batch"""
+    digits = [i for (i, model_names) in enumerate(model_names_by_digit) if CASCADE_MODEL_NAME in model_names]
+    if len(digits) == 0:
+        return {}
+    return {
+        i: prediction
+        for (i, prediction) in zip(digits, cascade.run(pixels, digits, deadlines, outputs))
+        if prediction is not None
+    }
+
+def predictions_from_outputs(model_names_by_digit: List[tuple[str, ...]], outputs: ModelOutputs, cascade_predictions: dict[int, PredictionClassification]) -> List[List[PredictionClassification]]:
+    """The predictions of the requested models for each digit, leaving out any which didn't finish in time"""
+    predictions_by_digit = [{} for _ in model_names_by_digit]
+    for (model_name, probabilities) in outputs.probabilities.items():
+        predictions = predictors[model_name].predictions(probabilities, outputs.weights_versions[model_name])
+        for ((i, row), prediction) in zip(outputs.rows[model_name].items(), predictions):
+            if model_name in outputs.completed_models[i]:
+                predictions_by_digit[i][model_name] = prediction
+    ensemble_digits = [i for (i, model_names) in enumerate(model_names_by_digit) if ENSEMBLE_MODEL_NAME in model_names]
+    if ensemble_digits:
+        for (i, prediction) in zip(ensemble_digits, ensemble.combine(ensemble_digits, outputs)):
+            if prediction is not None:
+                predictions_by_digit[i][ENSEMBLE_MODEL_NAME] = prediction
+    for (i, prediction) in cascade_predictions.items():
+        predictions_by_digit[i][CASCADE_MODEL_NAME] = prediction
+    return [
+        [predictions[model_name] for model_name in model_names if model_name in predictions]
+        for (model_names, predictions) in zip(model_names_by_digit, predictions_by_digit)
+    ]
+
+def create_predictions_batch(batch: List[PredictionRequest]) -> List[List[PredictionClassification]]:
+    """
+    Runs each model once (concurrently), over the digits in the batch which asked for that model,
+    and returns the list of predictions for each request of the batch, in order.
+    """
+    pixels = stack_pixels([request.data for request in batch])
+    indices_by_model = {}
+    for (i, request) in enumerate(batch):
+        for model_name in models_to_run(request.model_names):
+            indices_by_model.setdefault(model_name, []).append(i)
+    model_names_by_digit = [request.model_names for request in batch]
+    deadlines = [request.deadline for request in batch]
+    with batch_profiler.maybe_profile("batch"):
+        outputs = run_models(pixels, indices_by_model, deadlines)
+        cascade_predictions = run_cascade(pixels, model_names_by_digit, deadlines, outputs)
+    with time_stage("postprocess"):
+        return predictions_from_outputs(model_names_by_digit, outputs, cascade_predictions)
+
+def create_predictions_for_pixels(pixels: np.ndarray, model_names: tuple[str, ...] = DEFAULT_MODEL_NAMES) -> List[List[PredictionClassification]]:
+    """
+    Runs each model once (concurrently) over an N x 28 x 28 uint8 array of digits,
+    and returns the list of predictions for each digit, in order.
+    """
+    indices = list(range(len(pixels)))
+    model_names_by_digit = [model_names] * len(pixels)
+    deadlines = [None] * len(pixels)
+    with batch_profiler.maybe_profile("bulk"):
+        outputs = run_models(pixels, {model_name: indices for model_name in models_to_run(model_names)}, deadlines)
+        cascade_predictions = run_cascade(pixels, model_names_by_digit, deadlines, outputs)
+    with time_stage("postprocess"):
+        return predictions_from_outputs(model_names_by_digit, outputs, cascade_predictions)
+
+class PredictionCache:
+    """
+    A thread-safe LRU cache of predictions, holding at most max_entries predictions,
+    each for at most ttl_seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Hashable, tuple[float, PredictionClassification]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def hash_pixels(pixels: np.ndarray) -> bytes:
+        return hashlib.blake2b(np.ascontiguousarray(pixels).tobytes(), digest_size=16).digest()
+
+    def get(self, key: Hashable) -> PredictionClassification | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, prediction: PredictionClassification):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, prediction)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_model(self, model_name: str):
+        """Drops all predictions from the given model, e.g. after its weights are replaced"""
+        with self._lock:
+            stale_keys = [key for key in self._entries if key[1] == model_name]
+            for key in stale_keys:
+                del self._entries[key]
+            self.evictions += len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+            }
+
+# Each entry is a small dataclass, so the default bounds the cache to a few MB
+prediction_cache = PredictionCache(
+    max_entries=load_env_int("PREDICTION_CACHE_MAX_ENTRIES", 10_000),
+    ttl_seconds=load_env_float("PREDICTION_CACHE_TTL_SECONDS", 3600.0),
+)
+
+def invalidate_predictions(model_name: str):
+    """Drops the cached predictions of a model whose version was swapped, and of the ensemble or cascade using it"""
+    prediction_cache.invalidate_model(model_name)
+    if model_name in ensemble.weights:
+        prediction_cache.invalidate_model(ENSEMBLE_MODEL_NAME)
+    if model_name in (cascade.first, cascade.second):
+        prediction_cache.invalidate_model(CASCADE_MODEL_NAME)
+
+model_registry.add_swap_listener(invalidate_predictions)
+
+def predictor_for(model_name: str) -> CnnPredictor | EnsemblePredictor | CascadePredictor:
+    if model_name == ENSEMBLE_MODEL_NAME:
+        return ensemble
+    if model_name == CASCADE_MODEL_NAME:
+        return cascade
+    return predictors[model_name]
+
+def get_cached_predictions(request: PredictionRequest) -> List[PredictionClassification] | None:
+    """
+    Returns the predictions of every requested model if they are all cached, else None.
+    They're looked up by the weights versions this process last saw, so with the process executor, for up to
+    MODEL_WATCH_INTERVAL_SECONDS after a swap, they may still be the previous weights' predictions.
+    """
+    if prediction_cache.max_entries <= 0:
+        return None
+    pixels_hash = PredictionCache.hash_pixels(request.data.pixels)
+    predictions = []
+    for model_name in request.model_names:
+        predictor = predictor_for(model_name)
+        weights_versions = {member: model_registry.weights_version(member) for member in predictor.members}
+        prediction = prediction_cache.get(predictor.cache_key(pixels_hash, weights_versions))
+        if prediction is None:
+            return None
+        predictions.append(prediction)
+    return predictions
+
+def cache_predictions(request: PredictionRequest, predictions: List[PredictionClassification]):
+    """
+    Caches the predictions under the weights versions they were made with, which, if they were swapped meanwhile
+    (or with the process executor, the worker hasn't swapped them yet), may not be the versions they're looked up by
+    """
+    if prediction_cache.max_entries <= 0:
+        return
+    pixels_hash = PredictionCache.hash_pixels(request.data.pixels)
+    for prediction in predictions:
+        if prediction.model == ENSEMBLE_MODEL_NAME:
+            # Unless some members missed the deadline, and weren't combined
+            if prediction.combined_models != tuple(ensemble.weights):
+                continue
+        elif prediction.model == CASCADE_MODEL_NAME:
+            if not cascade.is_complete(prediction):
+                continue
+        predictor = predictor_for(prediction.model)
+        # The cascade's second model doesn't affect the digits it wasn't run on
+        weights_versions = {member: model_registry.weights_version(member) for member in predictor.members} | dict(prediction.weights_versions)
+        prediction_cache.put(predictor.cache_key(pixels_hash, weights_versions), prediction)
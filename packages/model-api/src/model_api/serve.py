@@ -0,0 +1,120 @@
+"""
+Serves the api from WEB_WORKERS worker processes, forked from a parent which has already loaded every model,
+so that the workers share the models' weights copy-on-write, rather than each loading their own copy.
+
+The parent binds the socket and loads the models, then forks the workers, which each run uvicorn on the
+shared socket (so the kernel spreads connections between them). It restarts any worker which dies,
+and stops them all gracefully on SIGTERM or SIGINT.
+
+Each worker has its own batching, prediction cache and /metrics, and without a DATABASE_URL,
+its own in-memory submissions, so use a database with more than one worker.
+
+Run with: uv run --package model-api python -m model_api.serve --host 0.0.0.0 --port 8000
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    return sock
+
+def preload_app():
+    """Imports the api and loads its models, without starting any threads, which wouldn't survive a fork"""
+    import torch
+    # Otherwise torch starts its intra-op thread pool on first use, and a forked worker would hang using it
+    torch.set_num_threads(1)
+    from .main import app
+    from .predictions import model_registry
+    model_registry.warm_up()
+    # Objects which already exist are never collected, so the garbage collector doesn't write to them,
+    # which would copy the pages they're on into every worker
+    gc.collect()
+    gc.freeze()
+    return app
+
+def run_worker(app, sock: socket.socket, log_level: str):
+    import random
+    import torch
+    import uvicorn
+    from .inference import INFERENCE_TORCH_THREADS
+    # Forked from the parent, so undo its signal handlers (uvicorn installs its own) and random state
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    random.seed()
+    torch.set_num_threads(INFERENCE_TORCH_THREADS)
+    uvicorn.Server(uvicorn.Config(app, log_level=log_level)).run(sockets=[sock])
+
+def serve(workers: int, host: str, port: int, log_level: str):
+    sock = bind_socket(host, port)
+    app = preload_app()
+    if workers <= 1:
+        run_worker(app, sock, log_level)
+        return
+
+    worker_pids = set()
+    stopping = False
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                run_worker(app, sock, log_level)
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)
+        worker_pids.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        start_worker()
+    print(f"Serving on {host}:{port} with {workers} workers: {', '.join(str(pid) for pid in sorted(worker_pids))}", flush=True)
+
+    while worker_pids:
+        try:
+            (pid, status) = os.wait()
+        except ChildProcessError:
+            break
+        worker_pids.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting it", file=sys.stderr, flush=True)
+            # Don't spin if workers keep failing on startup
+            time.sleep(1)
+            start_worker()
+    sock.close()
+
+def main():
+    from .config import load_env_int
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=load_env_int("WEB_WORKERS", 1), help="Defaults to WEB_WORKERS")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    # Before the api is imported, so each worker's share of the cores is derived from it
+    os.environ["WEB_WORKERS"] = str(args.workers)
+    serve(args.workers, args.host, args.port, args.log_level)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Exports the stored submissions as a dataset of digits and labels, for retraining the models.
+
+The api streams the submissions from /submissions/export.npy as a single .npy array of EXPORT_DTYPE records,
+decoding their images a chunk at a time. This downloads that stream into a new part of the output directory,
+as memory-mappable .npy files: images.npy (N x 28 x 28 uint8, white background), labels.npy, ids.npy and timestamps.npy.
+Each run only exports the submissions added since the last part, so re-running it keeps the export up to date.
+
+Run with: uv run --package model-api python -m model_api.submission_export --output-dir ./exports
+"""
+import argparse
+import datetime
+import io
+import re
+import shutil
+from pathlib import Path
+from typing import Iterator
+import numpy as np
+
+from .wire_formats import DIGIT_SHAPE, decode_stored_pixels
+
+EXPORT_DTYPE = np.dtype([
+    ("id", "<i8"),
+    ("timestamp", "<M8[us]"),
+    ("label", "u1"),
+    ("pixels", "u1", DIGIT_SHAPE),
+])
+# How many submissions are read from the store, and decoded, at once
+EXPORT_CHUNK_SIZE = 1000
+
+def to_records(rows: list) -> np.ndarray:
+    """Converts rows with an id, timestamp, label, deflated_pixels and png_bytes to EXPORT_DTYPE records"""
+    records = np.empty(len(rows), dtype=EXPORT_DTYPE)
+    for (record, row) in zip(records, rows):
+        # Timestamps are in UTC, but may or may not have a timezone attached
+        timestamp = row.timestamp.astimezone(datetime.UTC) if row.timestamp.tzinfo is not None else row.timestamp
+        record["id"] = row.id
+        record["timestamp"] = np.datetime64(timestamp.replace(tzinfo=None), "us")
+        record["label"] = row.label
+        record["pixels"] = decode_stored_pixels(row.deflated_pixels, row.png_bytes)[0]
+    return records
+
+def npy_header(count: int) -> bytes:
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buffer, {
+        "descr": np.lib.format.dtype_to_descr(EXPORT_DTYPE),
+        "fortran_order": False,
+        "shape": (count,),
+    })
+    return buffer.getvalue()
+
+def npy_size(count: int) -> int:
+    return len(npy_header(count)) + count * EXPORT_DTYPE.itemsize
+
+def stream_npy(count: int, chunks: Iterator[list]) -> Iterator[bytes]:
+    """Streams a .npy array of count EXPORT_DTYPE records, converting a chunk of rows at a time"""
+    yield npy_header(count)
+    streamed_count = 0
+    for chunk in chunks:
+        streamed_count += len(chunk)
+        if streamed_count > count:
+            raise RuntimeError(f"The export had more than the {count} submissions it was sized for")
+        yield to_records(chunk).tobytes()
+    if streamed_count < count:
+        raise RuntimeError(f"The export had {streamed_count} of the {count} submissions it was sized for")
+
+class _StreamReader:
+    """A file-like view of an iterator of byte chunks, for numpy's header parsing"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise EOFError(f"The export ended {size - len(self.buffer)} bytes early")
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+PART_PATTERN = re.compile(r"^part-(\d+)-(\d+)$")
+
+def last_exported_id(output_dir: Path) -> int:
+    """The id up to which submissions have been exported to output_dir, by previous parts"""
+    up_to_ids = [int(match.group(2)) for match in (PART_PATTERN.match(x.name) for x in output_dir.iterdir() if x.is_dir()) if match]
+    return max(up_to_ids, default=0)
+
+def download_export(api_url: str, output_dir: Path, after_id: int, since: datetime.datetime | None) -> Path | None:
+    """Downloads the submissions after after_id into a new part of output_dir, returning its path (or None if there were none)"""
+    import httpx
+    params = {"after_id": after_id} | ({"since": since.isoformat()} if since is not None else {})
+    with httpx.stream("GET", f"{api_url}/submissions/export.npy", params=params, timeout=None) as response:
+        response.raise_for_status()
+        up_to_id = int(response.headers["X-Export-Up-To-Id"])
+        reader = _StreamReader(response.iter_bytes())
+        if np.lib.format.read_magic(reader) != (1, 0):
+            raise ValueError("Unexpected export .npy format version")
+        (shape, _fortran_order, dtype) = np.lib.format.read_array_header_1_0(reader)
+        if dtype != EXPORT_DTYPE:
+            raise ValueError(f"Unexpected export dtype {dtype}")
+        (count,) = shape
+        if count == 0:
+            return None
+
+        part_path = output_dir / f"part-{after_id + 1:09d}-{up_to_id:09d}"
+        # Only renamed into place once complete, so an interrupted export is simply repeated
+        temporary_path = part_path.with_name(part_path.name + ".tmp")
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        temporary_path.mkdir(parents=True)
+        outputs = {
+            "images": np.lib.format.open_memmap(temporary_path / "images.npy", mode="w+", dtype=np.uint8, shape=(count, *DIGIT_SHAPE)),
+            "labels": np.lib.format.open_memmap(temporary_path / "labels.npy", mode="w+", dtype=np.uint8, shape=(count,)),
+            "ids": np.lib.format.open_memmap(temporary_path / "ids.npy", mode="w+", dtype=np.int64, shape=(count,)),
+            "timestamps": np.lib.format.open_memmap(temporary_path / "timestamps.npy", mode="w+", dtype="<M8[us]", shape=(count,)),
+        }
+        for start in range(0, count, EXPORT_CHUNK_SIZE):
+            chunk_count = min(EXPORT_CHUNK_SIZE, count - start)
+            records = np.frombuffer(reader.read(chunk_count * EXPORT_DTYPE.itemsize), dtype=EXPORT_DTYPE)
+            outputs["images"][start:start + chunk_count] = records["pixels"]
+            outputs["labels"][start:start + chunk_count] = records["label"]
+            outputs["ids"][start:start + chunk_count] = records["id"]
+            outputs["timestamps"][start:start + chunk_count] = records["timestamp"]
+        for output in outputs.values():
+            output.flush()
+        del outputs
+    temporary_path.rename(part_path)
+    return part_path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--after-id", type=int, help="Export submissions after this id, instead of after the last exported part")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="Only export submissions from this (ISO 8601) time")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    after_id = args.after_id if args.after_id is not None else last_exported_id(output_dir)
+    part_path = download_export(args.api_url.rstrip("/"), output_dir, after_id, args.since)
+    if part_path is None:
+        print(f"No submissions after id {after_id} to export")
+    else:
+        print(f"Exported {len(np.load(part_path / 'labels.npy', mmap_mode='r'))} submissions to {part_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,504 @@
+import base64
+import binascii
+import collections
 import datetime
-from typing import List
-from sqlmodel import Field, SQLModel, create_engine, Session, JSON, select, desc
+import itertools
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterator, List
+import numpy as np
+from sqlalchemy import Index, Integer, bindparam, cast, column, delete, event, func, make_url, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import defer
+from sqlmodel import Field, SQLModel, create_engine, Session, JSON, select, desc, insert
+from .config import load_env_int, load_env_float
+from .executor import BoundedExecutor
+from .instrumentation import time_stage
+from .model_stats import ModelStats, model_stats_of
+from .wire_formats import decode_png_pixels, decode_stored_pixels, encode_deflated_pixels
+from .write_behind import WriteBehindQueue
 
 class DbSubmission(SQLModel, table=True):
+    __table_args__ = (
+        # For keyset pagination of the most recent submissions, optionally with a given label
+        Index("ix_dbsubmission_timestamp_id", "timestamp", "id"),
+        Index("ix_dbsubmission_label_timestamp_id", "label", "timestamp", "id"),
+        # For filtering by model, with jsonb containment (@>)
+        Index(
+            "ix_dbsubmission_predictions",
+            cast(column("predictions"), JSONB),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     timestamp: datetime.datetime = Field(nullable=False)
-    png_bytes: bytes = Field(nullable=False)
+    """The digit's raw pixels, deflated (see wire_formats), or None if it was stored as png_bytes"""
+    deflated_pixels: bytes | None = Field(default=None)
+    """The PNG image of a submission stored by an earlier version, until model_api.image_migration converts it"""
+    png_bytes: bytes | None = Field(default=None)
     label: int = Field(nullable=False)
     predictions: List[dict] = Field(sa_type=JSON, nullable=False)
 
+class DbModelStats(SQLModel, table=True):
+    """A cell of a model's ModelStats, which each batch of submissions adds to as it's inserted"""
+    model: str = Field(primary_key=True)
+    label: int = Field(primary_key=True)
+    predicted_digit: int = Field(primary_key=True)
+    confidence_bin: int = Field(primary_key=True)
+    count: int = Field(nullable=False)
+    confidence_sum: float = Field(nullable=False)
+
+@dataclass(frozen=True)
+class SubmissionCursor:
+    """The position of the last submission of a page, which the next page starts after"""
+    timestamp: datetime.datetime
+    id: int
+
+    def __post_init__(self):
+        # Timestamps are stored in UTC, but may be read back without a timezone
+        if self.timestamp.tzinfo is None:
+            object.__setattr__(self, "timestamp", self.timestamp.replace(tzinfo=datetime.UTC))
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(f"{self.timestamp.isoformat()}|{self.id}".encode()).decode("ascii")
+
+    @classmethod
+    def decode(cls, cursor: str) -> "SubmissionCursor":
+        try:
+            (timestamp, id) = base64.urlsafe_b64decode(cursor.encode("ascii")).decode().split("|")
+            return cls(timestamp=datetime.datetime.fromisoformat(timestamp), id=int(id))
+        except (binascii.Error, UnicodeError, ValueError) as e:
+            raise ValueError("Invalid cursor") from e
+
+    @classmethod
+    def after(cls, submission: DbSubmission) -> "SubmissionCursor":
+        return cls(timestamp=submission.timestamp, id=submission.id)
+
+@dataclass
+class SubmissionExport:
+    """
+    The submissions with an id after after_id (and a timestamp from since, if given) up to up_to_id,
+    as chunks of rows with an id, timestamp, label, deflated_pixels and png_bytes, in id order.
+    Resume from up_to_id to export only the submissions added since.
+    """
+    count: int
+    up_to_id: int
+    chunks: Iterator[list]
+
+@dataclass(frozen=True)
+class SubmissionQuery:
+    """A page of submissions, most recent first"""
+    limit: int = 20
+    after: SubmissionCursor | None = None
+    label: int | None = None
+    """Only submissions with a prediction from this model"""
+    model: str | None = None
+    """Only submissions which were predicted wrongly, by the model if one is given, else by any model"""
+    misclassified: bool = False
+    """If False, the images of the submissions aren't loaded"""
+    include_images: bool = True
+
+    def matches(self, submission: DbSubmission) -> bool:
+        if self.after is not None and (submission.timestamp, submission.id) >= (self.after.timestamp, self.after.id):
+            return False
+        if self.label is not None and submission.label != self.label:
+            return False
+        predictions = [x for x in submission.predictions if self.model is None or x["model"] == self.model]
+        if self.model is not None and len(predictions) == 0:
+            return False
+        if self.misclassified and all(x["predicted_digit"] == submission.label for x in predictions):
+            return False
+        return True
+
+    def statement(self):
+        statement = select(DbSubmission)
+        if self.after is not None:
+            # A row comparison, which can use the (timestamp, id) indexes
+            statement = statement.where(tuple_(DbSubmission.timestamp, DbSubmission.id) < tuple_(self.after.timestamp, self.after.id))
+        if self.label is not None:
+            statement = statement.where(DbSubmission.label == self.label)
+        predictions = cast(DbSubmission.predictions, JSONB)
+        if self.model is not None:
+            statement = statement.where(predictions.contains([{"model": self.model}]))
+        if self.misclassified:
+            prediction = func.jsonb_array_elements(predictions).table_valued(column("value", JSONB)).render_derived()
+            wrong_predictions = select(1).select_from(prediction).where(
+                prediction.c.value["predicted_digit"].astext.cast(Integer) != DbSubmission.label
+            )
+            if self.model is not None:
+                wrong_predictions = wrong_predictions.where(prediction.c.value["model"].astext == self.model)
+            statement = statement.where(wrong_predictions.exists())
+        if not self.include_images:
+            statement = statement.options(defer(DbSubmission.deflated_pixels), defer(DbSubmission.png_bytes))
+        return statement.order_by(desc(DbSubmission.timestamp), desc(DbSubmission.id)).limit(self.limit)
+
 class InMemorySubmissionStore:
-    def __init__(self):
-        self.submissions = []
+    """
+    Keeps the most recent capacity submissions in a ring buffer, so memory stays bounded in long running processes.
+    Ids keep counting up as older submissions are evicted.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+        self.submissions: collections.deque[DbSubmission] = collections.deque(maxlen=capacity)
+        self._next_id = 1
+        self._evicted_count = 0
+        # Of every submission added, including those since evicted
+        self._model_stats: dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
 
     def add_submission(self, submission: DbSubmission):
-        self.submissions.append(submission)
+        self.add_submissions([submission])
+
+    def add_submissions(self, submissions: List[DbSubmission]):
+        stats_by_model = model_stats_of(submissions)
+        with self._lock:
+            for submission in submissions:
+                submission.id = self._next_id
+                self._next_id += 1
+                if len(self.submissions) == self.submissions.maxlen:
+                    self._evicted_count += 1
+                self.submissions.append(submission)
+            for (model_name, stats) in stats_by_model.items():
+                self._model_stats[model_name] = self._model_stats.get(model_name, ModelStats()) + stats
+
+    def get_submissions(self, query: SubmissionQuery) -> List[DbSubmission]:
+        page = []
+        # Held whilst scanning, as a deque can't be iterated whilst it's appended to
+        with self._lock:
+            # Submissions are added in order, so the most recent are at the end
+            for submission in reversed(self.submissions):
+                if len(page) == query.limit:
+                    break
+                if query.matches(submission):
+                    page.append(submission)
+        return page
+
+    def get_submission_pixels(self, id: int) -> np.ndarray | None:
+        with self._lock:
+            index = id - (self._next_id - len(self.submissions))
+            if not (0 <= index < len(self.submissions)):
+                return None
+            submission = self.submissions[index]
+        return decode_stored_pixels(submission.deflated_pixels, submission.png_bytes)[0]
 
     def get_recent_submissions(self, count) -> List[DbSubmission]:
-        return self.submissions[-count:]
+        return self.get_submissions(SubmissionQuery(limit=count))
+
+    def export_submissions(self, after_id: int, since: datetime.datetime | None, chunk_size: int) -> SubmissionExport:
+        # At most capacity submissions, so a snapshot is bounded, and can't be changed by evictions during the export
+        with self._lock:
+            first_index = max(0, after_id - (self._next_id - len(self.submissions)) + 1)
+            rows = [
+                x for x in itertools.islice(self.submissions, first_index, None)
+                if since is None or x.timestamp >= since
+            ]
+            up_to_id = max(after_id, self._next_id - 1)
+        chunks = (rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size))
+        return SubmissionExport(count=len(rows), up_to_id=up_to_id, chunks=chunks)
+
+    def get_model_stats(self) -> dict[str, ModelStats]:
+        with self._lock:
+            return {model_name: stats.copy() for (model_name, stats) in self._model_stats.items()}
+
+    def rebuild_model_stats(self, chunk_size: int, on_chunk: Callable[[int], None] | None = None) -> int:
+        """Rebuilds the stats from the submissions still held, so forgets those of evicted submissions"""
+        with self._lock:
+            self._model_stats = model_stats_of(self.submissions)
+            scanned_count = len(self.submissions)
+        if on_chunk is not None:
+            on_chunk(scanned_count)
+        return scanned_count
 
+    def summary(self) -> dict:
+        return {
+            "store": "in-memory",
+            "size": len(self.submissions),
+            "capacity": self.submissions.maxlen,
+            "evicted_count": self._evicted_count,
+        }
+
+@dataclass
+class PoolMetrics:
+    """Number of new connections opened to the database"""
+    connect_count: int = 0
+    """Number of times a connection was taken from the pool, whether new or reused"""
+    checkout_count: int = 0
+    """Number of connections discarded, e.g. as pre-ping found them disconnected"""
+    invalidated_count: int = 0
 
 class PostgreSqlSubmissionStore:
-    def __init__(self, database_url: str):
-        engine = create_engine(database_url)
-        SQLModel.metadata.create_all(engine)
-        self.engine = engine
+    """
+    Connects to the database (and creates the schema) on first use, rather than on import,
+    through a pool of at most pool_size + max_overflow connections.
+    """
+
+    def __init__(
+        self,
+        database_url: str,
+        pool_size: int = 5,
+        max_overflow: int = 5,
+        pool_timeout_seconds: float = 10.0,
+        pool_recycle_seconds: int = 1800,
+        statement_timeout_ms: int = 5000,
+    ):
+        self.database_url = database_url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout_seconds = pool_timeout_seconds
+        self.pool_recycle_seconds = pool_recycle_seconds
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pool_metrics = PoolMetrics()
+        self._engine = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self.start()
+        return self._engine
+
+    def start(self):
+        """Creates the engine and the schema, if not already started"""
+        with self._start_lock:
+            if self._engine is not None:
+                return
+            engine = self._create_engine()
+            SQLModel.metadata.create_all(engine)
+            if engine.dialect.name == "postgresql":
+                # create_all doesn't alter tables which already exist, e.g. from before deflated_pixels was added.
+                # Neither change rewrites the table, so both are quick however many submissions there are.
+                with engine.begin() as connection:
+                    connection.execute(text("ALTER TABLE dbsubmission ADD COLUMN IF NOT EXISTS deflated_pixels bytea"))
+                    connection.execute(text("ALTER TABLE dbsubmission ALTER COLUMN png_bytes DROP NOT NULL"))
+            # create_all skips the indexes of tables which already exist
+            for index in DbSubmission.__table__.indexes:
+                index.create(engine, checkfirst=True)
+            self._engine = engine
+
+    def _create_engine(self):
+        connect_args = {}
+        if make_url(self.database_url).get_backend_name() == "postgresql":
+            # Stop a slow query from holding a pooled connection (and a store worker) indefinitely
+            connect_args["options"] = f"-c statement_timeout={self.statement_timeout_ms}"
+        engine = create_engine(
+            self.database_url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout_seconds,
+            pool_recycle=self.pool_recycle_seconds,
+            # Checks each connection is still alive as it's checked out, e.g. after a database restart
+            pool_pre_ping=True,
+            connect_args=connect_args,
+        )
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        return engine
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.pool_metrics.connect_count += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.pool_metrics.checkout_count += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.pool_metrics.invalidated_count += 1
 
     def _get_session(self):
         with Session(self.engine) as session:
             yield session
 
     def add_submission(self, submission: DbSubmission):
+        self.add_submissions([submission])
+
+    def add_submissions(self, submissions: List[DbSubmission]):
+        """Inserts the submissions, and adds them to the model stats, in a single transaction, with multi-row statements"""
         with Session(self.engine) as session:
-            session.add(submission)
+            # Before the insert, see rebuild_model_stats
+            self._add_model_stats(session, model_stats_of(submissions))
+            session.execute(insert(DbSubmission), [x.model_dump(exclude={"id"}) for x in submissions])
             session.commit()
 
+    def _add_model_stats(self, session: Session, stats_by_model: dict[str, ModelStats]):
+        """Adds to (or with negative counts, subtracts from) the stored cells, as a single upsert"""
+        # In a consistent order, so concurrent upserts lock the rows they share in the same order, and can't deadlock
+        rows = [
+            {"model": model_name, "label": label, "predicted_digit": predicted_digit, "confidence_bin": confidence_bin, "count": count, "confidence_sum": confidence_sum}
+            for (model_name, stats) in sorted(stats_by_model.items())
+            for (label, predicted_digit, confidence_bin, count, confidence_sum) in stats.cells()
+        ]
+        if len(rows) == 0:
+            return
+        dialect = postgresql if self.engine.dialect.name == "postgresql" else sqlite
+        statement = dialect.insert(DbModelStats).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["model", "label", "predicted_digit", "confidence_bin"],
+            set_={
+                "count": DbModelStats.count + statement.excluded.count,
+                "confidence_sum": DbModelStats.confidence_sum + statement.excluded.confidence_sum,
+            },
+        ))
+
+    def get_submissions(self, query: SubmissionQuery) -> List[DbSubmission]:
+        with Session(self.engine) as session:
+            return [x for x in session.exec(query.statement())]
+
+    def get_submission_pixels(self, id: int) -> np.ndarray | None:
+        with Session(self.engine) as session:
+            row = session.exec(select(DbSubmission.deflated_pixels, DbSubmission.png_bytes).where(DbSubmission.id == id)).first()
+        return decode_stored_pixels(row.deflated_pixels, row.png_bytes)[0] if row is not None else None
+
     def get_recent_submissions(self, count) -> List[DbSubmission]:
+        return self.get_submissions(SubmissionQuery(limit=count))
+
+    def export_submissions(self, after_id: int, since: datetime.datetime | None, chunk_size: int) -> SubmissionExport:
+        with Session(self.engine) as session:
+            if self.engine.dialect.name == "postgresql":
+                # Ids are allocated before their transactions commit, so a batch of submissions still being inserted
+                # may have ids below the latest committed one. This waits for any such batch to commit (and holds
+                # off new ones, which get later ids, for as long as it takes to read the latest id).
+                session.execute(text(f"LOCK TABLE {DbSubmission.__tablename__} IN SHARE MODE"))
+            up_to_id = session.exec(select(func.max(DbSubmission.id))).one() or 0
+            session.commit()
+            up_to_id = max(after_id, up_to_id)
+            # So every submission up to up_to_id is committed, and as they're never deleted, the count of those
+            # up to it can't change during the export, nor can a resumed export miss any
+            conditions = [DbSubmission.id > after_id, DbSubmission.id <= up_to_id]
+            if since is not None:
+                conditions.append(DbSubmission.timestamp >= since)
+            count = session.exec(select(func.count()).select_from(DbSubmission).where(*conditions)).one()
+
+        def chunks():
+            with Session(self.engine) as session:
+                statement = (
+                    select(DbSubmission.id, DbSubmission.timestamp, DbSubmission.label, DbSubmission.deflated_pixels, DbSubmission.png_bytes)
+                    .where(*conditions)
+                    .order_by(DbSubmission.id)
+                    # A server-side cursor, so only a chunk of rows is held in memory at once
+                    .execution_options(stream_results=True, max_row_buffer=chunk_size)
+                )
+                for partition in session.exec(statement).partitions(chunk_size):
+                    yield list(partition)
+
+        return SubmissionExport(count=count, up_to_id=up_to_id, chunks=chunks())
+
+    def _read_model_stats(self, session: Session) -> dict[str, ModelStats]:
+        stats_by_model = {}
+        for row in session.exec(select(DbModelStats)):
+            if row.model not in stats_by_model:
+                stats_by_model[row.model] = ModelStats()
+            stats_by_model[row.model].add_cell(row.label, row.predicted_digit, row.confidence_bin, row.count, row.confidence_sum)
+        return stats_by_model
+
+    def get_model_stats(self) -> dict[str, ModelStats]:
+        """At most a row per cell of each model, however many submissions there are"""
+        with Session(self.engine) as session:
+            return self._read_model_stats(session)
+
+    def rebuild_model_stats(self, chunk_size: int, on_chunk: Callable[[int], None] | None = None) -> int:
+        """
+        Recounts the stats of the submissions up to the latest, streamed a chunk at a time, then corrects the stored
+        stats by the difference, whilst submissions are still being added (and counted) as usual.
+        """
+        with Session(self.engine) as session:
+            if self.engine.dialect.name == "postgresql":
+                # Waits for the transactions adding submissions to commit, and stops more until this commits.
+                # They add to the stats before inserting their submissions, so every submission up to up_to_id
+                # is committed, and every later one is counted in the stats after those read here.
+                session.execute(text(f"LOCK TABLE {DbModelStats.__tablename__} IN EXCLUSIVE MODE"))
+            stored_stats = self._read_model_stats(session)
+            up_to_id = session.exec(select(func.max(DbSubmission.id))).one() or 0
+            session.commit()
+
+        recounted_stats: dict[str, ModelStats] = {}
+        scanned_count = 0
         with Session(self.engine) as session:
-            statement=select(DbSubmission).order_by(desc(DbSubmission.timestamp)).limit(count)
-            return [x for x in session.exec(statement)]
+            statement = (
+                select(DbSubmission.label, DbSubmission.predictions)
+                .where(DbSubmission.id <= up_to_id)
+                # A server-side cursor, so only a chunk of rows is held in memory at once
+                .execution_options(stream_results=True, max_row_buffer=chunk_size)
+            )
+            for partition in session.exec(statement).partitions(chunk_size):
+                for (model_name, stats) in model_stats_of(partition).items():
+                    recounted_stats[model_name] = recounted_stats.get(model_name, ModelStats()) + stats
+                scanned_count += len(partition)
+                if on_chunk is not None:
+                    on_chunk(scanned_count)
+
+        with Session(self.engine) as session:
+            self._add_model_stats(session, {
+                model_name: recounted_stats.get(model_name, ModelStats()) - stored_stats.get(model_name, ModelStats())
+                for model_name in recounted_stats.keys() | stored_stats.keys()
+            })
+            session.execute(delete(DbModelStats).where(DbModelStats.count == 0))
+            session.commit()
+        return scanned_count
+
+    def convert_png_submissions(self, batch_size: int, on_batch: Callable[[int, int], None] | None = None) -> tuple[int, int]:
+        """
+        Converts the submissions stored as PNG images to deflated pixels, in id order, a batch per transaction,
+        so rows are only locked briefly. Returns how many were converted, and how many had an invalid image (and were left).
+        """
+        converted_count = 0
+        invalid_count = 0
+        after_id = 0
+        # Core, rather than ORM, so the batch is a single executemany
+        statement = (
+            update(DbSubmission.__table__)
+            .where(DbSubmission.__table__.c.id == bindparam("row_id"))
+            .values(deflated_pixels=bindparam("row_deflated_pixels"), png_bytes=None)
+        )
+        while True:
+            with Session(self.engine) as session:
+                rows = session.exec(
+                    select(DbSubmission.id, DbSubmission.png_bytes)
+                    .where(DbSubmission.id > after_id, DbSubmission.deflated_pixels.is_(None), DbSubmission.png_bytes.is_not(None))
+                    .order_by(DbSubmission.id)
+                    .limit(batch_size)
+                ).all()
+                if len(rows) == 0:
+                    break
+                parameters = []
+                for row in rows:
+                    try:
+                        parameters.append({"row_id": row.id, "row_deflated_pixels": encode_deflated_pixels(decode_png_pixels(row.png_bytes))})
+                    except ValueError:
+                        invalid_count += 1
+                if len(parameters) > 0:
+                    session.execute(statement, parameters)
+                session.commit()
+            converted_count += len(parameters)
+            after_id = rows[-1].id
+            if on_batch is not None:
+                on_batch(converted_count, invalid_count)
+        return (converted_count, invalid_count)
+
+    def summary(self) -> dict:
+        metrics = self.pool_metrics
+        summary = {
+            "store": "postgresql",
+            "started": self._engine is not None,
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "connect_count": metrics.connect_count,
+            "checkout_count": metrics.checkout_count,
+            "invalidated_count": metrics.invalidated_count,
+            # The fraction of checkouts which reused a pooled connection, rather than opening a new one
+            "connection_reuse_ratio": 1 - metrics.connect_count / metrics.checkout_count if metrics.checkout_count > 0 else 0.0,
+        }
+        if self._engine is not None:
+            pool = self._engine.pool
+            summary |= {
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            }
+        return summary
 
 def load_env_string(name: str) -> str:
     """Load string environment variable"""
@@ -51,7 +511,39 @@ def load_env_string(name: str) -> str:
 import os
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+STORE_WORKERS = load_env_int("STORE_WORKERS", 4)
+
+# Neither store connects to anything until first used
 if DATABASE_URL is None or DATABASE_URL == "":
-    submission_store = InMemorySubmissionStore()
+    submission_store = InMemorySubmissionStore(capacity=load_env_int("IN_MEMORY_STORE_CAPACITY", 10_000))
 else:
-    submission_store = PostgreSqlSubmissionStore(database_url=load_env_string("DATABASE_URL"))
\ No newline at end of file
+    submission_store = PostgreSqlSubmissionStore(
+        database_url=load_env_string("DATABASE_URL"),
+        # Enough for every store worker to hold a connection at once
+        pool_size=load_env_int("DATABASE_POOL_SIZE", STORE_WORKERS),
+        max_overflow=load_env_int("DATABASE_MAX_OVERFLOW", 2),
+        pool_timeout_seconds=load_env_float("DATABASE_POOL_TIMEOUT_SECONDS", 10.0),
+        pool_recycle_seconds=load_env_int("DATABASE_POOL_RECYCLE_SECONDS", 1800),
+        statement_timeout_ms=load_env_int("DATABASE_STATEMENT_TIMEOUT_MS", 5000),
+    )
+
+# Store calls block on the database, so run on their own small pool of threads
+store_executor = BoundedExecutor(
+    name="store",
+    max_workers=STORE_WORKERS,
+    max_queue_size=load_env_int("STORE_MAX_QUEUE", 64),
+)
+
+def timed_add_submissions(submissions: List[DbSubmission]):
+    with time_stage("store_write"):
+        submission_store.add_submissions(submissions)
+
+# Submissions are written behind the requests which made them, a batch at a time
+submission_writer: WriteBehindQueue[DbSubmission] = WriteBehindQueue(
+    name="submission-writer",
+    write_batch=timed_add_submissions,
+    executor=store_executor,
+    max_batch_size=load_env_int("SUBMISSION_WRITE_BATCH_SIZE", 100),
+    max_wait_seconds=load_env_float("SUBMISSION_WRITE_WINDOW_MS", 50.0) / 1000,
+    max_queue_size=load_env_int("SUBMISSION_WRITE_MAX_QUEUE", 10_000),
+)
@@ -0,0 +1,77 @@
+"""
+Compact encodings of 28 x 28 greyscale digits, all decoding straight to uint8 arrays:
+
+* raw: 784 bytes per digit, row by row (application/octet-stream)
+* base64: the raw bytes, base64 encoded for embedding in JSON
+* png: a 28 x 28 greyscale PNG image (image/png)
+* deflated: the raw bytes, compressed with zlib, as submissions are stored (smaller than a PNG, and far cheaper to encode)
+"""
+import base64
+import binascii
+import io
+import zlib
+import numpy as np
+
+DIGIT_SHAPE = (28, 28)
+DIGIT_BYTES = DIGIT_SHAPE[0] * DIGIT_SHAPE[1]
+
+def decode_raw_pixels(data: bytes) -> np.ndarray:
+    """Decodes one or more raw digits to an N x 28 x 28 uint8 array, which shares memory with data"""
+    if len(data) == 0 or len(data) % DIGIT_BYTES != 0:
+        raise ValueError(f"Expected a multiple of {DIGIT_BYTES} bytes, got {len(data)}")
+    return np.frombuffer(data, dtype=np.uint8).reshape((-1, *DIGIT_SHAPE))
+
+def encode_raw_pixels(pixels: np.ndarray) -> bytes:
+    return np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+
+def decode_base64_pixels(data: str) -> np.ndarray:
+    """Decodes one or more base64 encoded raw digits to an N x 28 x 28 uint8 array"""
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except binascii.Error as e:
+        raise ValueError("Invalid base64 pixel data") from e
+    return decode_raw_pixels(raw)
+
+def encode_base64_pixels(pixels: np.ndarray) -> str:
+    return base64.b64encode(encode_raw_pixels(pixels)).decode('ascii')
+
+def decode_png_pixels(data: bytes) -> np.ndarray:
+    """Decodes a 28 x 28 PNG image to a 1 x 28 x 28 uint8 array of greyscale pixels"""
+    from PIL import Image, UnidentifiedImageError
+    try:
+        image = Image.open(io.BytesIO(data), formats=["PNG"])
+        image.load()
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("Invalid PNG image") from e
+    if image.size != DIGIT_SHAPE:
+        raise ValueError(f"Expected a 28 x 28 image, got {image.size[0]} x {image.size[1]}")
+    if image.mode != "L":
+        image = image.convert("L")
+    return np.asarray(image, dtype=np.uint8)[np.newaxis]
+
+def encode_png_pixels(pixels: np.ndarray) -> bytes:
+    """Encodes a 28 x 28 digit as a greyscale PNG image"""
+    from PIL import Image
+    image_io = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8).reshape(DIGIT_SHAPE)).save(image_io, format="PNG")
+    return image_io.getvalue()
+
+def encode_deflated_pixels(pixels: np.ndarray) -> bytes:
+    # The fastest level, as digits are mostly background, which compresses well at any level
+    return zlib.compress(encode_raw_pixels(pixels), level=1)
+
+def decode_deflated_pixels(data: bytes) -> np.ndarray:
+    """Decodes one or more deflated digits to an N x 28 x 28 uint8 array"""
+    try:
+        raw = zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError("Invalid deflated pixel data") from e
+    return decode_raw_pixels(raw)
+
+def decode_stored_pixels(deflated_pixels: bytes | None, png_bytes: bytes | None) -> np.ndarray:
+    """Decodes a stored submission's digit to a 1 x 28 x 28 uint8 array, from its PNG image if stored by an earlier version"""
+    if deflated_pixels is not None:
+        return decode_deflated_pixels(deflated_pixels)
+    if png_bytes is not None:
+        return decode_png_pixels(png_bytes)
+    raise ValueError("The submission has no image")
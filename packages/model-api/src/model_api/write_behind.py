@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Generic, List, TypeVar
+from .executor import BoundedExecutor, OverloadedError
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WriteBehindMetrics:
+    enqueued_count: int = 0
+    written_count: int = 0
+    """Number of writes of a batch, each of which may write many items"""
+    batch_count: int = 0
+    """Number of items rejected because the queue was full"""
+    dropped_count: int = 0
+    """Number of items which failed to write after every retry"""
+    failed_count: int = 0
+    retry_count: int = 0
+    last_error: str | None = None
+
+    def summary(self) -> dict:
+        return {
+            "enqueued_count": self.enqueued_count,
+            "written_count": self.written_count,
+            "batch_count": self.batch_count,
+            "mean_batch_size": self.written_count / self.batch_count if self.batch_count > 0 else 0.0,
+            "dropped_count": self.dropped_count,
+            "failed_count": self.failed_count,
+            "retry_count": self.retry_count,
+            "last_error": self.last_error,
+        }
+
+class WriteBehindQueue(Generic[T]):
+    """
+    Buffers items to be written, and writes them in batches with write_batch (a blocking call, run on executor)
+    once max_batch_size items are waiting, or max_wait_seconds after the first item of a batch was enqueued.
+
+    Batches are written one at a time, in the order their items were enqueued. A failed write is retried
+    up to max_attempts times in all, after which its items are counted as failed and discarded.
+    At most max_queue_size items are buffered; beyond that, enqueue raises an OverloadedError.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        write_batch: Callable[[List[T]], None],
+        executor: BoundedExecutor,
+        max_batch_size: int,
+        max_wait_seconds: float,
+        max_queue_size: int,
+        max_attempts: int = 3,
+        retry_delay_seconds: float = 0.1,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"{name}: max_batch_size must be at least 1, got {max_batch_size}")
+        if max_queue_size < 1:
+            raise ValueError(f"{name}: max_queue_size must be at least 1, got {max_queue_size}")
+        self.name = name
+        self.write_batch = write_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue_size = max_queue_size
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self.metrics = WriteBehindMetrics()
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    def enqueue(self, item: T):
+        """Buffers the item to be written, returning immediately. Must be called on the event loop."""
+        loop = asyncio.get_running_loop()
+        self._ensure_worker(loop)
+        try:
+            self._queue.put_nowait((item, loop.time()))
+        except asyncio.QueueFull as e:
+            self.metrics.dropped_count += 1
+            raise OverloadedError(f"{self.name}: too many writes are already queued") from e
+        self.metrics.enqueued_count += 1
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_worker(self, loop: asyncio.AbstractEventLoop):
+        # The queue and worker are bound to the event loop they were created on
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._worker = None
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            try:
+                await self._write_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _collect_batch(self) -> List[T]:
+        (first, enqueued_at) = await self._queue.get()
+        batch = [first]
+        deadline = enqueued_at + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                # Still take anything which has already arrived
+                if self._queue.empty():
+                    break
+                batch.append(self._queue.get_nowait()[0])
+                continue
+            try:
+                batch.append((await asyncio.wait_for(self._queue.get(), timeout))[0])
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write_with_retries(self, batch: List[T]):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self.executor.run(self.write_batch, batch)
+            except Exception as e:
+                self.metrics.last_error = f"{type(e).__name__}: {e}"
+                if attempt == self.max_attempts:
+                    self.metrics.failed_count += len(batch)
+                    logger.exception(f"{self.name}: failed to write a batch of {len(batch)} after {attempt} attempts")
+                    return
+                self.metrics.retry_count += 1
+                await asyncio.sleep(self.retry_delay_seconds * 2 ** (attempt - 1))
+            else:
+                self.metrics.batch_count += 1
+                self.metrics.written_count += len(batch)
+                return
+
+    async def stop(self):
+        """Writes everything still buffered, then stops the worker"""
+        if self._queue is not None and self._worker is not None and not self._worker.done():
+            await self._queue.join()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._loop = None
+        self._queue = None
+
+    def summary(self) -> dict:
+        return self.metrics.summary() | {
+            "pending": self.pending,
+            "max_queue_size": self.max_queue_size,
+        }
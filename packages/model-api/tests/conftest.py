@@ -0,0 +1,43 @@
+import os
+import time
+import pytest
+import torch
+from fastapi.testclient import TestClient
+
+# Submissions are kept in memory, rather than needing a database
+os.environ["DATABASE_URL"] = ""
+
+@pytest.fixture
+def client() -> TestClient:
+    from model_api.main import app
+    return TestClient(app)
+
+class FakeModel:
+    """Stands in for a DigitModelBase, predicting the same digit for every image, after delay_seconds per batch"""
+
+    def __init__(self, digit: int, confidence: float, weights_version: str = "v1", delay_seconds: float = 0.0):
+        self.weights_version = weights_version
+        self.delay_seconds = delay_seconds
+        self.batch_sizes = []
+        self.predicts(digit, confidence)
+
+    def predicts(self, digit: int, confidence: float):
+        """The digit's probability is confidence, and the rest share what's left equally"""
+        self.probabilities = torch.full((10,), (1 - confidence) / 9)
+        self.probabilities[digit] = confidence
+
+    def probabilities_from_tensor(self, image_batch: torch.Tensor, temperature: float) -> torch.Tensor:
+        self.batch_sizes.append(len(image_batch))
+        time.sleep(self.delay_seconds)
+        return self.probabilities.repeat(len(image_batch), 1)
+
+    def augmented_probabilities_from_tensor(self, image_batch: torch.Tensor, temperature: float, augmentations) -> torch.Tensor:
+        return self.probabilities_from_tensor(image_batch, temperature)
+
+@pytest.fixture
+def fake_models(monkeypatch) -> dict[str, FakeModel]:
+    """Replaces every model with a FakeModel, which by default predicts 0 with confidence 0.9"""
+    from model_api import predictions
+    models = {model_name: FakeModel(digit=0, confidence=0.9) for model_name in predictions.predictors}
+    monkeypatch.setattr(predictions.model_registry, "get", lambda model_name: models[model_name])
+    return models
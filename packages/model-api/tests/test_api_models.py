@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from model_api.api_models import ApiDigitBatch, ApiDigitData
+
+def test_digit_pixels_are_read():
+    pixels = np.arange(28 * 28, dtype=np.uint8).reshape(28, 28)
+    assert np.array_equal(ApiDigitData(pixels=pixels.tolist()).to_prediction_model().pixels, pixels)
+
+@pytest.mark.parametrize("pixels", [[[300] * 28] * 28, [[-1] * 28] * 28, [[0] * 28] * 27])
+def test_invalid_digit_pixels_are_a_400(pixels):
+    with pytest.raises(HTTPException) as raised:
+        ApiDigitData(pixels=pixels).to_prediction_model()
+    assert raised.value.status_code == 400
+
+@pytest.mark.parametrize("digits", [[[[300] * 28] * 28], [[[0] * 28] * 27]])
+def test_invalid_batch_pixels_are_a_400(digits):
+    with pytest.raises(HTTPException) as raised:
+        ApiDigitBatch(digits=digits).to_pixels_array()
+    assert raised.value.status_code == 400
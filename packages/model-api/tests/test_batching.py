@@ -0,0 +1,145 @@
+import asyncio
+import time
+import pytest
+
+from model_api.batching import MicroBatchScheduler
+from model_api.executor import OverloadedError
+
+def recording_scheduler(batches: list, **kwargs) -> MicroBatchScheduler:
+    async def process_batch(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+    return MicroBatchScheduler(process_batch, **kwargs)
+
+def test_items_submitted_together_form_one_batch():
+    batches = []
+    scheduler = recording_scheduler(batches, max_batch_size=8, max_wait_seconds=0.05)
+
+    async def main():
+        results = await asyncio.gather(*[scheduler.submit(i) for i in range(5)])
+        await scheduler.stop()
+        return results
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert batches == [[0, 1, 2, 3, 4]]
+    assert scheduler.metrics.summary()["batch_size_histogram"] == {5: 1}
+
+def test_batches_are_split_at_max_batch_size():
+    batches = []
+    scheduler = recording_scheduler(batches, max_batch_size=2, max_wait_seconds=0.05)
+
+    async def main():
+        results = await asyncio.gather(*[scheduler.submit(i) for i in range(5)])
+        await scheduler.stop()
+        return results
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert batches == [[0, 1], [2, 3], [4]]
+
+def test_full_batch_is_processed_without_waiting_for_the_window():
+    batches = []
+    scheduler = recording_scheduler(batches, max_batch_size=3, max_wait_seconds=10.0)
+
+    async def main():
+        started_at = time.monotonic()
+        await asyncio.gather(*[scheduler.submit(i) for i in range(3)])
+        elapsed = time.monotonic() - started_at
+        await scheduler.stop()
+        return elapsed
+
+    assert asyncio.run(main()) < 1.0
+    assert batches == [[0, 1, 2]]
+
+def test_items_after_the_window_form_a_new_batch():
+    batches = []
+    scheduler = recording_scheduler(batches, max_batch_size=8, max_wait_seconds=0.02)
+
+    async def main():
+        first = asyncio.ensure_future(scheduler.submit(1))
+        await asyncio.sleep(0.1)
+        second = await scheduler.submit(2)
+        results = (await first, second)
+        await scheduler.stop()
+        return results
+
+    assert asyncio.run(main()) == (10, 20)
+    assert batches == [[1], [2]]
+
+def test_batch_failures_are_raised_to_every_item():
+    async def process_batch(items):
+        raise ValueError("model failed")
+    scheduler = MicroBatchScheduler(process_batch, max_batch_size=8, max_wait_seconds=0.01)
+
+    async def main():
+        results = await asyncio.gather(*[scheduler.submit(i) for i in range(3)], return_exceptions=True)
+        await scheduler.stop()
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+def test_wrong_number_of_results_is_an_error():
+    async def process_batch(items):
+        return items[:-1]
+    scheduler = MicroBatchScheduler(process_batch, max_batch_size=8, max_wait_seconds=0.01)
+
+    async def main():
+        results = await asyncio.gather(*[scheduler.submit(i) for i in range(2)], return_exceptions=True)
+        await scheduler.stop()
+        return results
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(main()))
+
+def test_stop_waits_for_batches_in_flight():
+    finished = []
+
+    async def process_batch(items):
+        await asyncio.sleep(0.05)
+        finished.extend(items)
+        return items
+    scheduler = MicroBatchScheduler(process_batch, max_batch_size=8, max_wait_seconds=0.0)
+
+    async def main():
+        pending = asyncio.ensure_future(scheduler.submit(1))
+        await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return await pending
+
+    assert asyncio.run(main()) == 1
+    assert finished == [1]
+
+def test_scheduler_can_be_used_from_another_event_loop():
+    batches = []
+    scheduler = recording_scheduler(batches, max_batch_size=8, max_wait_seconds=0.01)
+    assert asyncio.run(scheduler.submit(1)) == 10
+    assert asyncio.run(scheduler.submit(2)) == 20
+
+@pytest.mark.parametrize("kwargs", [{"max_batch_size": 0}, {"max_batch_size": 1, "max_concurrent_batches": 0}])
+def test_invalid_limits_are_rejected(kwargs):
+    with pytest.raises(ValueError):
+        recording_scheduler([], max_wait_seconds=0.01, **kwargs)
+
+def test_items_beyond_max_queue_size_are_rejected():
+    async def main():
+        release = asyncio.Event()
+
+        async def process_batch(items):
+            await release.wait()
+            return items
+        scheduler = MicroBatchScheduler(process_batch, max_batch_size=1, max_wait_seconds=0.0, max_queue_size=1)
+
+        # The first is taken off the queue to be processed, then the second waits in the queue
+        accepted = []
+        for i in range(2):
+            accepted.append(asyncio.ensure_future(scheduler.submit(i)))
+            await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(OverloadedError):
+                await asyncio.wait_for(scheduler.submit(2), timeout=1.0)
+        finally:
+            release.set()
+        results = await asyncio.gather(*accepted)
+        await scheduler.stop()
+        return (results, scheduler.metrics.rejected_count)
+
+    assert asyncio.run(main()) == ([0, 1], 1)
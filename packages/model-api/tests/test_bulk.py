@@ -0,0 +1,97 @@
+import asyncio
+import numpy as np
+import pytest
+
+from model_api import api_models, inference, wire_formats
+from model_api.executor import OverloadedError
+
+@pytest.fixture
+def chunk_sizes(monkeypatch) -> list:
+    """The size of each chunk passed to the inference workers, which predict each digit as its index"""
+    chunk_sizes = []
+
+    async def run_inference(fn, pixels, model_names):
+        chunk_sizes.append(len(pixels))
+        return [int(digit[0, 0]) for digit in pixels]
+    monkeypatch.setattr(inference, "run_inference", run_inference)
+    return chunk_sizes
+
+def numbered_digits(count: int) -> np.ndarray:
+    pixels = np.zeros((count, 28, 28), dtype=np.uint8)
+    pixels[:, 0, 0] = np.arange(count)
+    return pixels
+
+def test_bulk_requests_are_predicted_in_chunks_in_order(monkeypatch, chunk_sizes):
+    monkeypatch.setattr(inference, "BULK_CHUNK_SIZE", 3)
+    predictions = asyncio.run(inference.create_predictions_bulk(numbered_digits(7), ("cnn-v1",)))
+    assert predictions == list(range(7))
+    assert chunk_sizes == [3, 3, 1]
+
+def test_bulk_requests_beyond_the_queue_are_rejected(monkeypatch):
+    monkeypatch.setattr(inference, "BULK_MAX_CONCURRENT_CHUNKS", 1)
+    monkeypatch.setattr(inference, "BULK_MAX_QUEUE", 1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def run_inference(fn, pixels, model_names):
+            await release.wait()
+            return [0] * len(pixels)
+        monkeypatch.setattr(inference, "run_inference", run_inference)
+
+        # The first runs its chunk, and the second waits for it
+        accepted = []
+        for _ in range(2):
+            accepted.append(asyncio.ensure_future(inference.create_predictions_bulk(numbered_digits(1))))
+            await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(OverloadedError):
+                await asyncio.wait_for(inference.create_predictions_bulk(numbered_digits(1)), timeout=1.0)
+        finally:
+            release.set()
+        return await asyncio.gather(*accepted)
+
+    # Each event loop gets its own chunk slots
+    for _ in range(2):
+        assert asyncio.run(main()) == [[0], [0]]
+
+def test_bulk_endpoint_predicts_every_digit(client):
+    pixels = numbered_digits(3)
+    response = client.post(
+        "/recognize-digits?models=cnn-v1",
+        content=wire_formats.encode_raw_pixels(pixels),
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert response.status_code == 200
+    predictions = response.json()
+    assert len(predictions) == 3
+    assert all(len(digit_predictions) == 1 for digit_predictions in predictions)
+
+def test_too_many_raw_digits_are_a_413(monkeypatch, client, chunk_sizes):
+    monkeypatch.setattr(api_models, "BULK_MAX_DIGITS", 2)
+    response = client.post(
+        "/recognize-digits",
+        content=wire_formats.encode_raw_pixels(numbered_digits(3)),
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert response.status_code == 413
+    assert chunk_sizes == []
+
+def test_too_many_json_digits_are_a_413(monkeypatch, client, chunk_sizes):
+    monkeypatch.setattr(api_models, "BULK_MAX_DIGITS", 2)
+    response = client.post("/recognize-digits", json={"digits": numbered_digits(3).tolist()})
+    assert response.status_code == 413
+    assert chunk_sizes == []
+
+def test_a_body_too_long_for_the_limit_is_a_413_before_being_read(monkeypatch, client, chunk_sizes):
+    monkeypatch.setattr(api_models, "BULK_MAX_DIGITS", 2)
+
+    def body():
+        yield wire_formats.encode_raw_pixels(numbered_digits(2))
+        raise AssertionError("The rest of the body shouldn't be read")
+    response = client.post(
+        "/recognize-digits",
+        content=body(),
+        headers={"Content-Type": "application/octet-stream", "Content-Length": str(3 * wire_formats.DIGIT_BYTES)},
+    )
+    assert response.status_code == 413
@@ -0,0 +1,50 @@
+import dataclasses
+import time
+import numpy as np
+import pytest
+
+from model_api import predictions
+from model_api.predictions import CASCADE_MODEL_NAME, PredictionClassification, PredictionDigitData, PredictionRequest, create_predictions_batch
+
+@pytest.fixture
+def with_threshold(monkeypatch, fake_models):
+    """Sets the cascade's threshold, with the first model predicting 1 with confidence 0.6, and the second 2"""
+    fake_models["cnn-v1"].predicts(1, 0.6)
+    fake_models["cnn-v2"].predicts(2, 0.9)
+
+    def with_threshold(threshold: float):
+        monkeypatch.setattr(predictions, "cascade", dataclasses.replace(predictions.cascade, first="cnn-v1", second="cnn-v2", threshold=threshold))
+    return with_threshold
+
+def predict_cascade(count: int = 1, deadline: float | None = None) -> list[PredictionClassification]:
+    batch = [PredictionRequest(PredictionDigitData(np.zeros((28, 28), dtype=np.uint8)), (CASCADE_MODEL_NAME,), deadline) for _ in range(count)]
+    return [prediction for [prediction] in create_predictions_batch(batch)]
+
+@pytest.mark.parametrize("threshold", [0.0, 0.5, 0.6])
+def test_confident_digits_are_not_escalated(with_threshold, fake_models, threshold):
+    with_threshold(threshold)
+    for prediction in predict_cascade(3):
+        assert (prediction.predicted_digit, prediction.confidence) == (1, pytest.approx(0.6))
+        assert prediction.combined_models == ("cnn-v1",)
+        assert prediction.weights_versions == (("cnn-v1", "v1"),)
+        assert predictions.cascade.is_complete(prediction)
+    assert fake_models["cnn-v2"].batch_sizes == []
+
+@pytest.mark.parametrize("threshold", [0.7, 1.01])
+def test_unconfident_digits_are_escalated_to_the_second_model(with_threshold, fake_models, threshold):
+    with_threshold(threshold)
+    for prediction in predict_cascade(3):
+        assert (prediction.predicted_digit, prediction.confidence) == (2, pytest.approx(0.9))
+        assert prediction.combined_models == ("cnn-v1", "cnn-v2")
+        assert prediction.weights_versions == (("cnn-v1", "v1"), ("cnn-v2", "v1"))
+        assert predictions.cascade.is_complete(prediction)
+    # Only the first model runs over the whole batch, and the second once over the escalated digits
+    assert (fake_models["cnn-v1"].batch_sizes, fake_models["cnn-v2"].batch_sizes) == ([3], [3])
+
+def test_digits_past_their_deadline_are_not_escalated(with_threshold, fake_models):
+    with_threshold(0.7)
+    [prediction] = predict_cascade(deadline=time.monotonic() - 1)
+    assert prediction.combined_models == ("cnn-v1",)
+    assert fake_models["cnn-v2"].batch_sizes == []
+    # So it isn't cached, as it would have been escalated given time
+    assert not predictions.cascade.is_complete(prediction)
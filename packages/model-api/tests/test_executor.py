@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import pytest
+
+from model_api.executor import BoundedExecutor, OverloadedError
+
+def test_calls_beyond_the_workers_and_queue_are_rejected():
+    executor = BoundedExecutor(name="test", max_workers=1, max_queue_size=1)
+    release = threading.Event()
+
+    async def main():
+        running = [asyncio.ensure_future(executor.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(OverloadedError):
+                await executor.run(release.wait)
+            assert executor.summary()["pending"] == 2
+        finally:
+            # Otherwise shutdown would wait on the blocked workers forever
+            release.set()
+        return await asyncio.gather(*running)
+
+    try:
+        assert asyncio.run(main()) == [True, True]
+    finally:
+        executor.shutdown()
+    assert executor.summary()["rejected_count"] == 1
+    assert executor.summary()["pending"] == 0
+
+def test_calls_are_accepted_again_once_the_queue_drains():
+    executor = BoundedExecutor(name="test", max_workers=1, max_queue_size=0)
+
+    async def main():
+        return [await executor.run(sum, [i, 1]) for i in range(3)]
+
+    try:
+        assert asyncio.run(main()) == [1, 2, 3]
+    finally:
+        executor.shutdown()
+    assert executor.summary()["rejected_count"] == 0
+
+def test_errors_are_raised_to_the_caller():
+    executor = BoundedExecutor(name="test", max_workers=1, max_queue_size=0)
+
+    async def main():
+        with pytest.raises(ZeroDivisionError):
+            await executor.run(lambda: 1 / 0)
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+    assert executor.summary()["pending"] == 0
+
+def test_at_least_one_worker_is_needed():
+    with pytest.raises(ValueError):
+        BoundedExecutor(name="test", max_workers=0, max_queue_size=1)
@@ -0,0 +1,139 @@
+from pathlib import Path
+import pytest
+import torch
+
+from model.digit_model import weights_file_version
+from model_api.model_registry import PACKAGED_VERSION, ModelRegistry
+
+class StubModel:
+    """Stands in for a DigitModelBase, which the registry only warms up and reads the weights version of"""
+
+    def __init__(self, weights_version: str):
+        self.weights_version = weights_version
+
+    def probabilities_from_tensor(self, image_batch: torch.Tensor, temperature: float) -> torch.Tensor:
+        return torch.full((len(image_batch), 10), 0.1)
+
+def load_checkpoint(weights_path: Path) -> StubModel:
+    if weights_path.read_text() == "broken":
+        raise ValueError(f"{weights_path.name} is broken")
+    return StubModel(weights_file_version(weights_path))
+
+@pytest.fixture
+def checkpoint_dir(tmp_path) -> Path:
+    (tmp_path / "cnn").mkdir()
+    return tmp_path
+
+def add_checkpoint(checkpoint_dir: Path, version: str, content: str | None = None):
+    (checkpoint_dir / "cnn" / f"{version}.pth").write_text(content if content is not None else f"weights {version}")
+
+def create_registry(checkpoint_dir: Path | None, retained_versions: int = 1) -> ModelRegistry:
+    registry = ModelRegistry(checkpoint_dir, retained_versions)
+    registry.register("cnn", lambda: StubModel("packaged-weights"), lambda: "packaged-weights", load_checkpoint)
+    return registry
+
+def test_versions_are_ordered_by_their_numbers(checkpoint_dir):
+    for version in ("2", "10", "9", "2026-10-02", "2026-9-30"):
+        add_checkpoint(checkpoint_dir, version)
+    # Neither partially written files, nor other files, are versions
+    (checkpoint_dir / "cnn" / "11.pth.123.tmp").write_text("partial")
+    (checkpoint_dir / "cnn" / "notes.txt").write_text("notes")
+    assert create_registry(checkpoint_dir).versions("cnn") == [PACKAGED_VERSION, "2", "9", "10", "2026-9-30", "2026-10-02"]
+
+def test_only_the_packaged_weights_are_used_without_a_checkpoint_dir():
+    registry = create_registry(None)
+    assert registry.get("cnn").weights_version == "packaged-weights"
+    assert registry.versions("cnn") == [PACKAGED_VERSION]
+    with pytest.raises(ValueError):
+        registry.pin("cnn", PACKAGED_VERSION)
+
+def test_the_latest_version_is_loaded(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    add_checkpoint(checkpoint_dir, "2")
+    registry = create_registry(checkpoint_dir)
+    assert registry.get("cnn").weights_version == weights_file_version(checkpoint_dir / "cnn" / "2.pth")
+    assert registry.active_version("cnn") == "2"
+
+def test_new_versions_are_swapped_in(checkpoint_dir):
+    registry = create_registry(checkpoint_dir, retained_versions=1)
+    swapped = []
+    registry.add_swap_listener(swapped.append)
+    registry.get("cnn")
+    for version in ("1", "2"):
+        add_checkpoint(checkpoint_dir, version)
+        registry.reconcile()
+    assert registry.active_version("cnn") == "2"
+    assert registry.get("cnn").weights_version == weights_file_version(checkpoint_dir / "cnn" / "2.pth")
+    assert swapped == ["cnn", "cnn"]
+    # Only the previous version is kept loaded, for a quick rollback
+    assert registry.version_status("cnn")["loaded_versions"] == ["1", "2"]
+
+def test_a_version_which_fails_to_load_falls_back_to_the_previous_one(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    add_checkpoint(checkpoint_dir, "2", "broken")
+    registry = create_registry(checkpoint_dir)
+    assert registry.get("cnn").weights_version == weights_file_version(checkpoint_dir / "cnn" / "1.pth")
+    assert list(registry.version_status("cnn")["failed_versions"]) == ["2"]
+    # And isn't tried again
+    assert registry.target_version("cnn") == "1"
+
+def test_a_broken_new_version_is_not_swapped_in(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    registry = create_registry(checkpoint_dir)
+    registry.get("cnn")
+    add_checkpoint(checkpoint_dir, "2", "broken")
+    registry.reconcile()
+    assert registry.active_version("cnn") == "1"
+
+def test_a_pinned_version_is_kept_until_unpinned(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    add_checkpoint(checkpoint_dir, "2")
+    registry = create_registry(checkpoint_dir)
+    registry.get("cnn")
+    registry.pin("cnn", "1")
+    assert (checkpoint_dir / "cnn" / "pinned").read_text() == "1"
+    assert registry.active_version("cnn") == "1"
+
+    add_checkpoint(checkpoint_dir, "3")
+    registry.reconcile()
+    assert registry.active_version("cnn") == "1"
+    # Another process serving the api reads the same pin
+    assert create_registry(checkpoint_dir).target_version("cnn") == "1"
+
+    registry.unpin("cnn")
+    assert not (checkpoint_dir / "cnn" / "pinned").exists()
+    assert registry.active_version("cnn") == "3"
+
+def test_only_existing_versions_can_be_pinned(checkpoint_dir):
+    with pytest.raises(KeyError):
+        create_registry(checkpoint_dir).pin("cnn", "1")
+
+def test_a_broken_version_is_not_pinned(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1", "broken")
+    registry = create_registry(checkpoint_dir)
+    with pytest.raises(ValueError):
+        registry.pin("cnn", "1")
+    assert registry.pinned_version("cnn") is None
+
+def test_rollback_pins_the_previous_version(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    add_checkpoint(checkpoint_dir, "2")
+    registry = create_registry(checkpoint_dir)
+    registry.get("cnn")
+    assert registry.rollback("cnn") == "1"
+    assert registry.rollback("cnn") == PACKAGED_VERSION
+    assert (registry.active_version("cnn"), registry.pinned_version("cnn")) == (PACKAGED_VERSION, PACKAGED_VERSION)
+    assert registry.get("cnn").weights_version == "packaged-weights"
+    with pytest.raises(ValueError):
+        registry.rollback("cnn")
+
+def test_the_weights_version_of_an_unloaded_model_is_read_on_refresh(checkpoint_dir):
+    add_checkpoint(checkpoint_dir, "1")
+    registry = create_registry(checkpoint_dir)
+    assert registry.weights_version("cnn") == weights_file_version(checkpoint_dir / "cnn" / "1.pth")
+
+    add_checkpoint(checkpoint_dir, "2")
+    assert registry.weights_version("cnn") == weights_file_version(checkpoint_dir / "cnn" / "1.pth")
+    registry.refresh_weights_versions()
+    assert registry.weights_version("cnn") == weights_file_version(checkpoint_dir / "cnn" / "2.pth")
+    assert not registry.is_loaded("cnn")
@@ -0,0 +1,61 @@
+import pytest
+
+from model_api.model_stats import CONFIDENCE_BIN_COUNT, ModelStats
+
+def test_summary_of_correct_confident_predictions():
+    stats = ModelStats()
+    for _ in range(10):
+        stats.add_prediction(label=3, predicted_digit=3, confidence=0.95)
+    summary = stats.summary()
+
+    assert summary["count"] == 10
+    assert summary["accuracy"] == 1.0
+    assert summary["confusion_matrix"][3][3] == 10
+    assert sum(map(sum, summary["confusion_matrix"])) == 10
+    top_bin = summary["calibration"][9]
+    assert (top_bin["min_confidence"], top_bin["max_confidence"]) == (0.9, 1.0)
+    assert top_bin["count"] == 10
+    assert top_bin["accuracy"] == 1.0
+    assert top_bin["mean_confidence"] == pytest.approx(0.95)
+    assert all(x["count"] == 0 and x["accuracy"] is None for x in summary["calibration"][:9])
+    assert summary["expected_calibration_error"] == pytest.approx(0.05)
+
+def test_summary_of_mixed_predictions():
+    stats = ModelStats()
+    # Bin 0.9: 3 of 4 correct, mean confidence 0.9
+    stats.add_prediction(label=1, predicted_digit=1, confidence=0.9)
+    stats.add_prediction(label=2, predicted_digit=2, confidence=0.9)
+    stats.add_prediction(label=7, predicted_digit=7, confidence=0.9)
+    stats.add_prediction(label=7, predicted_digit=1, confidence=0.9)
+    # Bin 0.4: 1 of 2 correct, mean confidence 0.45
+    stats.add_prediction(label=4, predicted_digit=9, confidence=0.4)
+    stats.add_prediction(label=9, predicted_digit=9, confidence=0.5 - 1e-9)
+    summary = stats.summary()
+
+    assert summary["count"] == 6
+    assert summary["accuracy"] == pytest.approx(4 / 6)
+    assert summary["confusion_matrix"][7] == [0, 1, 0, 0, 0, 0, 0, 1, 0, 0]
+    assert summary["confusion_matrix"][4][9] == 1
+    assert summary["calibration"][9]["accuracy"] == pytest.approx(0.75)
+    assert summary["calibration"][4]["count"] == 2
+    assert summary["calibration"][4]["accuracy"] == pytest.approx(0.5)
+    assert summary["calibration"][4]["mean_confidence"] == pytest.approx(0.45)
+    # Weighted by each bin's share of the predictions
+    assert summary["expected_calibration_error"] == pytest.approx(4 / 6 * 0.15 + 2 / 6 * 0.05)
+
+def test_summary_of_no_predictions():
+    summary = ModelStats().summary()
+    assert summary["count"] == 0
+    assert summary["accuracy"] is None
+    assert summary["expected_calibration_error"] is None
+    assert len(summary["calibration"]) == CONFIDENCE_BIN_COUNT
+
+def test_stats_add_and_subtract_by_cell():
+    first = ModelStats()
+    first.add_prediction(label=5, predicted_digit=5, confidence=0.8)
+    second = ModelStats()
+    second.add_prediction(label=5, predicted_digit=6, confidence=0.3)
+
+    added = first + second
+    assert list(added.cells()) == [(5, 5, 8, 1, 0.8), (5, 6, 3, 1, 0.3)]
+    assert list((added - second).cells()) == list(first.cells())
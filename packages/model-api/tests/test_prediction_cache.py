@@ -0,0 +1,102 @@
+import asyncio
+import numpy as np
+import pytest
+
+from model_api import inference, predictions
+from model_api.predictions import ENSEMBLE_MODEL_NAME, PredictionCache, PredictionClassification, PredictionDigitData, PredictionRequest
+
+def prediction(model: str = "cnn-v1", **kwargs) -> PredictionClassification:
+    return PredictionClassification(model=model, predicted_digit=3, confidence=0.9, **kwargs)
+
+def test_hits_and_misses_are_counted():
+    cache = PredictionCache(max_entries=10, ttl_seconds=60)
+    assert cache.get(("a", "cnn-v1")) is None
+    cache.put(("a", "cnn-v1"), prediction())
+    assert cache.get(("a", "cnn-v1")) == prediction()
+    summary = cache.summary()
+    assert (summary["hits"], summary["misses"], summary["hit_rate"]) == (1, 1, 0.5)
+
+def test_expired_predictions_are_evicted():
+    cache = PredictionCache(max_entries=10, ttl_seconds=0)
+    cache.put(("a", "cnn-v1"), prediction())
+    assert cache.get(("a", "cnn-v1")) is None
+    assert cache.summary()["entries"] == 0
+    assert cache.evictions == 1
+
+def test_least_recently_used_predictions_are_evicted():
+    cache = PredictionCache(max_entries=2, ttl_seconds=60)
+    cache.put(("a", "cnn-v1"), prediction())
+    cache.put(("b", "cnn-v1"), prediction())
+    cache.get(("a", "cnn-v1"))
+    cache.put(("c", "cnn-v1"), prediction())
+    assert cache.get(("b", "cnn-v1")) is None
+    assert cache.get(("a", "cnn-v1")) is not None
+    assert cache.get(("c", "cnn-v1")) is not None
+
+def test_a_cache_without_entries_stores_nothing():
+    cache = PredictionCache(max_entries=0, ttl_seconds=60)
+    cache.put(("a", "cnn-v1"), prediction())
+    assert cache.summary()["entries"] == 0
+
+def test_invalidating_a_model_only_drops_its_predictions():
+    cache = PredictionCache(max_entries=10, ttl_seconds=60)
+    cache.put(("a", "cnn-v1"), prediction())
+    cache.put(("a", "cnn-v2"), prediction("cnn-v2"))
+    cache.invalidate_model("cnn-v1")
+    assert cache.get(("a", "cnn-v1")) is None
+    assert cache.get(("a", "cnn-v2")) is not None
+
+@pytest.fixture
+def weights_versions(monkeypatch) -> dict[str, str]:
+    """The weights version the registry reports for each model, with an empty cache"""
+    weights_versions = {model_name: "v1" for model_name in predictions.predictors}
+    monkeypatch.setattr(predictions.model_registry, "weights_version", lambda model_name: weights_versions[model_name])
+    monkeypatch.setattr(predictions, "prediction_cache", PredictionCache(max_entries=10, ttl_seconds=60))
+    return weights_versions
+
+def digit_request(*model_names: str) -> PredictionRequest:
+    return PredictionRequest(PredictionDigitData(np.zeros((28, 28), dtype=np.uint8)), model_names)
+
+def test_predictions_are_looked_up_by_the_current_weights_version(weights_versions):
+    request = digit_request("cnn-v1")
+    predictions.cache_predictions(request, [prediction(weights_versions=(("cnn-v1", "v1"),))])
+    assert predictions.get_cached_predictions(request) == [prediction(weights_versions=(("cnn-v1", "v1"),))]
+
+    weights_versions["cnn-v1"] = "v2"
+    assert predictions.get_cached_predictions(request) is None
+
+def test_predictions_are_cached_under_the_weights_version_they_were_made_with(weights_versions):
+    request = digit_request("cnn-v1")
+    # e.g. the weights were swapped whilst it was being predicted
+    predictions.cache_predictions(request, [prediction(weights_versions=(("cnn-v1", "v2"),))])
+    assert predictions.get_cached_predictions(request) is None
+
+    weights_versions["cnn-v1"] = "v2"
+    assert predictions.get_cached_predictions(request) is not None
+
+def test_only_predictions_of_every_requested_model_are_returned(weights_versions):
+    predictions.cache_predictions(digit_request("cnn-v1"), [prediction(weights_versions=(("cnn-v1", "v1"),))])
+    assert predictions.get_cached_predictions(digit_request("cnn-v1", "cnn-v2")) is None
+
+def test_ensemble_predictions_missing_members_are_not_cached(weights_versions):
+    (first_member, *_) = predictions.ensemble.weights
+    request = digit_request(ENSEMBLE_MODEL_NAME)
+    partial = prediction(ENSEMBLE_MODEL_NAME, combined_models=(first_member,), weights_versions=((first_member, "v1"),))
+    predictions.cache_predictions(request, [partial])
+    assert predictions.get_cached_predictions(request) is None
+
+def test_repeated_digits_are_predicted_once(weights_versions, monkeypatch):
+    batches = []
+
+    def create_predictions_batch(batch):
+        batches.append(batch)
+        return [[prediction(weights_versions=(("cnn-v1", "v1"),))] for _ in batch]
+    monkeypatch.setattr(inference, "create_predictions_batch", create_predictions_batch)
+    data = PredictionDigitData(np.zeros((28, 28), dtype=np.uint8))
+
+    async def main():
+        return [await inference.create_predictions(data, ("cnn-v1",)) for _ in range(2)]
+
+    (first, second) = asyncio.run(main())
+    assert first == second
+    assert len(batches) == 1
@@ -0,0 +1,78 @@
+import time
+import numpy as np
+import pytest
+
+from model_api import predictions
+from model_api.predictions import ENSEMBLE_MODEL_NAME, EnsemblePredictor, PredictionDigitData, PredictionRequest
+from model_api.predictions import configure_model_threads, create_predictions_batch, model_executor
+
+def digit_requests(count: int, model_names: tuple[str, ...], deadline: float | None = None) -> list[PredictionRequest]:
+    return [PredictionRequest(PredictionDigitData(np.zeros((28, 28), dtype=np.uint8)), model_names, deadline) for _ in range(count)]
+
+@pytest.fixture
+def parallel_models():
+    """Runs the models of a batch on two threads at once, as an inference worker with two cores would"""
+    configure_model_threads(2, 1)
+    yield
+    model_executor().shutdown(wait=True)
+    configure_model_threads(1, 1)
+
+def test_each_requested_model_predicts_each_digit(fake_models):
+    fake_models["cnn-v2"].predicts(7, 0.8)
+    batch = create_predictions_batch(digit_requests(2, ("cnn-v1", "cnn-v2")) + digit_requests(1, ("cnn-v2",)))
+    assert [[(x.model, x.predicted_digit) for x in digit] for digit in batch] == [
+        [("cnn-v1", 0), ("cnn-v2", 7)],
+        [("cnn-v1", 0), ("cnn-v2", 7)],
+        [("cnn-v2", 7)],
+    ]
+    # Each model runs once, over the digits which requested it
+    assert (fake_models["cnn-v1"].batch_sizes, fake_models["cnn-v2"].batch_sizes) == ([2], [3])
+
+def test_the_ensemble_averages_its_members_probabilities(fake_models):
+    fake_models["cnn-v1"].predicts(1, 0.6)
+    fake_models["cnn-v2"].predicts(2, 0.8)
+    [[prediction]] = create_predictions_batch(digit_requests(1, (ENSEMBLE_MODEL_NAME,)))
+    assert prediction.predicted_digit == 2
+    assert prediction.confidence == pytest.approx((0.8 + 0.4 / 9) / 2)
+    assert prediction.combined_models == ("cnn-v1", "cnn-v2")
+    assert prediction.weights_versions == (("cnn-v1", "v1"), ("cnn-v2", "v1"))
+
+def test_the_ensemble_weights_its_members(fake_models, monkeypatch):
+    monkeypatch.setattr(predictions, "ensemble", EnsemblePredictor(ENSEMBLE_MODEL_NAME, {"cnn-v1": 3.0, "cnn-v2": 1.0}))
+    fake_models["cnn-v1"].predicts(1, 0.6)
+    fake_models["cnn-v2"].predicts(2, 0.8)
+    [[prediction]] = create_predictions_batch(digit_requests(1, (ENSEMBLE_MODEL_NAME,)))
+    assert prediction.predicted_digit == 1
+    assert prediction.confidence == pytest.approx((3 * 0.6 + 0.2 / 9) / 4)
+
+def test_models_run_in_chunks_only_with_a_deadline(fake_models, monkeypatch):
+    monkeypatch.setattr(predictions, "DEADLINE_CHUNK_SIZE", 8)
+    create_predictions_batch(digit_requests(20, ("cnn-v1",)))
+    create_predictions_batch(digit_requests(20, ("cnn-v1",), deadline=time.monotonic() + 60))
+    assert fake_models["cnn-v1"].batch_sizes == [20, 8, 8, 4]
+
+def test_models_after_the_deadline_are_skipped(fake_models):
+    batch = create_predictions_batch(digit_requests(2, ("cnn-v1", "cnn-v2", ENSEMBLE_MODEL_NAME), deadline=time.monotonic() - 1))
+    for digit_predictions in batch:
+        # The first model is still waited for, and the ensemble only combines it
+        assert [x.model for x in digit_predictions] == ["cnn-v1", ENSEMBLE_MODEL_NAME]
+        assert digit_predictions[1].combined_models == ("cnn-v1",)
+    assert fake_models["cnn-v2"].batch_sizes == []
+
+def test_parallel_models_after_the_deadline_are_left_out(fake_models, parallel_models):
+    fake_models["cnn-v2"].delay_seconds = 0.5
+    started_at = time.monotonic()
+    [digit_predictions] = create_predictions_batch(digit_requests(1, ("cnn-v1", "cnn-v2"), deadline=time.monotonic() + 0.1))
+    assert time.monotonic() - started_at < 0.5
+    assert [x.model for x in digit_predictions] == ["cnn-v1"]
+
+def test_parallel_models_wait_for_the_first_to_finish_after_the_deadline(fake_models, parallel_models):
+    fake_models["cnn-v1"].delay_seconds = 0.5
+    fake_models["cnn-v2"].delay_seconds = 0.1
+    [digit_predictions] = create_predictions_batch(digit_requests(1, ("cnn-v1", "cnn-v2"), deadline=time.monotonic() - 1))
+    assert [x.model for x in digit_predictions] == ["cnn-v2"]
+
+def test_parallel_models_without_a_deadline_all_finish(fake_models, parallel_models):
+    fake_models["cnn-v2"].delay_seconds = 0.1
+    [digit_predictions] = create_predictions_batch(digit_requests(1, ("cnn-v1", "cnn-v2")))
+    assert [x.model for x in digit_predictions] == ["cnn-v1", "cnn-v2"]
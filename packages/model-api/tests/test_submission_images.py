@@ -0,0 +1,99 @@
+import datetime
+import numpy as np
+import pytest
+
+from model_api import inference, main, submission_store, wire_formats
+from model_api.submission_store import DbSubmission, InMemorySubmissionStore
+
+def digit_pixels(seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (28, 28), dtype=np.uint8)
+
+@pytest.fixture
+def store(monkeypatch) -> InMemorySubmissionStore:
+    store = InMemorySubmissionStore(capacity=100)
+    monkeypatch.setattr(submission_store, "submission_store", store)
+    monkeypatch.setattr(main, "submission_store", store)
+    return store
+
+def stored_submission(pixels: np.ndarray | None = None, png_bytes: bytes | None = None) -> DbSubmission:
+    return DbSubmission(
+        timestamp=datetime.datetime.now(datetime.UTC),
+        deflated_pixels=wire_formats.encode_deflated_pixels(pixels) if pixels is not None else None,
+        png_bytes=png_bytes,
+        label=1,
+        predictions=[],
+    )
+
+def test_deflated_pixels_round_trip():
+    pixels = digit_pixels()
+    deflated_pixels = wire_formats.encode_deflated_pixels(pixels)
+    assert np.array_equal(wire_formats.decode_deflated_pixels(deflated_pixels)[0], pixels)
+    # A blank digit, like most of a drawn one, is far smaller deflated
+    assert len(wire_formats.encode_deflated_pixels(np.full((28, 28), 255, dtype=np.uint8))) < wire_formats.DIGIT_BYTES / 10
+
+def test_invalid_deflated_pixels_are_rejected():
+    with pytest.raises(ValueError):
+        wire_formats.decode_deflated_pixels(b"not deflated")
+
+def test_stored_pixels_are_read_from_an_earlier_versions_png():
+    pixels = digit_pixels()
+    assert np.array_equal(wire_formats.decode_stored_pixels(None, wire_formats.encode_png_pixels(pixels))[0], pixels)
+    with pytest.raises(ValueError):
+        wire_formats.decode_stored_pixels(None, None)
+
+def test_submitted_digits_are_stored_deflated(client, store, fake_models, monkeypatch):
+    monkeypatch.setattr(inference, "start_warm_up", lambda: None)
+    pixels = digit_pixels()
+    # The lifespan writes the submissions still queued as the client closes
+    with client:
+        response = client.post("/submit-digit?models=cnn-v1", json={"digit": {"pixels": pixels.tolist()}, "label": 3})
+        assert response.status_code == 200
+    [submission] = store.get_submissions(submission_store.SubmissionQuery())
+    assert submission.png_bytes is None
+    assert np.array_equal(wire_formats.decode_deflated_pixels(submission.deflated_pixels)[0], pixels)
+    assert (submission.label, [x["model"] for x in submission.predictions]) == (3, ["cnn-v1"])
+
+@pytest.mark.parametrize("stored_as", ["deflated", "png"])
+def test_submission_images_are_served_as_pngs(client, store, stored_as):
+    pixels = digit_pixels()
+    if stored_as == "deflated":
+        store.add_submission(stored_submission(pixels))
+    else:
+        store.add_submission(stored_submission(png_bytes=wire_formats.encode_png_pixels(pixels)))
+    response = client.get("/submissions/1/image.png")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert "immutable" in response.headers["cache-control"]
+    assert np.array_equal(wire_formats.decode_png_pixels(response.content)[0], pixels)
+
+def test_etags_depend_only_on_the_pixels(client, store):
+    pixels = digit_pixels()
+    store.add_submissions([
+        stored_submission(pixels),
+        stored_submission(png_bytes=wire_formats.encode_png_pixels(pixels)),
+        stored_submission(digit_pixels(seed=1)),
+    ])
+    etags = [client.get(f"/submissions/{id}/image.png").headers["etag"] for id in (1, 2, 3)]
+    assert etags[0].startswith('W/"')
+    assert etags[0] == etags[1]
+    assert etags[0] != etags[2]
+
+@pytest.mark.parametrize("if_none_match", ["{etag}", "{strong_etag}", '"other", {etag}', "*"])
+def test_a_matching_etag_is_a_304(client, store, if_none_match):
+    store.add_submission(stored_submission(digit_pixels()))
+    etag = client.get("/submissions/1/image.png").headers["etag"]
+    response = client.get(
+        "/submissions/1/image.png",
+        headers={"If-None-Match": if_none_match.format(etag=etag, strong_etag=etag.removeprefix("W/"))},
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+def test_a_different_etag_gets_the_image(client, store):
+    store.add_submission(stored_submission(digit_pixels()))
+    response = client.get("/submissions/1/image.png", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+def test_a_missing_submission_is_a_404(client, store):
+    assert client.get("/submissions/1/image.png").status_code == 404
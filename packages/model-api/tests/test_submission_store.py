@@ -0,0 +1,91 @@
+import base64
+import datetime
+import numpy as np
+import pytest
+
+from model_api import main
+from model_api.submission_store import DbSubmission, InMemorySubmissionStore, SubmissionCursor, SubmissionQuery
+from model_api.wire_formats import encode_deflated_pixels
+
+START = datetime.datetime(2026, 10, 1, tzinfo=datetime.UTC)
+
+def submission(seconds: int, label: int = 1, predicted_digit: int = 1, model: str = "cnn-v1") -> DbSubmission:
+    return DbSubmission(
+        timestamp=START + datetime.timedelta(seconds=seconds),
+        deflated_pixels=encode_deflated_pixels(np.full((28, 28), seconds, dtype=np.uint8)),
+        label=label,
+        predictions=[{"model": model, "predicted_digit": predicted_digit, "confidence": 0.9}],
+    )
+
+@pytest.fixture
+def store() -> InMemorySubmissionStore:
+    store = InMemorySubmissionStore(capacity=100)
+    # Some share a timestamp, so are ordered by their id
+    store.add_submissions([submission(seconds) for seconds in (0, 1, 1, 1, 2, 3, 4)])
+    return store
+
+def all_pages(store: InMemorySubmissionStore, **kwargs) -> list[list[int]]:
+    pages = []
+    after = None
+    while True:
+        page = store.get_submissions(SubmissionQuery(limit=3, after=after, **kwargs))
+        if page:
+            pages.append([x.id for x in page])
+        if len(page) < 3:
+            return pages
+        after = SubmissionCursor.after(page[-1])
+
+def test_pages_are_the_most_recent_first(store):
+    assert all_pages(store) == [[7, 6, 5], [4, 3, 2], [1]]
+
+def test_pages_after_a_cursor_are_not_shifted_by_new_submissions(store):
+    first_page = store.get_submissions(SubmissionQuery(limit=3))
+    store.add_submissions([submission(5), submission(6)])
+    second_page = store.get_submissions(SubmissionQuery(limit=3, after=SubmissionCursor.after(first_page[-1])))
+    assert [x.id for x in second_page] == [4, 3, 2]
+
+def test_pages_can_be_filtered(store):
+    store.add_submissions([
+        submission(5, label=2, predicted_digit=2),
+        submission(6, label=2, predicted_digit=3),
+        submission(7, label=4, predicted_digit=4, model="cnn-v2"),
+    ])
+    assert all_pages(store, label=2) == [[9, 8]]
+    assert all_pages(store, model="cnn-v2") == [[10]]
+    assert all_pages(store, misclassified=True) == [[9]]
+    assert all_pages(store, model="cnn-v2", misclassified=True) == []
+
+def test_cursors_round_trip():
+    cursor = SubmissionCursor(timestamp=START, id=12)
+    assert SubmissionCursor.decode(cursor.encode()) == cursor
+    # Timestamps read back without a timezone are UTC
+    assert SubmissionCursor(timestamp=START.replace(tzinfo=None), id=12) == cursor
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    base64.urlsafe_b64encode(b"2026-10-01T00:00:00+00:00").decode(),
+    base64.urlsafe_b64encode(b"yesterday|1").decode(),
+    base64.urlsafe_b64encode(b"2026-10-01T00:00:00+00:00|one").decode(),
+])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        SubmissionCursor.decode(cursor)
+
+def test_recent_submissions_are_paged_through_with_next_cursor(client, store, monkeypatch):
+    monkeypatch.setattr(main, "submission_store", store)
+    pages = []
+    params = {"limit": 3, "include_images": False}
+    while True:
+        response = client.get("/recent-submissions", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        pages.append([x["id"] for x in page["submissions"]])
+        if page["next_cursor"] is None:
+            break
+        params["cursor"] = page["next_cursor"]
+    assert pages == [[7, 6, 5], [4, 3, 2], [1]]
+
+def test_an_invalid_cursor_is_a_400(client):
+    response = client.get("/recent-submissions", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+
+from model_api.executor import BoundedExecutor, OverloadedError
+from model_api.write_behind import WriteBehindQueue
+
+@pytest.fixture
+def executor():
+    executor = BoundedExecutor(name="test-store", max_workers=1, max_queue_size=4)
+    yield executor
+    executor.shutdown()
+
+def recording_queue(batches: list, executor: BoundedExecutor, **kwargs) -> WriteBehindQueue:
+    return WriteBehindQueue(name="test", write_batch=batches.append, executor=executor, **kwargs)
+
+def test_items_are_written_in_batches_of_at_most_max_batch_size(executor):
+    batches = []
+    queue = recording_queue(batches, executor, max_batch_size=3, max_wait_seconds=0.05, max_queue_size=10)
+
+    async def main():
+        for i in range(7):
+            queue.enqueue(i)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert queue.summary()["written_count"] == 7
+    assert queue.summary()["batch_count"] == 3
+
+def test_items_after_the_window_are_written_in_a_new_batch(executor):
+    batches = []
+    queue = recording_queue(batches, executor, max_batch_size=10, max_wait_seconds=0.02, max_queue_size=10)
+
+    async def main():
+        queue.enqueue(1)
+        await asyncio.sleep(0.1)
+        queue.enqueue(2)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert batches == [[1], [2]]
+
+def test_stop_writes_everything_still_queued(executor):
+    batches = []
+    queue = recording_queue(batches, executor, max_batch_size=10, max_wait_seconds=0.05, max_queue_size=10)
+
+    async def main():
+        for i in range(3):
+            queue.enqueue(i)
+        await queue.stop()
+        return queue.pending
+
+    assert asyncio.run(main()) == 0
+    assert batches == [[0, 1, 2]]
+
+def test_failed_writes_are_retried(executor):
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(batch)
+        if len(attempts) == 1:
+            raise ConnectionError("database unavailable")
+    queue = WriteBehindQueue(
+        name="test", write_batch=write_batch, executor=executor,
+        max_batch_size=10, max_wait_seconds=0.01, max_queue_size=10, retry_delay_seconds=0.001,
+    )
+
+    async def main():
+        queue.enqueue(1)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert attempts == [[1], [1]]
+    summary = queue.summary()
+    assert (summary["written_count"], summary["retry_count"], summary["failed_count"]) == (1, 1, 0)
+    assert summary["last_error"] == "ConnectionError: database unavailable"
+
+def test_items_failing_every_attempt_are_counted_as_failed(executor):
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(batch)
+        raise ConnectionError("database unavailable")
+    queue = WriteBehindQueue(
+        name="test", write_batch=write_batch, executor=executor,
+        max_batch_size=10, max_wait_seconds=0.01, max_queue_size=10, max_attempts=3, retry_delay_seconds=0.001,
+    )
+
+    async def main():
+        queue.enqueue(1)
+        queue.enqueue(2)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert len(attempts) == 3
+    summary = queue.summary()
+    assert (summary["written_count"], summary["retry_count"], summary["failed_count"]) == (0, 2, 2)
+
+def test_items_beyond_max_queue_size_are_dropped(executor):
+    batches = []
+    queue = recording_queue(batches, executor, max_batch_size=10, max_wait_seconds=0.01, max_queue_size=2)
+
+    async def main():
+        queue.enqueue(1)
+        queue.enqueue(2)
+        with pytest.raises(OverloadedError):
+            queue.enqueue(3)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert batches == [[1, 2]]
+    assert (queue.summary()["enqueued_count"], queue.summary()["dropped_count"]) == (2, 1)
+
+@pytest.mark.parametrize("kwargs", [{"max_batch_size": 0, "max_queue_size": 1}, {"max_batch_size": 1, "max_queue_size": 0}])
+def test_invalid_limits_are_rejected(executor, kwargs):
+    with pytest.raises(ValueError):
+        recording_queue([], executor, max_wait_seconds=0.01, **kwargs)
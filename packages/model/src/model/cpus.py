@@ -0,0 +1,31 @@
+"""How many CPUs this process can use, for sizing its threads and worker processes"""
+import math
+import os
+from pathlib import Path
+
+def cgroup_cpu_quota() -> float | None:
+    """The number of CPUs' worth of time a container's cgroup may use (e.g. docker's --cpus), if it's limited"""
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" when unlimited
+        (quota, period) = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        return int(quota) / int(period) if quota != "max" else None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 when unlimited
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpu_count() -> int:
+    """The number of CPUs this process is allowed to run on, limited by any CPU quota of its container"""
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpu_count = min(cpu_count, max(1, math.ceil(quota)))
+    return cpu_count
@@ -0,0 +1,38 @@
+"""
+Loading digit datasets as N x 28 x 28 uint8 arrays in the same convention as the api:
+greyscale, with a white background (255) and a dark digit.
+"""
+from pathlib import Path
+import numpy as np
+
+def mnist_files(data_dir: str | Path, train: bool = True) -> tuple[Path, Path]:
+    """
+    Downloads MNIST to data_dir if needed, and returns the paths of its (pixels, labels) as .npy files,
+    cached in data_dir. MNIST digits are white on black, so the pixels are inverted to match the api.
+    """
+    split = "train" if train else "test"
+    pixels_path = Path(data_dir) / f"mnist-{split}-pixels.npy"
+    labels_path = Path(data_dir) / f"mnist-{split}-labels.npy"
+    if not (pixels_path.exists() and labels_path.exists()):
+        import torchvision
+        dataset = torchvision.datasets.MNIST(str(data_dir), train=train, download=True)
+        np.save(pixels_path, 255 - dataset.data.numpy())
+        np.save(labels_path, dataset.targets.numpy().astype(np.uint8))
+    return (pixels_path, labels_path)
+
+def load_mnist_pixels(data_dir: str | Path, train: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    """Downloads MNIST to data_dir if needed, and returns its (pixels, labels), memory-mapped"""
+    (pixels_path, labels_path) = mnist_files(data_dir, train)
+    return (load_pixels_file(pixels_path), np.load(labels_path, mmap_mode="r"))
+
+def exported_submission_files(export_dir: str | Path) -> list[tuple[Path, Path]]:
+    """The (pixels, labels) .npy files of each part exported by model_api.submission_export, in order"""
+    part_dirs = sorted(x for x in Path(export_dir).glob("part-*") if x.is_dir() and not x.name.endswith(".tmp"))
+    return [(x / "images.npy", x / "labels.npy") for x in part_dirs]
+
+def load_pixels_file(path: str | Path) -> np.ndarray:
+    """Loads an N x 28 x 28 uint8 array of digits from a .npy file, memory-mapped"""
+    pixels = np.load(path, mmap_mode="r")
+    if pixels.dtype != np.uint8 or pixels.ndim != 3 or pixels.shape[1:] != (28, 28):
+        raise ValueError(f"Expected an N x 28 x 28 uint8 array in {path}, got {pixels.dtype} array of shape {pixels.shape}")
+    return pixels
@@ -1,8 +1,61 @@
+import functools
+import hashlib
+import warnings
+from pathlib import Path
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import PIL.Image
-from torchvision.transforms import v2
+import numpy as np
+
+def affine_transform(images: torch.Tensor, angles: torch.Tensor, scales: torch.Tensor, translations: torch.Tensor) -> torch.Tensor:
+    """
+    Rotates (by angles in radians), scales and translates (by N x 2 fractions of the image's width and height)
+    each image of an N x 1 x H x W batch with a black background, about its centre.
+    """
+    # affine_grid maps output coordinates to input coordinates, so invert the scale
+    cos = torch.cos(angles) / scales
+    sin = torch.sin(angles) / scales
+    # affine_grid's coordinates span -1 to 1, so are twice the fraction of the image
+    theta = torch.stack([
+        torch.stack([cos, -sin, translations[:, 0] * 2], dim=1),
+        torch.stack([sin, cos, translations[:, 1] * 2], dim=1),
+    ], dim=1)
+    grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+    return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+def test_time_augmentations(shift_pixels: float, rotation_degrees: float) -> tuple[tuple[float, float, float], ...]:
+    """
+    The (rotation in degrees, x shift in pixels, y shift in pixels) of each test-time augmentation:
+    the original image, shifted each way by shift_pixels and rotated each way by rotation_degrees (unless 0).
+    """
+    (shift_pixels, rotation_degrees) = (float(shift_pixels), float(rotation_degrees))
+    augmentations = [(0.0, 0.0, 0.0)]
+    if shift_pixels != 0:
+        augmentations += [(0.0, shift_pixels, 0.0), (0.0, -shift_pixels, 0.0), (0.0, 0.0, shift_pixels), (0.0, 0.0, -shift_pixels)]
+    if rotation_degrees != 0:
+        augmentations += [(rotation_degrees, 0.0, 0.0), (-rotation_degrees, 0.0, 0.0)]
+    return tuple(augmentations)
+
+def augment_batch(image_batch: torch.Tensor, augmentations: tuple[tuple[float, float, float], ...]) -> torch.Tensor:
+    """
+    Expects an N x 1 x 28 x 28 batch of tensors from pixels_tensor, and returns the (K * N) x 1 x 28 x 28
+    batch of each of its K augmentations (see test_time_augmentations) in turn, so they can be run as one batch.
+    """
+    batch_size = image_batch.shape[0]
+    transformed = [(i, augmentation) for (i, augmentation) in enumerate(augmentations) if augmentation != (0.0, 0.0, 0.0)]
+    augmented = image_batch.repeat(len(augmentations), 1, 1, 1)
+    if transformed:
+        # A row of rotation and x and y shift per image, for every image of every transformed augmentation
+        parameters = torch.tensor([augmentation for (_i, augmentation) in transformed], dtype=torch.float32).repeat_interleave(batch_size, dim=0)
+        rows = torch.cat([torch.arange(i * batch_size, (i + 1) * batch_size) for (i, _augmentation) in transformed])
+        augmented[rows] = affine_transform(
+            augmented[rows],
+            angles=torch.deg2rad(parameters[:, 0]),
+            scales=torch.ones(len(rows)),
+            translations=parameters[:, 1:] / image_batch.shape[-1],
+        )
+    return augmented
 
 class FirstNetwork(nn.Module):
     def __init__(self):
@@ -87,29 +140,63 @@ class SecondNetwork(nn.Module):
         return self.layers(x)
 
 class DigitModelBase:
-    def __init__(self, network):
+    def __init__(self, network, weights_version: str = "unversioned"):
         self.network = network
+        """Identifies the loaded weights, so that anything derived from them can be invalidated when they change"""
+        self.weights_version = weights_version
+
+    @staticmethod
+    def pixels_tensor(pixels: np.ndarray, scale: bool) -> torch.Tensor:
+        """
+        Expects an N x 28 x 28 uint8 array of greyscale images with a white background,
+        and returns the inverted N x 1 x 28 x 28 float tensor which the network expects.
+        """
+        if pixels.dtype != np.uint8 or pixels.ndim != 3 or pixels.shape[1:] != (28, 28):
+            raise ValueError(f"Expected an N x 28 x 28 uint8 array, got {pixels.dtype} array of shape {pixels.shape}")
+        with warnings.catch_warnings():
+            # A read-only array (e.g. from np.frombuffer) is fine, as we never write to the shared tensor
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            shared_tensor = torch.from_numpy(pixels)
+        # The conversion to float is the only copy; the inversion and scaling happen in place
+        image_batch = shared_tensor.unsqueeze(1).to(torch.float32)
+        image_batch.neg_().add_(255.0)
+        if scale:
+            image_batch.div_(255.0)
+        return image_batch
+
+    def probabilities_from_tensor(self, image_batch: torch.Tensor, temperature: float) -> torch.Tensor:
+        """
+        Expects an N x 1 x 28 x 28 batch of tensors from pixels_tensor,
+        and returns an N x 10 tensor of digit probabilities.
+        """
+        with torch.inference_mode():
+            logits = self.network(image_batch)
+            return F.softmax(logits * temperature, dim=1)
+
+    def augmented_probabilities_from_tensor(self, image_batch: torch.Tensor, temperature: float, augmentations: tuple[tuple[float, float, float], ...]) -> torch.Tensor:
+        """
+        Expects an N x 1 x 28 x 28 batch of tensors from pixels_tensor, and returns an N x 10 tensor
+        of digit probabilities, averaged over its augmentations, which are run through the network as one batch.
+        """
+        probabilities = self.probabilities_from_tensor(augment_batch(image_batch, augmentations), temperature)
+        return probabilities.view(len(augmentations), len(image_batch), 10).mean(dim=0)
+
+    def probabilities_batch(self, pixels: np.ndarray, temperature: float, scale: bool) -> np.ndarray:
+        """
+        Expects an N x 28 x 28 uint8 array of greyscale images with a white background,
+        and returns an N x 10 array of digit probabilities.
+        """
+        return self.probabilities_from_tensor(self.pixels_tensor(pixels, scale), temperature).numpy()
 
     def probabilities(self, pil_image: PIL.Image.Image, temperature: float, scale: bool):
         """
         Expects a 28x28 greyscale image with a white background,
         and returns a list of 10 (digit, probability) tuples.
         """
-        transform = v2.Compose([
-            v2.ToImage(),
-            v2.ToDtype(dtype=torch.float32, scale=scale),
-        ])
-        image_tensor = transform(pil_image)
-        # Invert black and white
-        ones = torch.full_like(image_tensor, 1.0 if scale else 255.0)
-        image_tensor = ones - image_tensor
-
-        if image_tensor.shape != (1, 28, 28):
+        pixels = np.asarray(pil_image, dtype=np.uint8)
+        if pixels.shape != (28, 28):
             raise ValueError("Expected a 28x28 greyscale image")
-        singleton_batch = torch.stack([image_tensor])
-        logits = self.network(singleton_batch)
-        digit_probabilities = [x for x in enumerate(F.softmax(logits * temperature, dim=1)[0].tolist())]
-        return digit_probabilities
+        return [x for x in enumerate(self.probabilities_batch(pixels[np.newaxis], temperature, scale)[0].tolist())]
 
     def predict(self, pil_image: PIL.Image.Image, temperature: float, scale: bool):
         """
@@ -118,20 +205,81 @@ class DigitModelBase:
         """
         return max(self.probabilities(pil_image, temperature, scale), key=lambda x: x[1])
 
+    def predict_batch(self, pixels: np.ndarray, temperature: float, scale: bool):
+        """
+        Expects an N x 28 x 28 uint8 array of greyscale images with a white background,
+        runs them through the network as a single batch,
+        and returns a list of N (predicted_digit, probability) in the same order.
+        """
+        return self.top_predictions(self.probabilities_batch(pixels, temperature, scale))
+
+    @staticmethod
+    def top_predictions(probabilities: np.ndarray):
+        """
+        Expects an N x 10 array of digit probabilities,
+        and returns a list of N (predicted_digit, probability) in the same order.
+        """
+        predicted_digits = probabilities.argmax(axis=1)
+        confidences = probabilities[np.arange(len(predicted_digits)), predicted_digits]
+        return list(zip(predicted_digits.tolist(), confidences.tolist()))
+
+@functools.cache
+def packaged_weights_version(weights_filename: str) -> str:
+    """A version hash of weights packaged alongside this module, which doesn't need them to be loaded"""
+    from importlib import resources
+    with resources.files(__package__).joinpath(weights_filename).open("rb") as weights_file:
+        return hashlib.file_digest(weights_file, "sha256").hexdigest()[:16]
+
+def weights_file_version(weights_path: Path) -> str:
+    """A version hash of a weights file, e.g. a checkpoint saved by model-train"""
+    with open(weights_path, "rb") as weights_file:
+        return hashlib.file_digest(weights_file, "sha256").hexdigest()[:16]
+
+def _load_weights_file(network: nn.Module, weights_path: Path):
+    # The weights are memory-mapped and assigned to the network rather than copied into it,
+    # so processes loading the same file share its pages
+    state_dict = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+    network.load_state_dict(state_dict, assign=True)
+    network.requires_grad_(False)
+    network.eval()
+
+def load_packaged_weights(network: nn.Module, weights_filename: str) -> str:
+    """
+    Loads weights packaged alongside this module into the network, and puts it in eval mode.
+    Returns a version hash of the weights.
+    """
+    from importlib import resources
+    with resources.as_file(resources.files(__package__).joinpath(weights_filename)) as weights_path:
+        _load_weights_file(network, weights_path)
+    return packaged_weights_version(weights_filename)
+
+def load_weights(network: nn.Module, weights_filename: str, weights_path: Path | None) -> str:
+    """Loads the weights at weights_path (or if None, the packaged weights) into the network, returning their version hash"""
+    if weights_path is None:
+        return load_packaged_weights(network, weights_filename)
+    _load_weights_file(network, weights_path)
+    return weights_file_version(weights_path)
+
 class FirstModel(DigitModelBase):
-    def __init__(self):
-        network = FirstNetwork()
-        from importlib import resources
-        weights = resources.open_binary(__package__, "model_v1.pth")
-        network.load_state_dict(torch.load(weights, map_location="cpu"))
-        network.eval()
-        super().__init__(network)
+    network_class = FirstNetwork
+    weights_filename = "model_v1.pth"
+    """Whether the network was trained on pixels scaled to [0, 1], rather than [0, 255]"""
+    scale_inputs = False
+
+    def __init__(self, weights_path: Path | None = None):
+        """Loads the packaged weights, or those at weights_path, e.g. a retrained checkpoint"""
+        network = self.network_class()
+        weights_version = load_weights(network, self.weights_filename, weights_path)
+        super().__init__(network, weights_version)
 
 class SecondModel(DigitModelBase):
-    def __init__(self):
-        network = SecondNetwork()
-        from importlib import resources
-        weights = resources.open_binary(__package__, "model_v2.pth")
-        network.load_state_dict(torch.load(weights, map_location="cpu"))
-        network.eval()
-        super().__init__(network)
\ No newline at end of file
+    network_class = SecondNetwork
+    weights_filename = "model_v2.pth"
+    """Whether the network was trained on pixels scaled to [0, 1], rather than [0, 255]"""
+    scale_inputs = True
+
+    def __init__(self, weights_path: Path | None = None):
+        """Loads the packaged weights, or those at weights_path, e.g. a retrained checkpoint"""
+        network = self.network_class()
+        weights_version = load_weights(network, self.weights_filename, weights_path)
+        super().__init__(network, weights_version)
@@ -0,0 +1,239 @@
+"""
+Exports optimized inference artifacts for the packaged models, next to their .pth weights.
+
+The eager networks are first simplified for inference:
+* AssertShape and Dropout layers (both no-ops in eval mode) are removed
+* Each BatchNorm2d is folded into the weights of the Conv2d which follows it
+
+And then either traced and frozen with TorchScript, or exported to ONNX (for use with ONNX Runtime, if installed).
+Every export is checked for parity against the eager network before it's saved.
+
+Run with: uv run --package model model-export
+"""
+import argparse
+import copy
+import importlib.util
+import os
+from pathlib import Path
+from typing import Callable
+import torch
+import torch.nn as nn
+from .digit_model import AssertShape, DigitModelBase, FirstModel, FirstNetwork, SecondModel, packaged_weights_version, weights_file_version
+
+RUNTIMES = ["eager", "torchscript", "onnxruntime"]
+PACKAGED_MODELS: dict[str, type[DigitModelBase]] = {
+    "v1": FirstModel,
+    "v2": SecondModel,
+}
+# Differences from folding and fusing should be far below this, relative to the largest logit
+PARITY_TOLERANCE = 1e-4
+
+def fold_batch_norm_into_conv(batch_norm: nn.BatchNorm2d, conv: nn.Conv2d) -> nn.Conv2d:
+    """
+    Returns a Conv2d equivalent to applying batch_norm (in eval mode) and then conv.
+
+    The batch norm is an affine map x * scale + shift per channel, which, as the conv is linear,
+    can be pushed into its weights and bias. This is only exact if the conv doesn't pad its input,
+    as padding would be applied after the shift.
+    """
+    if any(padding != 0 for padding in conv.padding) or conv.groups != 1:
+        raise ValueError("Can only fold a batch norm into a conv without padding or groups")
+    scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+    shift = batch_norm.bias - batch_norm.running_mean * scale
+
+    folded = copy.deepcopy(conv)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight * scale.reshape(1, -1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels)
+        folded.bias = nn.Parameter(bias + (conv.weight * shift.reshape(1, -1, 1, 1)).sum(dim=(1, 2, 3)))
+    return folded
+
+def simplify_for_inference(layers: nn.Sequential, fold_batch_norms: bool = True) -> nn.Sequential:
+    """Removes no-op layers, and (unless fold_batch_norms is False) folds each batch norm into the conv after it"""
+    remaining = [layer for layer in layers if not isinstance(layer, (AssertShape, nn.Dropout))]
+    if not fold_batch_norms:
+        return nn.Sequential(*remaining).eval()
+    simplified = []
+    pending_batch_norm = None
+    for layer in remaining:
+        if isinstance(layer, nn.BatchNorm2d):
+            if pending_batch_norm is not None:
+                raise ValueError("Can't fold consecutive batch norms")
+            pending_batch_norm = layer
+        elif pending_batch_norm is not None and isinstance(layer, nn.Conv2d):
+            simplified.append(fold_batch_norm_into_conv(pending_batch_norm, layer))
+            pending_batch_norm = None
+        elif pending_batch_norm is not None and isinstance(layer, (nn.ReLU, nn.MaxPool2d)):
+            # Nothing in our networks does this, and these don't commute with the affine batch norm
+            raise ValueError(f"Can't fold a batch norm past a {type(layer).__name__}")
+        else:
+            simplified.append(layer)
+    if pending_batch_norm is not None:
+        simplified.append(pending_batch_norm)
+    return nn.Sequential(*simplified).eval()
+
+def as_sequential(network: nn.Module) -> nn.Sequential:
+    """Returns the network's layers as an nn.Sequential, sharing their parameters"""
+    if isinstance(network, FirstNetwork):
+        # Equivalent to FirstNetwork.forward
+        return nn.Sequential(
+            network.conv1, nn.ReLU(), network.pool,
+            network.conv2, nn.ReLU(), network.pool,
+            nn.Flatten(),
+            network.fc1, nn.ReLU(),
+            network.fc2, nn.ReLU(),
+            network.fc3,
+        )
+    if hasattr(network, "layers") and isinstance(network.layers, nn.Sequential):
+        return network.layers
+    raise ValueError(f"Unsupported network {type(network).__name__}")
+
+def optimize_network(network: nn.Module, fold_batch_norms: bool = True) -> nn.Sequential:
+    """Returns an equivalent network for inference, without modifying the original"""
+    return simplify_for_inference(as_sequential(copy.deepcopy(network).eval()), fold_batch_norms)
+
+def example_batch(batch_size: int = 16) -> torch.Tensor:
+    """A reproducible batch of noise, in the range of both scaled and unscaled inputs"""
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand((batch_size, 1, 28, 28), generator=generator) * 255
+
+def check_parity(eager_network: nn.Module, optimized_network, inputs: torch.Tensor | None = None):
+    """Raises if the optimized network's logits differ from the eager network's by more than PARITY_TOLERANCE (relatively)"""
+    for scale in (1.0, 1 / 255):
+        batch = (inputs if inputs is not None else example_batch()) * scale
+        with torch.inference_mode():
+            expected = eager_network(batch)
+            actual = optimized_network(batch)
+        max_difference = (expected - actual).abs().max().item()
+        if max_difference > PARITY_TOLERANCE * max(1.0, expected.abs().max().item()):
+            raise RuntimeError(f"Optimized network differs from the eager network by up to {max_difference}")
+
+def artifact_path(model_class: type[DigitModelBase], runtime: str, weights_path: Path | None = None) -> Path:
+    """Where the artifact of the packaged weights (or those at weights_path) is exported to, next to the weights"""
+    if weights_path is None:
+        weights_path = Path(__file__).parent / model_class.weights_filename
+    suffix = {"torchscript": ".torchscript.pt", "onnxruntime": ".onnx"}[runtime]
+    return weights_path.with_suffix(suffix)
+
+def version_path(path: Path) -> Path:
+    return path.with_name(path.name + ".version")
+
+def is_up_to_date(path: Path, weights_version: str) -> bool:
+    """Whether the artifact at path exists, and was exported from the given weights version"""
+    artifact_version_path = version_path(path)
+    return path.exists() and artifact_version_path.exists() and artifact_version_path.read_text().strip() == weights_version
+
+def write_atomically(path: Path, write: Callable[[Path], None]):
+    # Several worker processes may export the same artifact at once, so never expose a partial file
+    temporary_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        write(temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+def export_torchscript(network: nn.Module, path: Path, weights_version: str):
+    traced = torch.jit.freeze(torch.jit.trace(network, example_batch()))
+    write_atomically(path, lambda temporary_path: torch.jit.save(traced, temporary_path))
+    write_atomically(version_path(path), lambda temporary_path: temporary_path.write_text(weights_version))
+
+def export_onnx(network: nn.Module, path: Path, weights_version: str):
+    write_atomically(path, lambda temporary_path: torch.onnx.export(
+        network,
+        (example_batch(),),
+        temporary_path,
+        input_names=["images"],
+        output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+        dynamo=False,
+    ))
+    write_atomically(version_path(path), lambda temporary_path: temporary_path.write_text(weights_version))
+
+class OnnxRuntimeNetwork:
+    """Runs an exported ONNX network with ONNX Runtime, taking and returning torch tensors like the network"""
+
+    def __init__(self, path: Path, intra_op_threads: int | None = None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        (logits,) = self.session.run(["logits"], {"images": images.numpy()})
+        return torch.from_numpy(logits)
+
+def onnxruntime_available() -> bool:
+    """Whether ONNX artifacts can be both exported (needing onnx) and run (needing onnxruntime)"""
+    return importlib.util.find_spec("onnx") is not None and importlib.util.find_spec("onnxruntime") is not None
+
+def _load_artifact(path: Path, runtime: str):
+    if runtime == "torchscript":
+        return torch.jit.load(path, map_location="cpu").eval()
+    return OnnxRuntimeNetwork(path, intra_op_threads=torch.get_num_threads())
+
+def export_model(model_class: type[DigitModelBase], runtime: str, eager_model: DigitModelBase | None = None, weights_path: Path | None = None) -> Path:
+    """Exports the optimized network, checking its parity with the eager network, and returns the artifact path"""
+    if eager_model is None:
+        eager_model = model_class(weights_path)
+    path = artifact_path(model_class, runtime, weights_path)
+    optimized = optimize_network(eager_model.network)
+    check_parity(eager_model.network, optimized)
+    if runtime == "torchscript":
+        export_torchscript(optimized, path, eager_model.weights_version)
+    elif runtime == "onnxruntime":
+        export_onnx(optimized, path, eager_model.weights_version)
+    else:
+        raise ValueError(f"Unknown runtime {runtime}, expected one of torchscript or onnxruntime")
+    check_parity(eager_model.network, _load_artifact(path, runtime))
+    return path
+
+def load_inference_model(model_class: type[DigitModelBase], runtime: str = "torchscript", weights_path: Path | None = None) -> DigitModelBase:
+    """
+    Loads the model (with the packaged weights, or those at weights_path) for serving with the given runtime,
+    from its cached artifact if it's up to date with the weights. Otherwise the artifact is re-exported,
+    or if that's not possible (e.g. a read-only install), the optimized network is used directly.
+    """
+    if runtime == "eager":
+        return model_class(weights_path)
+    if runtime == "onnxruntime" and importlib.util.find_spec("onnxruntime") is None:
+        raise ValueError("The onnxruntime runtime requires the onnxruntime package to be installed")
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime}, expected one of {', '.join(RUNTIMES)}")
+
+    weights_version = packaged_weights_version(model_class.weights_filename) if weights_path is None else weights_file_version(weights_path)
+    path = artifact_path(model_class, runtime, weights_path)
+    if not is_up_to_date(path, weights_version):
+        eager_model = model_class(weights_path)
+        try:
+            export_model(model_class, runtime, eager_model, weights_path)
+        except (OSError, ImportError):
+            # Either the package directory isn't writable, or onnx isn't installed to export with
+            return DigitModelBase(optimize_network(eager_model.network), weights_version)
+    return DigitModelBase(_load_artifact(path, runtime), weights_version)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=[*PACKAGED_MODELS, "all"], default="all")
+    parser.add_argument(
+        "--runtime",
+        choices=["torchscript", "onnxruntime", "all"],
+        default="all",
+        help="Which artifacts to export; onnxruntime is skipped under all if it isn't installed",
+    )
+    args = parser.parse_args()
+
+    model_names = list(PACKAGED_MODELS) if args.model == "all" else [args.model]
+    if args.runtime == "all":
+        runtimes = ["torchscript"] + (["onnxruntime"] if onnxruntime_available() else [])
+    else:
+        runtimes = [args.runtime]
+    for model_name in model_names:
+        model_class = PACKAGED_MODELS[model_name]
+        eager_model = model_class()
+        for runtime in runtimes:
+            path = export_model(model_class, runtime, eager_model)
+            print(f"Exported {model_name} for {runtime} to {path} (parity checked against the eager model)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Trains a digit network on memory-mapped uint8 datasets: MNIST, and any submissions exported with
+model_api.submission_export. The weights are saved in the .pth format which FirstModel and SecondModel load.
+
+Batches are gathered from the memory-mapped files, inverted, and (optionally) augmented with a random rotation,
+scale and shift, all as one vectorized operation per batch, in DataLoader worker processes.
+So the main process only has to run the network.
+
+Run with: uv run --package model model-train --model v2 --mnist ./data --output ./model_v2.pth
+"""
+import argparse
+import random
+import time
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn as nn
+from .cpus import available_cpu_count
+from .datasets import exported_submission_files, mnist_files
+from .digit_model import DigitModelBase, affine_transform
+from .export import PACKAGED_MODELS, write_atomically
+
+# Matching the notebooks each model was first trained in
+DEFAULT_AUGMENT = {"v1": False, "v2": True}
+DEFAULT_OPTIMIZER = {"v1": "sgd", "v2": "adam"}
+
+def random_affine(
+    images: torch.Tensor,
+    max_rotation_degrees: float = 30.0,
+    scale_range: tuple[float, float] = (0.8, 1.2),
+    max_translation: float = 0.1,
+) -> torch.Tensor:
+    """
+    Applies a different random rotation, scale and translation (as a fraction of the image) to each image
+    of an N x 1 x H x W batch with a black background, using torch's global random generator.
+    """
+    batch_size = images.shape[0]
+    angles = torch.deg2rad((torch.rand(batch_size) * 2 - 1) * max_rotation_degrees)
+    scales = torch.empty(batch_size).uniform_(*scale_range)
+    translations = (torch.rand(batch_size, 2) * 2 - 1) * max_translation
+    return affine_transform(images, angles, scales, translations)
+
+class DigitBatches(torch.utils.data.Dataset):
+    """
+    Digits from one or more pairs of (pixels, labels) .npy files, indexed by a list of indices to load a whole batch at once.
+    Each batch is returned as an N x 1 x 28 x 28 float tensor, inverted to a black background,
+    with values from 0 to 255, and a tensor of N labels.
+    """
+
+    def __init__(self, sources: list[tuple[Path, Path]], augment: bool):
+        if len(sources) == 0:
+            raise ValueError("Expected at least one dataset to train on")
+        self.sources = sources
+        self.augment = augment
+        lengths = [len(np.load(labels_path, mmap_mode="r")) for (_pixels_path, labels_path) in sources]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # Opened lazily, so that each worker process maps the files itself, rather than receiving a copy
+        self._arrays = None
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def _open(self) -> list[tuple[np.ndarray, np.ndarray]]:
+        if self._arrays is None:
+            self._arrays = [
+                (np.load(pixels_path, mmap_mode="r"), np.load(labels_path, mmap_mode="r"))
+                for (pixels_path, labels_path) in self.sources
+            ]
+        return self._arrays
+
+    def __getitem__(self, indices: list[int]) -> tuple[torch.Tensor, torch.Tensor]:
+        # Sorted to read the files in order; a batch's order doesn't matter
+        indices = np.sort(np.asarray(indices))
+        pixels = np.empty((len(indices), 28, 28), dtype=np.uint8)
+        labels = np.empty(len(indices), dtype=np.int64)
+        source_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        for (source_id, (source_pixels, source_labels)) in enumerate(self._open()):
+            in_source = source_ids == source_id
+            if in_source.any():
+                source_indices = indices[in_source] - self.offsets[source_id]
+                pixels[in_source] = source_pixels[source_indices]
+                labels[in_source] = source_labels[source_indices]
+        images = torch.from_numpy(pixels).unsqueeze(1).to(torch.float32).neg_().add_(255)
+        if self.augment:
+            images = random_affine(images)
+        return (images, torch.from_numpy(labels))
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def initialize_worker(worker_id: int):
+    # The main process runs the network with the other cores
+    torch.set_num_threads(1)
+    # Torch seeds each worker from the loader's generator, so derive numpy's seed from that
+    np.random.seed(torch.initial_seed() % 2**32)
+
+def create_loader(dataset: DigitBatches, batch_size: int, workers: int, seed: int, pin_memory: bool) -> torch.utils.data.DataLoader:
+    generator = torch.Generator().manual_seed(seed)
+    batches = torch.utils.data.BatchSampler(
+        torch.utils.data.RandomSampler(dataset, generator=generator),
+        batch_size=batch_size,
+        drop_last=False,
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        # Each item from the sampler is a list of indices, which the dataset loads as a batch
+        sampler=batches,
+        batch_size=None,
+        num_workers=workers,
+        pin_memory=pin_memory,
+        persistent_workers=workers > 0,
+        worker_init_fn=initialize_worker,
+        generator=generator,
+    )
+
+def evaluate(network: nn.Module, dataset: DigitBatches, input_scale: float, device: torch.device, batch_size: int = 1000) -> float:
+    """The network's accuracy on the dataset"""
+    network.eval()
+    correct = 0
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            (images, labels) = dataset[list(range(start, min(start + batch_size, len(dataset))))]
+            logits = network(images.to(device) * input_scale)
+            correct += (logits.argmax(dim=1).cpu() == labels).sum().item()
+    return correct / len(dataset)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=list(PACKAGED_MODELS), required=True)
+    parser.add_argument("--mnist", metavar="DATA_DIR", help="Train on MNIST's training digits (downloaded to DATA_DIR), and evaluate on its test digits")
+    parser.add_argument("--submissions", metavar="EXPORT_DIR", action="append", default=[], help="Also train on submissions exported to EXPORT_DIR")
+    parser.add_argument("--output", required=True, help="Where to save the trained weights, e.g. model_v2.pth")
+    parser.add_argument("--init", choices=["random", "packaged"], default="random", help="Start from random weights, or fine-tune the packaged weights")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--optimizer", choices=["adam", "sgd"], help="Defaults to what the model was first trained with")
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--augment", action=argparse.BooleanOptionalAction, help="Defaults to whether the model was first trained with augmentation")
+    parser.add_argument("--workers", type=int, default=min(4, max(1, available_cpu_count() // 2)), help="DataLoader worker processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--deterministic", action="store_true", help="Only use deterministic algorithms, which may be slower")
+    args = parser.parse_args()
+
+    model_class: type[DigitModelBase] = PACKAGED_MODELS[args.model]
+    augment = args.augment if args.augment is not None else DEFAULT_AUGMENT[args.model]
+    optimizer_name = args.optimizer if args.optimizer is not None else DEFAULT_OPTIMIZER[args.model]
+    input_scale = 1 / 255 if model_class.scale_inputs else 1.0
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    seed_everything(args.seed)
+    torch.use_deterministic_algorithms(args.deterministic)
+    if device.type == "cpu":
+        torch.set_num_threads(max(1, available_cpu_count() - args.workers))
+
+    train_sources = []
+    test_sources = []
+    if args.mnist is not None:
+        train_sources.append(mnist_files(args.mnist, train=True))
+        test_sources.append(mnist_files(args.mnist, train=False))
+    for export_dir in args.submissions:
+        train_sources += exported_submission_files(export_dir)
+    train_set = DigitBatches(train_sources, augment=augment)
+    test_set = DigitBatches(test_sources, augment=False) if test_sources else None
+    loader = create_loader(train_set, args.batch_size, args.workers, args.seed, pin_memory=device.type == "cuda")
+
+    network = model_class.network_class()
+    if args.init == "packaged":
+        network.load_state_dict(model_class().network.state_dict())
+    network.to(device)
+    if optimizer_name == "adam":
+        optimizer = torch.optim.Adam(network.parameters(), lr=args.lr)
+    else:
+        optimizer = torch.optim.SGD(network.parameters(), lr=args.lr, momentum=0.9)
+    criterion = nn.CrossEntropyLoss()
+
+    print(f"Training {args.model} on {len(train_set)} digits, with {args.workers} workers and {torch.get_num_threads()} torch threads")
+    cores = available_cpu_count()
+    total_images = 0
+    total_seconds = 0.0
+    for epoch in range(1, args.epochs + 1):
+        network.train()
+        running_loss = 0.0
+        epoch_images = 0
+        started_at = time.perf_counter()
+        for (images, labels) in loader:
+            images = images.to(device, non_blocking=True) * input_scale
+            labels = labels.to(device, non_blocking=True)
+            optimizer.zero_grad()
+            loss = criterion(network(images), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * len(labels)
+            epoch_images += len(labels)
+        epoch_seconds = time.perf_counter() - started_at
+        total_images += epoch_images
+        total_seconds += epoch_seconds
+
+        accuracy = f", test accuracy {evaluate(network, test_set, input_scale, device):.2%}" if test_set is not None else ""
+        images_per_second = epoch_images / epoch_seconds
+        print(
+            f"[epoch {epoch}] loss {running_loss / epoch_images:.4f}{accuracy}"
+            f" - {images_per_second:,.0f} images/s ({images_per_second / cores:,.0f} per core)"
+        )
+        # Saved after each epoch, so that an interrupted run keeps its progress
+        state_dict = {name: tensor.cpu() for (name, tensor) in network.state_dict().items()}
+        write_atomically(Path(args.output), lambda temporary_path: torch.save(state_dict, temporary_path))
+
+    images_per_second = total_images / total_seconds
+    print(f"Saved weights to {args.output}. Trained at {images_per_second:,.0f} images/s, {images_per_second / cores:,.0f} per core ({cores} cores)")
+
+if __name__ == "__main__":
+    main()
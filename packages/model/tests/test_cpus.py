@@ -0,0 +1,10 @@
+import os
+import pytest
+
+from model import cpus
+
+@pytest.mark.parametrize(("quota", "expected"), [(None, 8), (2.0, 2), (1.5, 2), (0.5, 1), (16.0, 8)])
+def test_available_cpu_count_is_limited_by_the_cgroup_quota(monkeypatch, quota, expected):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    monkeypatch.setattr(cpus, "cgroup_cpu_quota", lambda: quota)
+    assert cpus.available_cpu_count() == expected
@@ -0,0 +1,35 @@
+import shutil
+from pathlib import Path
+import pytest
+import torch
+
+import model
+from model.export import PACKAGED_MODELS, check_parity, export_model, load_inference_model, onnxruntime_available
+
+RUNTIMES = [
+    "torchscript",
+    pytest.param("onnxruntime", marks=pytest.mark.skipif(not onnxruntime_available(), reason="onnx and onnxruntime aren't installed")),
+]
+
+@pytest.fixture(params=list(PACKAGED_MODELS))
+def model_class(request):
+    return PACKAGED_MODELS[request.param]
+
+@pytest.fixture
+def weights_path(model_class, tmp_path) -> Path:
+    """A copy of the packaged weights, so the artifacts are exported next to it rather than into the package"""
+    copied_path = tmp_path / model_class.weights_filename
+    shutil.copyfile(Path(model.__file__).parent / model_class.weights_filename, copied_path)
+    return copied_path
+
+@pytest.mark.parametrize("runtime", RUNTIMES)
+def test_exported_model_matches_eager_model(model_class, weights_path, runtime):
+    eager_model = model_class(weights_path)
+    export_model(model_class, runtime, eager_model, weights_path)
+    # Loads the artifact just exported, as it's up to date with the weights
+    exported_model = load_inference_model(model_class, runtime, weights_path)
+
+    assert exported_model.weights_version == eager_model.weights_version
+    generator = torch.Generator().manual_seed(1)
+    for batch_size in (1, 7, 64):
+        check_parity(eager_model.network, exported_model.network, torch.rand((batch_size, 1, 28, 28), generator=generator) * 255)